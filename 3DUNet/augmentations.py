@@ -3,7 +3,8 @@ import numpy as np
 import SimpleITK as sitk
 import math
 
-from utils import normalize, padd, matrix_from_axis_angle
+import augmentations_numpy
+from utils import normalize, padd, matrix_from_axis_angle, getResampledSize, getReferenceGrid, resampleToGrid
 
 
 
@@ -37,6 +38,15 @@ def applyAugmentations(image, segmentation, output_size, translation, noise):
         image.update({name : roi_filter.Execute(image[name])})
     segmentation = roi_filter.Execute(seg)
 
+    image = applyNoise(image, noise)
+
+    
+    return image, segmentation
+
+
+# Adds random noise to the images and normalizes them.
+def applyNoise(image, noise):
+
     #
     noise_filter = sitk.AdditiveGaussianNoiseImageFilter()
     noise_filter.SetMean(0)
@@ -48,7 +58,17 @@ def applyAugmentations(image, segmentation, output_size, translation, noise):
     for name in image.keys():
         image.update({name : normalize(image[name], 99, 1)})
 
-    
+    return image
+
+
+# Resamples the native images & segmentation through the transform straight onto the output grid.
+def applyFusedTransform(image, segmentation, transform, grid, output_size):
+
+    for name in image.keys():
+        image.update({name : resampleToGrid(image[name], transform, sitk.sitkLinear, grid, output_size)})
+
+    segmentation = resampleToGrid(segmentation, transform, sitk.sitkNearestNeighbor, grid, output_size)
+
     return image, segmentation
 
 
@@ -210,4 +230,69 @@ def augmentData(img, seg, event):
 
     imgs_augmented, seg_augmented = applyAugmentations(imgs_transformed, seg_transformed, output_size, translation, noise)
 
-    return imgs_augmented, seg_augmented
\ No newline at end of file
+    return imgs_augmented, seg_augmented
+
+
+# Draws the augmentation of native images as in augmentData: the transform, the noise and the output grid. The grid
+# starts at the translation (an index on the resampled grid, padded in z-direction as in padd).
+def getFusedAugmentation(img, event, resolution, output_size):
+
+    reference = img['AxT2']
+    prel_img = reference + 1
+    center = getCenter(prel_img)
+
+    # Bounding box as indices on the resampled grid
+    BB = getBoundingBox(prel_img)
+    grid = getReferenceGrid(reference.GetOrigin(), resolution, reference.GetDirection())
+    start = grid.TransformPhysicalPointToIndex(prel_img.TransformIndexToPhysicalPoint(BB[:3]))
+    stop = grid.TransformPhysicalPointToIndex(prel_img.TransformIndexToPhysicalPoint([i + n for i, n in zip(BB[:3], BB[3:])]))
+    BB = list(start) + [b - a for a, b in zip(start, stop)]
+
+    rot = getRotation(event)
+    scale = getScale(event)
+
+    transform = getTransform(img, center, rot, scale)
+
+    noise = getNoise(event)
+    translation = getTranslation(output_size, BB, event)
+
+    z_padding = output_size[2] - getResampledSize(reference, resolution)[2]
+    pad_lower = math.floor(z_padding / 2) if z_padding > 0 else 0
+    grid.SetOrigin(grid.TransformIndexToPhysicalPoint([int(translation[0]), int(translation[1]), int(translation[2]) - pad_lower]))
+
+    return transform, grid, noise
+
+
+# Same augmentation as augmentData, but on images at their native resolution. The change of spacing, the rotation and
+# scaling, the translation and the crop are combined into one resampling onto the output grid, so every image is
+# interpolated once instead of being resampled to the resolution and then transformed on the full grid.
+def augmentDataFused(img, seg, event, resolution=[0.5, 0.5, 3]):
+
+    output_size = [192, 192, 32]
+
+    transform, grid, noise = getFusedAugmentation(img, event, resolution, output_size)
+
+    imgs_transformed, seg_transformed = applyFusedTransform(img, seg, transform, grid, output_size)
+    imgs_augmented = applyNoise(imgs_transformed, noise)
+
+    return imgs_augmented, seg_transformed
+
+
+# Same augmentation as augmentDataFused with the NumPy backend (see augmentations_numpy). All images must share the
+# geometry of the AxT2 image (e.g. ADC and HBV resampled to the T2) and are returned as one (C, Z, Y, X) array, in the
+# order of img.keys(), with a (Z, Y, X) uint8 label map. The labels equal those of augmentDataFused up to voxels on
+# a rounding tie of the nearest-neighbour interpolation (see augmentations_numpy.warp).
+def augmentDataNumpy(img, seg, event, resolution=[0.5, 0.5, 3], out=None, seg_out=None):
+
+    output_size = [192, 192, 32]
+
+    transform, grid, noise = getFusedAugmentation(img, event, resolution, output_size)
+
+    # Seed of the noise, drawn from np.random as in preprocessing.drawAugmentation, so that a seeded call is reproducible.
+    noise_seed = int(np.random.randint(1, 2**31))
+
+    images = np.stack([sitk.GetArrayViewFromImage(img[name]) for name in img.keys()]).astype(np.float32, copy=False)
+
+    return augmentations_numpy.augmentArrays(images, sitk.GetArrayViewFromImage(seg), augmentations_numpy.getGeometry(img['AxT2']),
+                                             augmentations_numpy.getGeometry(grid), transform, output_size, noise,
+                                             noise_seed, out=out, seg_out=seg_out)
@@ -0,0 +1,165 @@
+import numpy as np
+from scipy import ndimage
+
+from utils import normalizeArray
+
+'''
+NumPy backend of the 3D U-Net augmentation.
+
+The sample is kept as one (C, Z, Y, X) float32 array (C image channels, e.g. T2, ADC and HBV) with a (Z, Y, X) label
+map, instead of one SimpleITK image per channel. The spacing change, rotation and scaling, translation, padding, crop
+and an optional left-right flip are combined into one affine map from the output voxels to the input voxels, which is
+applied to every channel with scipy.ndimage.affine_transform. Noise and normalization are applied in place.
+Output arrays can be passed in (out, seg_out) to reuse them between samples.
+'''
+
+
+# Origin, spacing and direction of a SimpleITK image (or a grid from utils.getReferenceGrid) as arrays.
+def getGeometry(image):
+
+    return {'origin': np.array(image.GetOrigin()),
+            'spacing': np.array(image.GetSpacing()),
+            'direction': np.array(image.GetDirection()).reshape(3, 3)}
+
+
+# Affine part (A, b) of a SimpleITK transform, so that transform.TransformPoint(p) = A p + b.
+def getTransformAffine(transform):
+
+    b = np.array(transform.TransformPoint((0.0, 0.0, 0.0)))
+    A = np.stack([np.array(transform.TransformPoint(tuple(axis))) - b for axis in np.eye(3)], axis=1)
+
+    return A, b
+
+
+def getIndexMap(input_geometry, output_geometry, transform, output_size, flip=False):
+    """
+    Map from the output voxels to the input voxels: input index = matrix @ output index + offset, in (Z, Y, X) order.
+
+    Args:
+        input_geometry (dict): Geometry of the input image (getGeometry).
+        output_geometry (dict): Geometry of the output grid.
+        transform: SimpleITK transform from output points to input points, as used by sitk.Resample.
+        output_size (list): Output size (X, Y, Z).
+        flip (bool): Flip the output left-right (along X).
+
+    Returns:
+        tuple: 3x3 matrix and offset.
+    """
+    A, b = getTransformAffine(transform)
+
+    # Output index -> physical point -> transformed point -> input index (all in X, Y, Z)
+    to_physical = output_geometry['direction'] @ np.diag(output_geometry['spacing'])
+    to_index = np.diag(1 / input_geometry['spacing']) @ np.linalg.inv(input_geometry['direction'])
+
+    matrix = to_index @ A @ to_physical
+    offset = to_index @ (A @ output_geometry['origin'] + b - input_geometry['origin'])
+
+    if flip:
+        offset = offset + matrix[:, 0] * (output_size[0] - 1)
+        matrix = matrix @ np.diag([-1, 1, 1])
+
+    return matrix[::-1, ::-1], offset[::-1]
+
+
+# Mask of the output voxels that map inside the input, i.e. within half a voxel of its first and last voxels as in
+# SimpleITK. Computed one slice at a time.
+def getInsideMask(matrix, offset, input_shape, output_shape):
+
+    inside = np.empty(output_shape, dtype=bool)
+    y, x = np.meshgrid(np.arange(output_shape[1]), np.arange(output_shape[2]), indexing='ij')
+
+    for z in range(output_shape[0]):
+        inside[z] = True
+        for axis in range(3):
+            coordinate = matrix[axis, 0] * z + matrix[axis, 1] * y + matrix[axis, 2] * x + offset[axis]
+            inside[z] &= (coordinate >= -0.5) & (coordinate <= input_shape[axis] - 0.5)
+
+    return inside
+
+
+def warp(images, seg, matrix, offset, output_shape, out=None, seg_out=None):
+    """
+    Resamples all channels (linear) and the label map (nearest neighbour) onto the output grid. Voxels that map
+    outside the input are set to 0.
+
+    Both scipy and SimpleITK round half-way indices up, but the index map is composed in a different order than in
+    SimpleITK. A source point on a rounding tie (half-way between two input voxels) can therefore pick the other
+    neighbour, so the labels equal those of sitk.Resample up to such boundary voxels, and the images up to float
+    rounding.
+
+    Args:
+        images (np.ndarray): (C, Z, Y, X) float32 images.
+        seg (np.ndarray): (Z, Y, X) label map.
+        matrix, offset: Index map from getIndexMap.
+        output_shape (tuple): Output shape (Z, Y, X).
+
+    Returns:
+        tuple: (C, Z, Y, X) float32 images and (Z, Y, X) uint8 label map.
+    """
+    if out is None:
+        out = np.empty((images.shape[0],) + tuple(output_shape), dtype=np.float32)
+    if seg_out is None:
+        seg_out = np.empty(output_shape, dtype=np.uint8)
+
+    # The index map and the mask are shared by all channels.
+    outside = ~getInsideMask(matrix, offset, seg.shape, output_shape)
+
+    for channel, channel_out in zip(images, out):
+        ndimage.affine_transform(channel, matrix, offset=offset, output_shape=output_shape, output=channel_out,
+                                 order=1, mode='nearest', prefilter=False)
+        channel_out[outside] = 0
+
+    ndimage.affine_transform(seg, matrix, offset=offset, output_shape=output_shape, output=seg_out, order=0,
+                             mode='nearest', prefilter=False)
+    seg_out[outside] = 0
+
+    return out, seg_out
+
+
+# Adds Gaussian noise to the images in place.
+def addNoise(images, noise, seed=None):
+
+    if noise > 0:
+        rng = np.random.default_rng(seed)
+        for channel in images:
+            channel += rng.normal(0, noise, channel.shape).astype(np.float32)
+
+    return images
+
+
+# Normalizes every channel between the lower and upper percentiles in place (see utils.normalizeArray).
+def normalizeChannels(images, upper_percentile=99, lower_percentile=1, tolerance=None):
+
+    for channel in images:
+        normalizeArray(channel, upper_percentile, lower_percentile, tolerance)
+
+    return images
+
+
+def augmentArrays(images, seg, input_geometry, output_geometry, transform, output_size, noise=0, noise_seed=None,
+                  flip=False, out=None, seg_out=None, tolerance=None):
+    """
+    Augments a multi-channel sample: one warp onto the output grid, then noise and normalization in place.
+
+    Args:
+        images (np.ndarray): (C, Z, Y, X) float32 images at their native resolution.
+        seg (np.ndarray): (Z, Y, X) label map.
+        input_geometry (dict): Geometry of the images (getGeometry).
+        output_geometry (dict): Geometry of the output grid (origin at the first voxel of the crop).
+        transform: SimpleITK transform from output points to input points.
+        output_size (list): Output size (X, Y, Z).
+        noise (float): Standard deviation of the Gaussian noise.
+        flip (bool): Flip the sample left-right.
+        tolerance (float): Tolerance of the normalization percentiles in percentile points (see
+            utils.getPercentiles). None computes them from all voxels.
+
+    Returns:
+        tuple: (C, Z, Y, X) float32 images normalized to [0, 1] and (Z, Y, X) uint8 label map.
+    """
+    matrix, offset = getIndexMap(input_geometry, output_geometry, transform, output_size, flip)
+    out, seg_out = warp(images, seg, matrix, offset, tuple(reversed(output_size)), out, seg_out)
+
+    addNoise(out, noise, noise_seed)
+    normalizeChannels(out, tolerance=tolerance)
+
+    return out, seg_out
@@ -0,0 +1,184 @@
+import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import preprocessing    # Import preprocessing module
+from sample_io import LABELS, one_hot
+
+'''
+Streaming data loader for training the 3D U-Net without the preprocessing step.
+
+Instead of saving every augmentation with preprocess_3DUNet.py, fresh augmentations are generated on the fly by
+preprocessing.startPreprocess in a pool of processes. At most `prefetch` samples are queued ahead of the training, so
+the memory use is bounded, and nothing is written to disk. The samples are returned in a fixed order that only depends
+on the seed, so the stream is the same for any number of workers. The batches can be used directly in a Python training
+loop or through as_tf_dataset in tf.data.
+'''
+
+# Case directories in a data folder (e.g. .../Train).
+def get_case_dirs(folder):
+
+    return [os.path.join(folder, case) for case in sorted(os.listdir(folder)) if os.path.isdir(os.path.join(folder, case))]
+
+
+# Keeps more resampled cases in memory in each worker.
+def init_worker(cache_size):
+
+    preprocessing.CACHE_SIZE = cache_size
+
+
+# Generates one augmented sample. Returns the image (Z, Y, X) as float32 and the label map as uint8.
+def generate_sample(job):
+
+    inputDir, event, seed, flip, cache_folder, fused, backend = job
+
+    np.random.seed(seed)
+    img, seg = preprocessing.startPreprocess(inputDir, event=event, cache_folder=cache_folder, fused=fused, backend=backend)
+
+    # Apply flipping
+    if flip == 1:
+        img = np.flip(img, axis=2)
+        seg = np.flip(seg, axis=2)
+
+    return np.ascontiguousarray(img, dtype=np.float32), np.ascontiguousarray(seg, dtype=np.uint8)
+
+
+# Endless sequence of jobs: the cases are shuffled in every pass, and each sample gets its own seed and flip.
+def generate_jobs(case_dirs, event='Train', flips=2, seed=0, shuffle=True, cache_folder=None, fused=False, backend='sitk'):
+
+    rng = np.random.default_rng(seed)
+    sequence = np.random.SeedSequence(seed)
+
+    while True:
+        order = rng.permutation(len(case_dirs)) if shuffle else range(len(case_dirs))
+        for index in order:
+            flip = int(rng.integers(flips))
+            job_seed = int(sequence.spawn(1)[0].generate_state(1)[0])
+            yield case_dirs[index], event, job_seed, flip, cache_folder, fused, backend
+
+
+def sample_stream(case_dirs, event='Train', flips=2, seed=0, shuffle=True, workers=1, prefetch=8, cache_folder=None,
+                  fused=False, backend='sitk', cache_size=8, samples=None, mp_context=None):
+    """
+    Generates augmented samples on the fly.
+
+    Args:
+        case_dirs (list): Case directories (containing the T2 DICOM folder and the segmentation).
+        event (str): Train, Validate or Test. Decides the augmentation ranges, as in startPreprocess.
+        flips (int): 1 - no flipping, 2 - half of the samples are flipped left-right.
+        seed (int): Seed of the stream.
+        shuffle (bool): Shuffle the cases in every pass.
+        workers (int): Number of processes. With 0, the samples are generated in this process.
+        prefetch (int): Maximum number of samples generated ahead.
+        cache_folder (str): Disk cache of the resampled cases (see preprocessing.loadCase).
+        fused (bool): Use the single-resample augmentation (see preprocessing.augmentCaseFused).
+        backend (str): Augmentation backend, sitk or numpy (see preprocessing.startPreprocess).
+        cache_size (int): Number of resampled cases kept in memory by each worker.
+        samples (int): Number of samples to generate. If None, the stream is endless.
+        mp_context: Multiprocessing context of the pool (e.g. multiprocessing.get_context('spawn')). Defaults to the
+            platform default (fork on Linux).
+
+    Yields:
+        tuple: Image (32, 192, 192) float32 and label map (32, 192, 192) uint8.
+    """
+    jobs = generate_jobs(case_dirs, event, flips, seed, shuffle, cache_folder, fused, backend)
+    if samples is not None:
+        jobs = (job for _, job in zip(range(samples), jobs))
+
+    if workers == 0:
+        init_worker(cache_size)
+        for job in jobs:
+            yield generate_sample(job)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=init_worker, initargs=(cache_size,))
+    queue = deque()
+    try:
+        # Keep the queue filled with at most `prefetch` samples and return them in order.
+        for job in jobs:
+            queue.append(executor.submit(generate_sample, job))
+            if len(queue) >= prefetch:
+                yield queue.popleft().result()
+
+        while queue:
+            yield queue.popleft().result()
+    finally:
+        for future in queue:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def batch_stream(case_dirs, batch_size=2, one_hot_labels=True, dtype=np.float32, **kwargs):
+    """
+    Generates batches of augmented samples on the fly. Takes the same keyword arguments as sample_stream.
+
+    Yields:
+        tuple: Images (B, 32, 192, 192, 1) and labels (B, 32, 192, 192, 6) one-hot, or (B, 32, 192, 192) uint8 label
+            maps if one_hot_labels is False.
+    """
+    imgs = []
+    segs = []
+    for img, seg in sample_stream(case_dirs, **kwargs):
+        imgs.append(img)
+        segs.append(seg)
+
+        if len(imgs) == batch_size:
+            x = np.stack(imgs)[..., None].astype(dtype, copy=False)
+            y = np.stack(segs)
+            yield x, one_hot(y, dtype) if one_hot_labels else y
+            imgs = []
+            segs = []
+
+
+def as_tf_dataset(case_dirs, batch_size=2, **kwargs):
+    """
+    Wraps batch_stream in a tf.data.Dataset with one-hot float32 labels. Takes the same keyword arguments as
+    sample_stream. TensorFlow is only imported when this function is used.
+
+    The generator runs inside the multithreaded TensorFlow runtime, where forking can deadlock, so the workers are
+    started with the spawn method. The training script therefore needs an `if __name__ == '__main__':` guard.
+    """
+    import tensorflow as tf
+
+    kwargs.setdefault('mp_context', multiprocessing.get_context('spawn'))
+
+    size = list(reversed(preprocessing.OUTPUT_SIZE))
+    signature = (tf.TensorSpec(shape=[batch_size] + size + [1], dtype=tf.float32),
+                 tf.TensorSpec(shape=[batch_size] + size + [len(LABELS)], dtype=tf.float32))
+
+    return tf.data.Dataset.from_generator(lambda: batch_stream(case_dirs, batch_size=batch_size, **kwargs),
+                                          output_signature=signature)
+
+
+# Measures the throughput of the data loader.
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_folder', type=str, default="C:\\William\\TEST\\Train", help='Path to the folder containing the cases.')
+    parser.add_argument('--event', type=str, default='Train', help='Train, Validate or Test.')
+    parser.add_argument('--batch_size', type=int, default=2, help='Number of samples in a batch.')
+    parser.add_argument('--batches', type=int, default=20, help='Number of batches to generate.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes generating samples.')
+    parser.add_argument('--prefetch', type=int, default=8, help='Maximum number of samples generated ahead.')
+    parser.add_argument('--cache_folder', type=str, default=None, help='Folder for caching the resampled cases.')
+    parser.add_argument('--fused', action='store_true', help='Use the single-resample augmentation.')
+    parser.add_argument('--backend', type=str, default='sitk', choices=preprocessing.BACKENDS, help='Augmentation backend.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the stream.')
+    parser.add_argument('--tf', action='store_true', help='Read the batches through as_tf_dataset (needs TensorFlow).')
+    args = parser.parse_args()
+
+    loader = as_tf_dataset if args.tf else batch_stream
+    stream = loader(get_case_dirs(args.input_folder), batch_size=args.batch_size, event=args.event,
+                    seed=args.seed, workers=args.workers, prefetch=args.prefetch, cache_folder=args.cache_folder,
+                    fused=args.fused, backend=args.backend, samples=args.batches * args.batch_size)
+
+    start = time.perf_counter()
+    for x, y in stream:
+        pass
+
+    elapsed = time.perf_counter() - start
+    print('Generated {} batches of {} in {:.1f} s ({:.1f} samples/s, {} workers, {} backend{}).'.format(args.batches, args.batch_size, elapsed, args.batches * args.batch_size / elapsed, args.workers, args.backend, ', tf.data' if args.tf else ''))
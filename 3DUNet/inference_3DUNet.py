@@ -0,0 +1,207 @@
+import os
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import preprocessing    # Import preprocessing module
+from data_loader import get_case_dirs
+from augmentations_numpy import getTransformAffine
+
+'''
+Batch inference with the frozen 3D U-Net graph (.pb) on the CPU.
+
+Every case is preprocessed as a Test sample by preprocessing.startPreprocess (one 192x192x32 crop around the center of
+the image), optionally in a pool of processes (--workers) while the model runs. The crops of --batch_size cases go
+through the model in one forward pass. The predicted labels are mapped back onto the original DICOM grid with a single
+nearest-neighbour resampling through the transform and output grid of the preprocessing, and saved as CASE.nrrd.
+Voxels outside the crop are background. TensorFlow is only imported when the graph is loaded.
+'''
+
+
+class FrozenGraph:
+    """
+    A frozen TensorFlow graph (.pb) in a CPU session.
+
+    Args:
+        pb_file (str): Path to the frozen graph.
+        input_name (str): Name of the input tensor. Defaults to the first placeholder.
+        output_name (str): Name of the output tensor. Defaults to the output of the last operation.
+        threads (int): Number of threads of the session. 0 lets TensorFlow decide.
+    """
+
+    def __init__(self, pb_file, input_name=None, output_name=None, threads=0):
+        import tensorflow as tf
+
+        graph_def = tf.compat.v1.GraphDef()
+        with open(pb_file, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.compat.v1.import_graph_def(graph_def, name='')
+
+        operations = self.graph.get_operations()
+        if input_name is None:
+            input_name = [op for op in operations if op.type == 'Placeholder'][0].outputs[0].name
+        if output_name is None:
+            output_name = operations[-1].outputs[0].name
+
+        self.input = self.graph.get_tensor_by_name(input_name)
+        self.output = self.graph.get_tensor_by_name(output_name)
+
+        config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1,
+                                          device_count={'GPU': 0})
+        self.session = tf.compat.v1.Session(graph=self.graph, config=config)
+
+    @property
+    def batch_size(self):
+        """
+        Fixed batch size of the input, None if it is dynamic.
+        """
+        return self.input.shape[0] if self.input.shape.rank is not None else None
+
+    def __call__(self, images):
+        """
+        Class probabilities (B, 32, 192, 192, 6) of a batch of images (B, 32, 192, 192).
+        """
+        return self.session.run(self.output, {self.input: images[..., None]})
+
+
+# Geometry of a SimpleITK image as plain lists, so that it can be sent between processes.
+def get_geometry(image):
+
+    return {'origin': list(image.GetOrigin()), 'spacing': list(image.GetSpacing()), 'direction': list(image.GetDirection()),
+            'size': list(image.GetSize())}
+
+
+# Preprocesses one case for the inference. Returns the crop (32, 192, 192) and the mapping back to the native image:
+# the transform from the crop to the native image (as an affine matrix and translation), the crop grid and the native grid.
+def prepare_case(case_dir, cache_folder=None, backend='sitk'):
+
+    img, _, geometry = preprocessing.startPreprocess(case_dir, event='Test', cache_folder=cache_folder, fused=True,
+                                                     backend=backend, return_geometry=True)
+
+    # The native case was loaded by startPreprocess and is taken from the in-memory cache.
+    native = preprocessing.loadCase(case_dir, cache_folder, resample=False)[0]
+
+    matrix, translation = getTransformAffine(geometry['transform'])
+    mapping = {'matrix': matrix.ravel().tolist(), 'translation': translation.tolist(),
+               'grid': dict(get_geometry(geometry['grid']), size=preprocessing.OUTPUT_SIZE), 'native': get_geometry(native)}
+
+    return img, mapping
+
+
+def to_native(labels, mapping):
+    """
+    Maps predicted labels on the crop back onto the native image grid with one nearest-neighbour resampling.
+
+    Args:
+        labels (np.ndarray): Label map (32, 192, 192).
+        mapping (dict): Mapping of the case (see prepare_case).
+
+    Returns:
+        SimpleITK.Image: uint8 label image with the geometry of the native image.
+    """
+    prediction = sitk.GetImageFromArray(np.asarray(labels, dtype=np.uint8))
+    prediction.SetOrigin(mapping['grid']['origin'])
+    prediction.SetSpacing(mapping['grid']['spacing'])
+    prediction.SetDirection(mapping['grid']['direction'])
+
+    # The preprocessing maps crop points to native points; the inverse maps native points to crop points.
+    transform = sitk.AffineTransform(3)
+    transform.SetMatrix(mapping['matrix'])
+    transform.SetTranslation(mapping['translation'])
+
+    native = mapping['native']
+    return sitk.Resample(prediction, native['size'], transform.GetInverse(), sitk.sitkNearestNeighbor, native['origin'],
+                         native['spacing'], native['direction'], 0, sitk.sitkUInt8)
+
+
+# Prepared cases in the order of case_dirs, generated in a pool of processes if workers > 0. At most prefetch cases
+# are prepared ahead, as in data_loader.sample_stream.
+def prepared_cases(case_dirs, workers=0, cache_folder=None, backend='sitk', prefetch=8):
+
+    if workers == 0:
+        for case_dir in case_dirs:
+            yield prepare_case(case_dir, cache_folder, backend)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        queue = deque()
+        for case_dir in case_dirs:
+            queue.append(executor.submit(prepare_case, case_dir, cache_folder, backend))
+            if len(queue) >= prefetch:
+                yield queue.popleft().result()
+
+        while queue:
+            yield queue.popleft().result()
+
+
+def predict_cases(case_dirs, model, output_folder, batch_size=4, workers=0, cache_folder=None, backend='sitk'):
+    """
+    Predicts the cases in batches and saves the labels on the native grid as CASE.nrrd in the output folder.
+
+    Args:
+        case_dirs (list): Case directories (containing the T2 DICOM folder).
+        model (FrozenGraph): The 3D U-Net.
+        output_folder (str): Path to the output folder.
+        batch_size (int): Number of cases in a forward pass (ignored if the model has a fixed batch size).
+        workers (int): Number of processes preprocessing the cases. With 0, they are preprocessed in this process.
+
+    Returns:
+        dict: Seconds spent waiting for the preprocessing, in the model and mapping back and saving.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    batch_size = model.batch_size or batch_size
+    timings = {'preprocess': 0.0, 'model': 0.0, 'save': 0.0}
+
+    cases = prepared_cases(case_dirs, workers, cache_folder, backend, prefetch=max(2 * batch_size, workers))
+    for start in range(0, len(case_dirs), batch_size):
+        names = [os.path.basename(os.path.normpath(case_dir)) for case_dir in case_dirs[start:start + batch_size]]
+
+        t = time.perf_counter()
+        batch = [next(cases) for _ in names]
+        images = np.zeros((batch_size,) + batch[0][0].shape, dtype=np.float32)
+        for i, (img, _) in enumerate(batch):
+            images[i] = img
+        timings['preprocess'] += time.perf_counter() - t
+
+        t = time.perf_counter()
+        labels = np.argmax(model(images if model.batch_size else images[:len(batch)]), axis=-1).astype(np.uint8)
+        timings['model'] += time.perf_counter() - t
+
+        t = time.perf_counter()
+        for name, (_, mapping), case_labels in zip(names, batch, labels):
+            sitk.WriteImage(to_native(case_labels, mapping), os.path.join(output_folder, name + '.nrrd'), useCompression=True)
+        timings['save'] += time.perf_counter() - t
+
+    return timings
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_folder', type=str, default="C:\\William\\TEST\\Test", help='Path to the folder containing the cases.')
+    parser.add_argument('--model', type=str, default="C:\\William\\TEST\\3DUNet\\model.pb", help='Path to the frozen graph of the 3D U-Net.')
+    parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\3DUNet\\Predictions", help='Path to the desired output folder.')
+    parser.add_argument('--input_name', type=str, default=None, help='Name of the input tensor. Defaults to the first placeholder of the graph.')
+    parser.add_argument('--output_name', type=str, default=None, help='Name of the output tensor. Defaults to the output of the last operation of the graph.')
+    parser.add_argument('--batch_size', type=int, default=4, help='Number of cases in a forward pass.')
+    parser.add_argument('--threads', type=int, default=0, help='Number of threads of the TensorFlow session. 0 lets TensorFlow decide.')
+    parser.add_argument('--workers', type=int, default=0, help='Number of processes preprocessing the cases while the model runs.')
+    parser.add_argument('--cache_folder', type=str, default=None, help='Folder for caching the loaded cases (see preprocessing.loadCase).')
+    parser.add_argument('--backend', type=str, default='sitk', choices=preprocessing.BACKENDS, help='Preprocessing backend.')
+    args = parser.parse_args()
+
+    model = FrozenGraph(args.model, args.input_name, args.output_name, args.threads)
+    case_dirs = get_case_dirs(args.input_folder)
+
+    start = time.perf_counter()
+    timings = predict_cases(case_dirs, model, args.output_folder, args.batch_size, args.workers, args.cache_folder, args.backend)
+    elapsed = time.perf_counter() - start
+
+    print('Predicted {} cases in {:.1f} s ({:.2f} cases/s, batch size {}, {} workers).'.format(len(case_dirs), elapsed, len(case_dirs) / elapsed if elapsed > 0 else 0, model.batch_size or args.batch_size, args.workers))
+    print('Preprocessing {preprocess:.1f} s, model {model:.1f} s, mapping and saving {save:.1f} s.'.format(**timings))
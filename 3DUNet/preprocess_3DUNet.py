@@ -1,9 +1,16 @@
 import os
+import time
+import zlib
+import json
+import traceback
 import numpy as np
+import SimpleITK as sitk
 import preprocessing    # Import preprocessing module
+import sample_io        # Import sample_io module
 import utils            # Import utils module
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 def check_range(value):
     ivalue = int(value)
@@ -13,39 +20,180 @@ def check_range(value):
 
 '''
 This file will perform the preprocessing for the 3D U-Net model.
+Every (case, augmentation) is an independent job that is run in a pool of processes (--workers). Each job seeds the
+random number generator from (--seed, event, case, augmentation), so the output does not depend on the number of
+workers or the order in which the jobs finish.
 '''
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--input_folder', type=str, default="C:\\William\\TEST", help='Path to folder containing the probabilities from the model prediction.')
-parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\3DUNet\\Preprocessed", help='Path to the desired output folder.')
-parser.add_argument('--n_aug_tr', type=int, default=25, help='...')
-parser.add_argument('--n_aug_val', type=int, default=5, help='...')
-parser.add_argument('--n_flips_tr', type=check_range, default=2, help='...')
-parser.add_argument('--n_flips_val', type=check_range, default=2, help='...')
-args = parser.parse_args()
 
-# Define directories for training and validation data.
-caseDir_train = os.path.join(args.input_folder, 'Train')
-saveDir_train = os.path.join(args.output_folder, 'Train')
+# Seed of the random number generator for one augmentation of a case.
+def job_seed(seed, event, case, aug):
 
-caseDir_val = os.path.join(args.input_folder, 'Validate')
-saveDir_val = os.path.join(args.output_folder, 'Validate')
+    entropy = [seed, zlib.crc32(event.encode()), zlib.crc32(str(case).encode()), aug]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+# Filename will be: CASE_AUG_FLIP
+# Where AUG and FLIP will be a number within the range specified earlier.
+def get_description(event, aug, flip):
+
+    if event == 'Train' or event == 'Validate':
+        return '_' + str(aug) + '_' + str(flip)
+    return ''
+
+
+# Preprocesses one augmentation of a case and saves it with all flips.
+# Options are: cache_folder, fused, backend (see preprocessing.startPreprocess), sample_format and t2_dtype (see sample_io).
+# If a shard (images file, labels file, first row) is given, the flips are written to its rows instead of npz-files.
+def preprocess_job(inputDir, save_path, case, aug, event, flips, seed, options, shard=None):
+
+    if shard is not None:
+        images_file, labels_file, row = shard
+        images = np.load(images_file, mmap_mode='r+')
+        labels = np.load(labels_file, mmap_mode='r+')
+
+    np.random.seed(seed)
+    img, seg = preprocessing.startPreprocess(inputDir, event=event, cache_folder=options.get('cache_folder'), fused=options.get('fused', False),
+                                             backend=options.get('backend', 'sitk'))
+
+    for flip in range(flips):
+        # Apply flipping
+        if flip == 1:
+            img = np.flip(img, axis=2)
+            seg = np.flip(seg, axis=2)
+
+        if shard is not None:
+            images[row + flip] = sample_io.encode_t2(img, options.get('t2_dtype', 'float32'))
+            labels[row + flip] = seg
+            continue
+
+        sample_io.save_sample(os.path.join(save_path, str(case) + get_description(event, aug, flip)), img, seg,
+                              sample_format=options.get('sample_format', 'masks'), t2_dtype=options.get('t2_dtype', 'float32'))
+
+    if shard is not None:
+        images.flush()
+        labels.flush()
+
+
+# Limits the threads of the SimpleITK filters in a worker, so that the workers do not compete for the cores.
+# read_threads is the number of threads reading the DICOM slices of a case (see preprocessing.READ_THREADS).
+def init_worker(threads, read_threads=0):
+
+    if threads > 0:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    preprocessing.READ_THREADS = read_threads
+
+
+# Runs a job and reports the error instead of raising it, so that one bad case does not stop the other jobs.
+def run_job(job):
+
+    try:
+        preprocess_job(*job)
+        return job, None
+    except Exception:
+        return job, traceback.format_exc()
+
+
+# List of jobs for one event configuration.
+def get_jobs(config, seed=0, options=None):
+
+    options = {} if options is None else options
+    jobs = []
+    for case in sorted(os.listdir(config['caseDir'])):
+        inputDir = os.path.join(config['caseDir'], case)
+        for aug in range(config['Augmentations']):
+            jobs.append((inputDir, config['save_path'], case, aug, config['event'], config['Flips'],
+                         job_seed(seed, config['event'], case, aug), options))
+    return jobs
+
+
+# Allocates the shards of an event and assigns every job to its rows. The rows of a job are never split over shards.
+# Returns the jobs with their shard and the index of the samples.
+def create_shards(save_path, jobs, shard_size, t2_dtype='float32'):
+
+    shards = []
+    samples = []
+    sharded_jobs = []
+
+    for job in jobs:
+        case, aug, event, flips = job[2:6]
+
+        if len(shards) == 0 or shards[-1]['rows'] + flips > shard_size:
+            shards.append({'images': 'images_' + str(len(shards)).zfill(3) + '.npy',
+                           'labels': 'labels_' + str(len(shards)).zfill(3) + '.npy',
+                           'rows': 0})
+
+        row = shards[-1]['rows']
+        sharded_jobs.append(job + ((os.path.join(save_path, shards[-1]['images']), os.path.join(save_path, shards[-1]['labels']), row),))
+        for flip in range(flips):
+            samples.append({'name': str(case) + get_description(event, aug, flip), 'case': case, 'aug': aug, 'flip': flip,
+                            'shard': len(shards) - 1, 'row': row + flip})
+        shards[-1]['rows'] += flips
+
+    shape = list(reversed(preprocessing.OUTPUT_SIZE))
+    for shard in shards:
+        for name, dtype in [('images', t2_dtype), ('labels', np.uint8)]:
+            array = np.lib.format.open_memmap(os.path.join(save_path, shard[name]), mode='w+', dtype=dtype, shape=tuple([shard['rows']] + shape))
+            del array
+
+    return sharded_jobs, {'t2_dtype': t2_dtype, 'shards': shards, 'samples': samples}
+
+
+# Writes the index of the shards, without the samples of the failed jobs.
+def write_shard_index(save_path, index, failed=()):
+
+    failed = set((job[2], job[3]) for job in failed)
+    index = dict(index, samples=[sample for sample in index['samples'] if (sample['case'], sample['aug']) not in failed])
+
+    index_file = os.path.join(save_path, sample_io.SHARD_INDEX)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_file + '.tmp', index_file)
 
-caseDir_test = os.path.join(args.input_folder, 'Test')
-saveDir_test = os.path.join(args.output_folder, 'Test')
 
 if __name__ == '__main__':
-    
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_folder', type=str, default="C:\\William\\TEST", help='Path to folder containing the probabilities from the model prediction.')
+    parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\3DUNet\\Preprocessed", help='Path to the desired output folder.')
+    parser.add_argument('--n_aug_tr', type=int, default=25, help='...')
+    parser.add_argument('--n_aug_val', type=int, default=5, help='...')
+    parser.add_argument('--n_flips_tr', type=check_range, default=2, help='...')
+    parser.add_argument('--n_flips_val', type=check_range, default=2, help='...')
+    parser.add_argument('--workers', type=int, default=1, help='Number of augmentations that are generated at the same time.')
+    parser.add_argument('--threads', type=int, default=0, help='Number of threads used by the SimpleITK filters in each worker. 0 keeps the SimpleITK default.')
+    parser.add_argument('--read_threads', type=int, default=0, help='Number of threads reading the DICOM slices of a case. 0 uses the SimpleITK series reader.')
+    parser.add_argument('--chunksize', type=int, default=1, help='Number of jobs sent to a worker at a time. Use the number of augmentations to let one worker generate all augmentations of a case.')
+    parser.add_argument('--cache_folder', type=str, default=None, help='Folder for caching the resampled cases, so that each case is only read and resampled once, also across runs.')
+    parser.add_argument('--fused', action='store_true', help='Resample each sample once from the native image onto the output grid, instead of resampling to the resolution first.')
+    parser.add_argument('--backend', type=str, default='sitk', choices=preprocessing.BACKENDS, help='Augmentation backend. numpy warps the native image with scipy (always fused).')
+    parser.add_argument('--sample_format', type=str, default='masks', choices=sample_io.SAMPLE_FORMATS, help='masks: t2 and six boolean masks (original format). compact: t2 and one uint8 label map.')
+    parser.add_argument('--t2_dtype', type=str, default='float32', choices=sample_io.T2_DTYPES, help='Data type of t2 in the compact format. uint16 quantizes the normalized image in steps of 1/65535.')
+    parser.add_argument('--shards', action='store_true', help='Pack the samples into large uncompressed shards (images_XXX.npy, labels_XXX.npy and index.json) instead of one npz-file per sample.')
+    parser.add_argument('--shard_size', type=int, default=1000, help='Maximum number of samples in a shard.')
+    parser.add_argument('--seed', type=int, default=0, help='Base seed of the random augmentations.')
+    args = parser.parse_args()
+
+    # Define directories for training and validation data.
+    caseDir_train = os.path.join(args.input_folder, 'Train')
+    saveDir_train = os.path.join(args.output_folder, 'Train')
+
+    caseDir_val = os.path.join(args.input_folder, 'Validate')
+    saveDir_val = os.path.join(args.output_folder, 'Validate')
+
+    caseDir_test = os.path.join(args.input_folder, 'Test')
+    saveDir_test = os.path.join(args.output_folder, 'Test')
+
     # Configuration for training and validation events.
     # Flips represents LEFT - RIGHT flipping. 1 - No flipping, one sample is saved. 2 - Save two samples, one with and one without flipping.
-    train = {   
+    train = {
                 'event'         : 'Train',
                 'caseDir'       : caseDir_train,
                 'save_path'     : saveDir_train,
                 'Augmentations' : args.n_aug_tr,
                 'Flips'         : args.n_flips_tr
             }
-    
+
     val =   {
                 'event'         : 'Validate',
                 'caseDir'       : caseDir_val,
@@ -53,7 +201,7 @@ if __name__ == '__main__':
                 'Augmentations' : args.n_aug_val,
                 'Flips'         : args.n_flips_val
             }
-    
+
     test =   {
                 'event'         : 'Test',
                 'caseDir'       : caseDir_test,
@@ -62,56 +210,33 @@ if __name__ == '__main__':
                 'Flips'         : 1
             }
 
-    # Loop over training and validation configurations
-    for ii in [train, val, test]: #[train, val, test]:
+    options = {'cache_folder': args.cache_folder, 'fused': args.fused, 'backend': args.backend, 'sample_format': args.sample_format, 't2_dtype': args.t2_dtype}
 
-        event = ii['event']
-        caseDir = ii['caseDir']
-        save_path = ii['save_path']
-        augmentations = ii['Augmentations']
-        flips = ii['Flips']
+    # Collect the jobs of the training, validation and test configurations
+    jobs = []
+    indices = []
+    for ii in [train, val, test]: #[train, val, test]:
 
         # Create output directory for saving preprocessed data if it doesn't already exist
-        utils.makeDirectory(save_path)
-
-    
-        cases = os.listdir(caseDir)
-        # Loop through cases in specified directory
-        for case in cases:
-            inputDir = os.path.join(caseDir, case)
-
-            # Perform preprocessing for the specified number of augmentations
-            for aug in range(augmentations):
-                img, seg = preprocessing.startPreprocess(inputDir, event=event)
-                
-                for flip in range(flips):
-                    # Apply flipping
-                    if flip == 1:
-                        img = np.flip(img, axis=2)
-                        seg = np.flip(seg, axis=2)
-                    
-                    # Extract segmented regions
-                    seg_bg = (seg == 0)     # BG
-                    seg_pz = (seg == 1)     # PZ
-                    seg_cz = (seg == 2)     # CZ
-                    seg_tz = (seg == 3)     # TZ
-                    seg_afs = (seg == 4)    # AFS
-                    seg_u = (seg == 5)      # Urethra
-                
-                
-                    # Save preprocessed data
-                    # Filename will be: CASE_AUG_FLIP
-                    # Where AUG and FLIP will be a number within the range specified earlier.
-                    if event == 'Train' or event == 'Validate':
-                        description = '_' + str(aug) + '_' + str(flip)
-                    else:
-                        description = ''
-
-                    np.savez_compressed(os.path.join(save_path, str(case) + description),
-                                        t2=np.array(img, dtype=np.float32),
-                                        seg_bg=np.array(seg_bg, dtype=np.bool_),
-                                        seg_pz=np.array(seg_pz, dtype=np.bool_),
-                                        seg_cz=np.array(seg_cz, dtype=np.bool_),
-                                        seg_tz=np.array(seg_tz, dtype=np.bool_),
-                                        seg_afs=np.array(seg_afs, dtype=np.bool_),
-                                        seg_u=np.array(seg_u, dtype=np.bool_))
\ No newline at end of file
+        utils.makeDirectory(ii['save_path'])
+        event_jobs = get_jobs(ii, args.seed, options)
+
+        if args.shards:
+            event_jobs, index = create_shards(ii['save_path'], event_jobs, args.shard_size, args.t2_dtype)
+            indices.append((ii['save_path'], index))
+
+        jobs += event_jobs
+
+    start = time.perf_counter()
+    failed = []
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.threads, args.read_threads)) as executor:
+        for job, error in executor.map(run_job, jobs, chunksize=args.chunksize):
+            if error is not None:
+                print('Failed: ' + job[2] + ' (' + job[4] + ', augmentation ' + str(job[3]) + ')\n' + error)
+                failed.append(job)
+
+    for save_path, index in indices:
+        write_shard_index(save_path, index, [job for job in failed if job[1] == save_path])
+
+    print('Generated {} augmentations in {:.1f} s, {} failed ({} workers).'.format(len(jobs) - len(failed), time.perf_counter() - start, len(failed), args.workers))
@@ -1,42 +1,226 @@
 import os
+import math
+import json
+import hashlib
 import numpy as np
 import SimpleITK as sitk
+from collections import OrderedDict
 
-from utils import getData, resampleImage, matrix_from_axis_angle, normalize, padd
+import augmentations_numpy
 
+from utils import getData, resampleImage, matrix_from_axis_angle, normalizeArray, padd, getResampledSize, getReferenceGrid, resampleToGrid
 
-# Function for preprocessing an image with corresponding segmentation
-def startPreprocess(imgDir, event='Train'):
-    
-    # Define resolution and output size
-    resolution = [0.5, 0.5, 3]
-    output_size = [192, 192, 32]
 
-    # Load image and segmentation data. Output is two sitk-images.
-    img, seg = getData(imgDir)
+# Define resolution and output size
+RESOLUTION = [0.5, 0.5, 3]
+OUTPUT_SIZE = [192, 192, 32]
+
+# Augmentation backends, see startPreprocess
+BACKENDS = ['sitk', 'numpy']
+
+# Tolerance of the normalization percentiles in percentile points, e.g. 0.5 estimates the 1st percentile somewhere
+# between the 0.5th and 1.5th (see utils.getPercentiles). None computes them from all voxels.
+NORMALIZE_TOLERANCE = None
+
+
+# Number of resampled cases that are kept in memory by loadCase.
+CACHE_SIZE = 8
+
+# Number of threads reading the DICOM slices of a case. 0 reads the series with SimpleITK's series reader.
+READ_THREADS = 0
+
+# Index of the DICOM series (sorted files and geometry, one json-file per series) in the cache folder, see utils.getSeriesIndex
+SERIES_INDEX = 'series_index'
+_case_cache = OrderedDict()
 
-    # Resample image and segmentation to the desired resolution
-    img = resampleImage(img, newSpacing=resolution, interpolator=sitk.sitkLinear)
-    seg = resampleImage(seg, newSpacing=resolution, interpolator=sitk.sitkNearestNeighbor)
 
-    # Threshold and determine the center of the image
+# Threshold and determine the center of the image
+def getCentroid(img):
+
     mask = sitk.BinaryThreshold(img, lowerThreshold=0, upperThreshold=1e10, insideValue=1, outsideValue=0)
     filter = sitk.LabelShapeStatisticsImageFilter()
     filter.Execute(mask)
-    center = filter.GetCentroid(1)
+
+    return filter.GetCentroid(1)
+
+
+# Deterministic stage of the preprocessing: loads a case, resamples it to the target resolution and finds its center.
+def resampleCase(imgDir, index_folder=None):
+
+    # Load image and segmentation data. Output is two sitk-images.
+    img, seg = getData(imgDir, index_folder, READ_THREADS)
+
+    # Resample image and segmentation to the desired resolution
+    img = resampleImage(img, newSpacing=RESOLUTION, interpolator=sitk.sitkLinear)
+    seg = resampleImage(seg, newSpacing=RESOLUTION, interpolator=sitk.sitkNearestNeighbor)
+
+    return img, seg, getCentroid(img)
+
+
+# Deterministic stage of the fused preprocessing: loads a case at its native resolution and finds its center.
+def readCase(imgDir, index_folder=None):
+
+    img, seg = getData(imgDir, index_folder, READ_THREADS)
+    img = sitk.Cast(img, sitk.sitkFloat32)
+
+    # The center is found on the resampled grid, as in resampleCase. Only the thresholded mask is resampled.
+    mask = sitk.BinaryThreshold(img, lowerThreshold=0, upperThreshold=1e10, insideValue=1, outsideValue=0)
+    mask = resampleImage(mask, newSpacing=RESOLUTION, interpolator=sitk.sitkNearestNeighbor, defaultValue=1)
+
+    return img, seg, getCentroid(mask)
+
+
+# Latest modification time of the files in a case directory.
+def getModificationTime(imgDir):
+
+    mtime = os.path.getmtime(imgDir)
+    for root, _, files in os.walk(imgDir):
+        for file in files:
+            mtime = max(mtime, os.path.getmtime(os.path.join(root, file)))
+    return mtime
+
+
+# Paths of the files of a case in the disk cache.
+def getCacheFiles(imgDir, cache_folder, resample=True):
+
+    key = hashlib.sha1(os.path.abspath(imgDir).encode()).hexdigest() + ('' if resample else '_native')
+    return [os.path.join(cache_folder, key + suffix) for suffix in ['_img.nrrd', '_seg.nrrd', '.json']]
+
+
+# Reads a resampled case from the disk cache. Returns None if it is not cached or older than the case directory.
+def readCaseCache(imgDir, cache_folder, resample=True):
+
+    img_file, seg_file, json_file = getCacheFiles(imgDir, cache_folder, resample)
+    if not os.path.exists(json_file):
+        return None
+
+    with open(json_file) as f:
+        header = json.load(f)
+    if header['mtime'] != getModificationTime(imgDir):
+        return None
+
+    return sitk.ReadImage(img_file), sitk.ReadImage(seg_file), tuple(header['center'])
+
+
+# Per-process temporary name of a cache file. The extension is kept, so that SimpleITK writes the same format.
+def getTempFile(file):
+
+    root, extension = os.path.splitext(file)
+    return root + '.' + str(os.getpid()) + '.tmp' + extension
+
+
+# Writes a resampled case to the disk cache. Every file is written under a per-process temporary name and moved into
+# place, so workers writing the same case never read each other's partial files. The json-file is moved last and marks
+# the entry as complete, so an interrupted write is never used.
+def writeCaseCache(imgDir, cache_folder, img, seg, center, resample=True):
+
+    os.makedirs(cache_folder, exist_ok=True)
+    img_file, seg_file, json_file = getCacheFiles(imgDir, cache_folder, resample)
+
+    sitk.WriteImage(img, getTempFile(img_file))
+    os.replace(getTempFile(img_file), img_file)
+    sitk.WriteImage(seg, getTempFile(seg_file), useCompression=True)
+    os.replace(getTempFile(seg_file), seg_file)
+
+    header = {'case': os.path.abspath(imgDir), 'mtime': getModificationTime(imgDir), 'center': list(center)}
+    with open(getTempFile(json_file), 'w') as f:
+        json.dump(header, f)
+    os.replace(getTempFile(json_file), json_file)
+
+
+# Resampled image, segmentation and center of a case. The last CACHE_SIZE cases are kept in memory and, if a
+# cache_folder is given, all cases are also stored on disk, so the case is only read and resampled once.
+# With resample=False the case is kept at its native resolution (for the fused preprocessing).
+def loadCase(imgDir, cache_folder=None, resample=True):
+
+    key = (os.path.abspath(imgDir), resample)
+    if key in _case_cache:
+        _case_cache.move_to_end(key)
+        return _case_cache[key]
+
+    case = readCaseCache(imgDir, cache_folder, resample) if cache_folder is not None else None
+    if case is None:
+        index_folder = os.path.join(cache_folder, SERIES_INDEX) if cache_folder is not None else None
+        case = resampleCase(imgDir, index_folder) if resample else readCase(imgDir, index_folder)
+        if cache_folder is not None:
+            writeCaseCache(imgDir, cache_folder, *case, resample=resample)
+
+    _case_cache[key] = case
+    while len(_case_cache) > CACHE_SIZE:
+        _case_cache.popitem(last=False)
+
+    return case
+
+
+# Function for preprocessing an image with corresponding segmentation.
+# With fused=True the native image is resampled only once, straight onto the output grid (see augmentCaseFused).
+# The numpy backend does the same with scipy instead of SimpleITK (see augmentCaseNumpy), so it is always fused.
+# With return_geometry=True the geometry of the sample is returned as well: the transform from the output grid to the
+# case and the output grid (a 1x1x1 image with the origin, spacing and direction of the sample), e.g. to map a
+# prediction back onto the case.
+def startPreprocess(imgDir, event='Train', cache_folder=None, fused=False, backend='sitk', return_geometry=False):
+
+    if backend not in BACKENDS:
+        raise ValueError('Unknown augmentation backend: ' + str(backend) + '. Options are: ' + ', '.join(BACKENDS))
+
+    img, seg, center = loadCase(imgDir, cache_folder, resample=not (fused or backend == 'numpy'))
+    if backend == 'numpy':
+        return augmentCaseNumpy(img, seg, center, event=event, return_geometry=return_geometry)
+    if fused:
+        return augmentCaseFused(img, seg, center, event=event, return_geometry=return_geometry)
+    return augmentCase(img, seg, center, event=event, return_geometry=return_geometry)
+
+
+# Ranges of the random augmentation parameters. Test samples are not augmented.
+AUGMENTATION_RANGES = {
+    'Train'     : {'rot': (-30, 30), 'scale': (0.925, 1/0.925), 'noise': (0, 0.1), 'movement_px': 4},
+    'Validate'  : {'rot': (-10, 10), 'scale': (0.975, 1/0.975), 'noise': None, 'movement_px': 2},
+}
+
+
+# Draws the random augmentation parameters of a sample.
+def drawAugmentation(event='Train'):
+
+    ranges = AUGMENTATION_RANGES.get(event)
 
     # Define rotation and scaling parameters based on event (Train/Validate)
-    if event == 'Train':
-        rot = np.random.uniform(-30, 30)
-        scale = np.random.uniform(0.925, 1/0.925)
-    elif event == 'Validate':
-        rot = np.random.uniform(-10, 10)
-        scale = np.random.uniform(0.975, 1/0.975)
+    if ranges is not None:
+        rot = np.random.uniform(*ranges['rot'])
+        scale = np.random.uniform(*ranges['scale'])
     else:
         rot = 0
         scale = 1
 
-    # Set up the similarity transform with rotation and scaling
+    # Define noise parameters
+    if ranges is not None and ranges['noise'] is not None:
+        noise = np.random.uniform(*ranges['noise'])
+    else:
+        noise = 0
+
+    # Seed of the noise filter (its default is the wall clock), so that a seeded run is reproducible.
+    noise_seed = int(np.random.randint(1, 2**31))
+
+    # Get Translation
+        
+        # According to PI-QUALS the prostate image FOV (in-plane) should be 12-20cm. Our bounding box is 9.6cm.
+        # This means that we have 2.4 - 10.4 cm to move around in. We will restrict movement to be ≤ 2cm in the x- and y-direction.
+
+    maximum_movement_px = ranges['movement_px'] if ranges is not None else 0
+
+    movement = [i * maximum_movement_px for i in RESOLUTION[:2]]
+    if maximum_movement_px > 0: 
+        rand_x = np.random.randint(-movement[0], movement[0])
+        rand_y = np.random.randint(-movement[1], movement[1])
+    else:
+        rand_x = 0
+        rand_y = 0
+
+    return {'rot': rot, 'scale': scale, 'noise': noise, 'noise_seed': noise_seed, 'rand_x': rand_x, 'rand_y': rand_y}
+
+
+# Similarity transform that rotates around the slice normal and scales around the center.
+def getSimilarityTransform(img, center, rot, scale):
+
     transform = sitk.Similarity3DTransform()
     transform.SetCenter(center)
     direction = np.array(img.GetDirection()).reshape(3,3)
@@ -46,51 +230,43 @@ def startPreprocess(imgDir, event='Train'):
     transform.SetMatrix(np_rot_mat.flatten().tolist())
     transform.SetScale(scale)
 
-    # Apply transformation
-    img_transformed = sitk.Resample(img, transform, sitk.sitkLinear, 0)
-    seg_transformed = sitk.Resample(seg, transform, sitk.sitkNearestNeighbor, 0)
+    return transform
 
-    # Define noise parameters
-    if event == 'Train':
-        noise = np.random.uniform(0, 0.1)
-    elif event == 'Validate':
-        noise = 0
-    else:
-        noise = 0
 
-    # Add Gaussian noise
+# Adds Gaussian noise to an image.
+def addNoise(img, noise, seed):
+
     noise_filter = sitk.AdditiveGaussianNoiseImageFilter()
     noise_filter.SetMean(0)
     noise_filter.SetStandardDeviation(noise)
-    img_noise = noise_filter.Execute(img_transformed)
+    noise_filter.SetSeed(seed)
 
+    return noise_filter.Execute(img)
 
-    # Padd image to required output size.
-    img_padded, seg_padded = padd(img_noise, seg_transformed, output_size[2])
-    
-    # Get Translation
-        
-        # According to PI-QUALS the prostate image FOV (in-plane) should be 12-20cm. Our bounding box is 9.6cm.
-        # This means that we have 2.4 - 10.4 cm to move around in. We will restrict movement to be ≤ 2cm in the x- and y-direction.
 
-    if event == 'Train':
-        maximum_movement_px = 4
-    elif event == 'Validate':
-        maximum_movement_px = 2
-    else:
-        maximum_movement_px = 0
+# Random stage of the preprocessing: augments a resampled case and crops it to the output size.
+def augmentCase(img, seg, center, event='Train', return_geometry=False):
 
+    output_size = OUTPUT_SIZE
+    params = drawAugmentation(event)
 
-    movement = [i * maximum_movement_px for i in resolution[:2]]
-    if maximum_movement_px > 0: 
-        rand_x = np.random.randint(-movement[0], movement[0])
-        rand_y = np.random.randint(-movement[1], movement[1])
-    else:
-        rand_x = 0
-        rand_y = 0
+    # Set up the similarity transform with rotation and scaling
+    transform = getSimilarityTransform(img, center, params['rot'], params['scale'])
+
+    # Apply transformation
+    img_transformed = sitk.Resample(img, transform, sitk.sitkLinear, 0)
+    seg_transformed = sitk.Resample(seg, transform, sitk.sitkNearestNeighbor, 0)
+
+    # Add Gaussian noise
+    img_noise = addNoise(img_transformed, params['noise'], params['noise_seed'])
+
+
+    # Padd image to required output size.
+    img_padded, seg_padded = padd(img_noise, seg_transformed, output_size[2])
+    
     center_idx = img_padded.TransformPhysicalPointToIndex(center)
-    start_pos = [int(center_idx[0] + rand_x - output_size[0]/2),
-                 int(center_idx[1] + rand_y - output_size[1]/2),
+    start_pos = [int(center_idx[0] + params['rand_x'] - output_size[0]/2),
+                 int(center_idx[1] + params['rand_y'] - output_size[1]/2),
                  0]
 
     # Crop the image and segmentation to the specified output size
@@ -101,16 +277,80 @@ def startPreprocess(imgDir, event='Train'):
     img_roi = roi_filter.Execute(img_padded)
     seg_roi = roi_filter.Execute(seg_padded)
 
-    # Normalize between 1st and 99th percentile.
-    normalized_image = normalize(img_roi, 99, 1)
+    # Convert images to numpy arrays and normalize between 1st and 99th percentile.
+    arr = normalizeArray(sitk.GetArrayFromImage(img_roi).astype(np.float32, copy=False), 99, 1, NORMALIZE_TOLERANCE)
+    seg = sitk.GetArrayFromImage(seg_roi)
+
+    if return_geometry:
+        grid = getReferenceGrid(img_roi.GetOrigin(), img_roi.GetSpacing(), img_roi.GetDirection())
+        return arr, seg, {'transform': transform, 'grid': grid}
+    return arr, seg
+
+
+# Output grid of a native case: the crop of augmentCase, on the resampled grid padded in z-direction.
+def getOutputGrid(img, center, params):
+
+    output_size = OUTPUT_SIZE
+
+    # Grid of the resampled image, shifted by the padding in z-direction.
+    z_padding = output_size[2] - getResampledSize(img, RESOLUTION)[2]
+    grid = getReferenceGrid(img.GetOrigin(), RESOLUTION, img.GetDirection())
+    grid.SetOrigin(grid.TransformContinuousIndexToPhysicalPoint([0, 0, -math.floor(z_padding / 2) if z_padding > 0 else 0]))
+
+    # Move the grid to the crop
+    center_idx = grid.TransformPhysicalPointToIndex(center)
+    start_pos = [int(center_idx[0] + params['rand_x'] - output_size[0]/2),
+                 int(center_idx[1] + params['rand_y'] - output_size[1]/2),
+                 0]
+    grid.SetOrigin(grid.TransformIndexToPhysicalPoint(start_pos))
+
+    return grid
+
+
+# Random stage of the preprocessing on a native (not resampled) case. The change of spacing, the rotation and scaling,
+# the padding and the crop are combined into one resampling of the native image onto the 192x192x32 output grid.
+# The output grid is the same as the crop in augmentCase, but the image is interpolated once instead of twice.
+def augmentCaseFused(img, seg, center, event='Train', return_geometry=False):
+
+    output_size = OUTPUT_SIZE
+    params = drawAugmentation(event)
+
+    transform = getSimilarityTransform(img, center, params['rot'], params['scale'])
+    grid = getOutputGrid(img, center, params)
+
+    img_roi = resampleToGrid(img, transform, sitk.sitkLinear, grid, output_size)
+    seg_roi = resampleToGrid(seg, transform, sitk.sitkNearestNeighbor, grid, output_size)
+
+    # Add Gaussian noise and normalize between 1st and 99th percentile.
+    img_noise = addNoise(img_roi, params['noise'], params['noise_seed'])
 
     # Convert images to numpy arrays
-    arr = sitk.GetArrayFromImage(normalized_image)
+    arr = normalizeArray(sitk.GetArrayFromImage(img_noise).astype(np.float32, copy=False), 99, 1, NORMALIZE_TOLERANCE)
     seg = sitk.GetArrayFromImage(seg_roi)
 
+    if return_geometry:
+        return arr, seg, {'transform': transform, 'grid': grid}
     return arr, seg
 
 
+# Same as augmentCaseFused with the NumPy backend (see augmentations_numpy). Returns the label map as uint8.
+def augmentCaseNumpy(img, seg, center, event='Train', return_geometry=False):
+
+    params = drawAugmentation(event)
+
+    transform = getSimilarityTransform(img, center, params['rot'], params['scale'])
+    grid = getOutputGrid(img, center, params)
+
+    images = sitk.GetArrayViewFromImage(img)[None]
+    arr, seg = augmentations_numpy.augmentArrays(images, sitk.GetArrayViewFromImage(seg), augmentations_numpy.getGeometry(img),
+                                                 augmentations_numpy.getGeometry(grid), transform, OUTPUT_SIZE,
+                                                 params['noise'], params['noise_seed'], tolerance=NORMALIZE_TOLERANCE)
+
+    if return_geometry:
+        return arr[0], seg, {'transform': transform, 'grid': grid}
+    return arr[0], seg
+
+
 # Example usage of preprocessing function
 if __name__ == '__main__':
 
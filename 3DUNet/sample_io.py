@@ -0,0 +1,137 @@
+import os
+import json
+import numpy as np
+
+'''
+Reading and writing of the preprocessed 3D U-Net samples.
+
+Two sample formats are supported:
+    masks   - the original format: t2 as float32 and one boolean mask per label (seg_bg, seg_pz, seg_cz, seg_tz,
+              seg_afs, seg_u).
+    compact - t2 as float32, float16 or uint16 (quantized over [0, 1]) and a single uint8 label map (seg).
+load_sample reads both formats and only expands the labels to one-hot channels when asked to.
+
+The samples can also be packed into a few large shards: images_XXX.npy (N, 32, 192, 192) with t2 and labels_XXX.npy
+(N, 32, 192, 192) with uint8 label maps, plus index.json that maps every CASE_AUG_FLIP to a shard and row. ShardReader
+memory-maps them for random access without decoding.
+'''
+
+# Order of the one-hot label channels, the same as the keys of the masks format.
+LABELS = ['seg_bg', 'seg_pz', 'seg_cz', 'seg_tz', 'seg_afs', 'seg_u']
+
+SAMPLE_FORMATS = ['masks', 'compact']
+T2_DTYPES = ['float32', 'float16', 'uint16']
+
+SHARD_INDEX = 'index.json'
+
+# The normalized t2 lies in [0, 1]; uint16 stores it in steps of 1/65535.
+UINT16_SCALE = 65535
+
+
+# Expands a label map (..., Z, Y, X) to one-hot channels (..., Z, Y, X, 6) in the order of LABELS.
+def one_hot(seg, dtype=np.float32):
+
+    return (seg[..., None] == np.arange(len(LABELS), dtype=seg.dtype)).astype(dtype)
+
+
+# Converts the normalized t2 to the stored data type.
+def encode_t2(img, t2_dtype='float32'):
+
+    if t2_dtype == 'uint16':
+        return np.round(np.clip(img, 0, 1) * UINT16_SCALE).astype(np.uint16)
+    return np.asarray(img, dtype=t2_dtype)
+
+
+# Converts a stored t2 back to float32.
+def decode_t2(t2):
+
+    if t2.dtype == np.uint16:
+        return t2.astype(np.float32) / np.float32(UINT16_SCALE)
+    return t2.astype(np.float32, copy=False)
+
+
+def save_sample(file, img, seg, sample_format='masks', t2_dtype='float32'):
+    """
+    Saves a preprocessed sample as a compressed npz-file.
+
+    Args:
+        file (str): Path to the npz-file.
+        img (np.ndarray): Normalized t2 (Z, Y, X).
+        seg (np.ndarray): Label map (Z, Y, X) with the labels 0-5.
+        sample_format (str): masks or compact, see above. t2_dtype is only used by the compact format.
+    """
+    if sample_format == 'compact':
+        np.savez_compressed(file, t2=encode_t2(img, t2_dtype), seg=np.asarray(seg, dtype=np.uint8))
+        return
+
+    if sample_format != 'masks':
+        raise ValueError('Unknown sample format: ' + str(sample_format) + '. Options are: ' + ', '.join(SAMPLE_FORMATS))
+
+    # Extract segmented regions
+    masks = {name: np.array(seg == value, dtype=np.bool_) for value, name in enumerate(LABELS)}
+
+    np.savez_compressed(file, t2=np.array(img, dtype=np.float32), **masks)
+
+
+def load_sample(file, one_hot_labels=False, dtype=np.float32):
+    """
+    Loads a preprocessed sample in either format.
+
+    Args:
+        file (str): Path to the npz-file.
+        one_hot_labels (bool): Return the labels as one-hot channels (Z, Y, X, 6) of dtype instead of a uint8 label map.
+
+    Returns:
+        tuple: t2 (Z, Y, X) as float32 and the labels.
+    """
+    with np.load(file) as data:
+        img = decode_t2(data['t2'])
+
+        if 'seg' in data:
+            seg = data['seg']
+        else:
+            # Masks format: every voxel belongs to exactly one mask.
+            seg = np.zeros(img.shape, dtype=np.uint8)
+            for value, name in enumerate(LABELS[1:], start=1):
+                seg[data[name]] = value
+
+    if one_hot_labels:
+        return img, one_hot(seg, dtype)
+    return img, seg
+
+
+class ShardReader:
+    """
+    Zero-copy access to the samples in the shards written by preprocess_3DUNet.py (--shards). The shards are
+    memory-mapped read-only, so several training processes share the same pages in the page cache.
+
+    Args:
+        folder (str): Folder with index.json and the shards.
+    """
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, SHARD_INDEX)) as f:
+            self.index = json.load(f)
+
+        self.images = [np.load(os.path.join(folder, shard['images']), mmap_mode='r') for shard in self.index['shards']]
+        self.labels = [np.load(os.path.join(folder, shard['labels']), mmap_mode='r') for shard in self.index['shards']]
+        self.samples = self.index['samples']
+        self.names = {sample['name']: i for i, sample in enumerate(self.samples)}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, i):
+        """
+        Sample i as t2 (Z, Y, X) float32 and a uint8 label map. Both are views into the shards if t2 is stored as
+        float32.
+        """
+        sample = self.samples[i]
+        return decode_t2(self.images[sample['shard']][sample['row']]), self.labels[sample['shard']][sample['row']]
+
+    def find(self, case, aug=None, flip=None):
+        """
+        Index of a sample from its case, augmentation and flip (CASE_AUG_FLIP), as in the npz-file names.
+        """
+        name = str(case) if aug is None else str(case) + '_' + str(aug) + '_' + str(flip)
+        return self.names[name]
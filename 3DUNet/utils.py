@@ -1,7 +1,14 @@
 import os
+import json
+import hashlib
 import numpy as np
 import math
 import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Sorted files and geometry of the DICOM series folders that have been read, see getSeriesIndex
+_series_index = {}
 
 
 # Function to create a directory if it doesn't exist
@@ -10,27 +17,70 @@ def makeDirectory(pathToDir):
         os.makedirs(pathToDir)
 
 
-# Function to normalize pixel values of an image between upper and lower percentiles
-def normalize(image, upper_percentile, lower_percentile):
-    # Extract pixel values from the image
-    image_array = sitk.GetArrayFromImage(image).flatten()
+# Probability that a percentile estimated with a tolerance (see getPercentiles) is further off than the tolerance.
+PERCENTILE_ERROR_PROBABILITY = 1e-3
 
-    # Calculate upper and lower percentiles
-    upperPerc = np.percentile(image_array, upper_percentile)
-    lowerPerc = np.percentile(image_array, lower_percentile)
 
-    # Set up filters for casting and intensity windowing
-    castImageFilter = sitk.CastImageFilter()
-    castImageFilter.SetOutputPixelType(sitk.sitkFloat32)
-    normalizationFilter = sitk.IntensityWindowingImageFilter()
-    normalizationFilter.SetOutputMaximum(1.0)
-    normalizationFilter.SetOutputMinimum(0.0)
-    normalizationFilter.SetWindowMaximum(upperPerc)
-    normalizationFilter.SetWindowMinimum(lowerPerc)
-    
+# Function to calculate the number of random samples that estimate a percentile within the tolerance (in percentile
+# points) with probability 1 - error_probability, from the Dvoretzky-Kiefer-Wolfowitz inequality
+# P(max |F_n - F| > e) <= 2 exp(-2 n e^2). The number does not depend on the image size.
+def getPercentileSampleSize(tolerance, error_probability=PERCENTILE_ERROR_PROBABILITY):
+    return int(math.ceil(math.log(2 / error_probability) / (2 * (tolerance / 100) ** 2)))
+
+
+# Function to calculate the upper and lower percentiles of an image array in one call.
+# With a tolerance (in percentile points), the percentiles are estimated from a uniform random sample of the voxels
+# (drawn with replacement, from a fixed seed so that the result is repeatable). The fraction of voxels below each
+# estimate is then within the tolerance of the requested percentile with probability 1 - PERCENTILE_ERROR_PROBABILITY,
+# whatever the structure of the image. Images with fewer voxels than the sample size are used in full.
+def getPercentiles(image_array, upper_percentile, lower_percentile, tolerance=None, seed=0):
+
+    values = np.ravel(image_array)
+    if tolerance is not None:
+        samples = getPercentileSampleSize(tolerance)
+        if values.size > samples:
+            values = values[np.random.default_rng(seed).integers(0, values.size, samples)]
+
+    lowerPerc, upperPerc = np.percentile(values, [lower_percentile, upper_percentile])
+
+    return float(upperPerc), float(lowerPerc)
+
+
+# Function to normalize a float32 image array between upper and lower percentiles, in place.
+# Gives the same values as the IntensityWindowingImageFilter, which maps the window to [0, 1] in double precision.
+def normalizeArray(image_array, upper_percentile, lower_percentile, tolerance=None):
+
+    upperPerc, lowerPerc = getPercentiles(image_array, upper_percentile, lower_percentile, tolerance)
+
+    # The window is stored as float32, as in the filter
+    upperPerc = float(np.float32(upperPerc))
+    lowerPerc = float(np.float32(lowerPerc))
+
+    scale = 1.0 / (upperPerc - lowerPerc) if upperPerc > lowerPerc else 0.0
+    shift = -lowerPerc * scale
+
+    # One slice at a time, so that the double precision buffer stays small
+    for z in range(image_array.shape[0]):
+        image_slice = image_array[z]
+        below = image_slice < lowerPerc
+        above = image_slice > upperPerc
+        image_slice[...] = image_slice.astype(np.float64) * scale + shift
+        image_slice[below] = 0.0
+        image_slice[above] = 1.0
+
+    return image_array
+
+
+# Function to normalize pixel values of an image between upper and lower percentiles
+def normalize(image, upper_percentile, lower_percentile, tolerance=None):
+    # Copy the pixel values of the image once, as float32
+    image_array = sitk.GetArrayViewFromImage(image).astype(np.float32)
+
     # Apply normalization to the image
-    img = castImageFilter.Execute(image)
-    image_normalized = normalizationFilter.Execute(img)
+    normalizeArray(image_array, upper_percentile, lower_percentile, tolerance)
+
+    image_normalized = sitk.GetImageFromArray(image_array)
+    image_normalized.CopyInformation(image)
     
     return image_normalized 
     
@@ -90,12 +140,8 @@ def matrix_from_axis_angle(a):
     return R
 
 
-# Function to resample an image to a new spacing using a specified interpolator
-def  resampleImage(inputImage, newSpacing, interpolator, defaultValue=0):
-
-    castImageFilter = sitk.CastImageFilter()
-    castImageFilter.SetOutputPixelType(sitk.sitkFloat32)
-    inputImage = castImageFilter.Execute(inputImage)
+# Function to calculate the size of an image resampled to a new spacing
+def getResampledSize(inputImage, newSpacing):
 
     oldSize = inputImage.GetSize()
     oldSpacing = inputImage.GetSpacing()
@@ -105,7 +151,36 @@ def  resampleImage(inputImage, newSpacing, interpolator, defaultValue=0):
     newWidth = oldSpacing_rounded[0] / newSpacing[0] * oldSize[0]
     newHeight = oldSpacing_rounded[1] / newSpacing[1] * oldSize[1]
     newDepth = oldSpacing_rounded[2] / newSpacing[2] * oldSize[2]
-    newSize = [int(newWidth), int(newHeight), int(newDepth)]
+
+    return [int(newWidth), int(newHeight), int(newDepth)]
+
+
+# Function to create a grid (a 1x1x1 image) with the given geometry, used to convert between indices and physical points
+def getReferenceGrid(origin, spacing, direction):
+
+    grid = sitk.Image([1, 1, 1], sitk.sitkUInt8)
+    grid.SetOrigin(origin)
+    grid.SetSpacing(spacing)
+    grid.SetDirection(direction)
+
+    return grid
+
+
+# Function to resample an image through a transform directly onto an output grid, with a single interpolation
+def resampleToGrid(inputImage, transform, interpolator, grid, size, defaultValue=0):
+
+    return sitk.Resample(inputImage, size, transform, interpolator, grid.GetOrigin(), grid.GetSpacing(),
+                         grid.GetDirection(), defaultValue, sitk.sitkFloat32)
+
+
+# Function to resample an image to a new spacing using a specified interpolator
+def  resampleImage(inputImage, newSpacing, interpolator, defaultValue=0):
+
+    castImageFilter = sitk.CastImageFilter()
+    castImageFilter.SetOutputPixelType(sitk.sitkFloat32)
+    inputImage = castImageFilter.Execute(inputImage)
+
+    newSize = getResampledSize(inputImage, newSpacing)
 
     # Set up resampling filter
     filter = sitk.ResampleImageFilter()
@@ -121,9 +196,123 @@ def  resampleImage(inputImage, newSpacing, interpolator, defaultValue=0):
     return outImage
 
 
-# Function to get image and segmentation data from a specified directory
-def getData(inputDir):
+# Function to get a signature of a folder that changes when a file is added, removed or modified
+def getFolderSignature(folder):
+
+    entries = [entry for entry in os.scandir(folder) if entry.is_file()]
+    mtime = max([entry.stat().st_mtime for entry in entries], default=0)
+
+    return [os.path.getmtime(folder), len(entries), mtime]
+
+
+# Function to get the path of the index entry of a DICOM series folder (one json-file per series folder).
+def getSeriesIndexFile(index_folder, key):
+
+    return os.path.join(index_folder, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+
+# Function to save the index entry of a series folder. Every series has its own file, so processes indexing different
+# series never overwrite each other's entries, and the file is replaced at once, so readers never see a partial file.
+def saveSeriesIndex(index_folder, key, entry):
+
+    os.makedirs(index_folder, exist_ok=True)
+    index_file = getSeriesIndexFile(index_folder, key)
+    tmp_file = index_file + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(dict(entry, folder=key), f)
+    os.replace(tmp_file, index_file)
+
+
+# Function to get the sorted files (and geometry, once read) of a DICOM series folder. GDCM only scans the folder when
+# it is new or has changed; the index is kept in memory and, if an index_folder is given, in a json-file per series.
+def getSeriesIndex(dcm_folder, index_folder=None):
+
+    key = os.path.abspath(dcm_folder)
+    signature = getFolderSignature(dcm_folder)
+
+    if index_folder is not None and key not in _series_index:
+        index_file = getSeriesIndexFile(index_folder, key)
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                _series_index[key] = json.load(f)
+
+    entry = _series_index.get(key)
+    if entry is None or entry['signature'] != signature:
+        reader = sitk.ImageSeriesReader()
+        dcm_files = reader.GetGDCMSeriesFileNames(dcm_folder)
+        entry = {'signature': signature, 'files': [os.path.basename(file) for file in dcm_files]}
+        _series_index[key] = entry
+        if index_folder is not None:
+            saveSeriesIndex(index_folder, key, entry)
+
+    return entry
+
+
+# Function to read the slices of a series with a thread pool and assemble them into a volume.
+# Without a geometry, the geometry is taken from the first and last slices.
+def readSlicesThreaded(dcm_files, threads, geometry=None):
+
+    first = sitk.ReadImage(dcm_files[0])
+    first_array = sitk.GetArrayViewFromImage(first)
+
+    volume = np.empty((len(dcm_files),) + first_array.shape[1:], dtype=first_array.dtype)
+    volume[0] = first_array[0]
+
+    def readSlice(z):
+        # Keep a reference to the slice while its array view is copied
+        dcm_slice = sitk.ReadImage(dcm_files[z])
+        volume[z] = sitk.GetArrayViewFromImage(dcm_slice)[0]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(readSlice, range(1, len(dcm_files))))
+
+    if geometry is None:
+        direction = np.array(first.GetDirection()).reshape(3, 3)
+        last_origin = sitk.ReadImage(dcm_files[-1]).GetOrigin()
+        distance = np.dot(np.array(last_origin) - np.array(first.GetOrigin()), direction[:, 2])
+        spacing_z = abs(distance) / (len(dcm_files) - 1) if len(dcm_files) > 1 else first.GetSpacing()[2]
+
+        # Slices ordered against the slice normal run along the negative normal
+        if distance < 0:
+            direction[:, 2] = -direction[:, 2]
+        geometry = {'origin': first.GetOrigin(), 'spacing': first.GetSpacing()[:2] + (spacing_z,), 'direction': tuple(direction.flatten())}
+
+    img = sitk.GetImageFromArray(volume)
+    img.SetOrigin(geometry['origin'])
+    img.SetSpacing(geometry['spacing'])
+    img.SetDirection(geometry['direction'])
+
+    return img
+
+
+# Function to read a DICOM series through the series index. With threads > 0, the slices are read in parallel.
+def readSeries(dcm_folder, index_folder=None, threads=0):
+
+    entry = getSeriesIndex(dcm_folder, index_folder)
+    dcm_files = [os.path.join(dcm_folder, file) for file in entry['files']]
+
+    if threads > 0:
+        img = readSlicesThreaded(dcm_files, threads, entry.get('geometry'))
+    else:
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(dcm_files)
+        img = reader.Execute()
+
+    # Remember the geometry of the series for the threaded reader
+    if 'geometry' not in entry:
+        entry['geometry'] = {'origin': img.GetOrigin(), 'spacing': img.GetSpacing(), 'direction': img.GetDirection()}
+        if index_folder is not None:
+            saveSeriesIndex(index_folder, os.path.abspath(dcm_folder), entry)
+
+    return img
+
+
+# Function to get image and segmentation data from a specified directory.
+# The DICOM series is read through the series index (see readSeries).
+# Cases without a segmentation (e.g. for inference) get an empty one on the image grid.
+def getData(inputDir, index_folder=None, threads=0):
     sub_folders = os.listdir(inputDir)
+    seg = None
     
     for sub_folder in sub_folders:
 
@@ -137,10 +326,11 @@ def getData(inputDir):
             dcm_folder = os.path.join(inputDir, sub_folder)
             
             # Read DICOM series and return image
-            reader = sitk.ImageSeriesReader()
-            dcm_files = reader.GetGDCMSeriesFileNames(dcm_folder)
-            reader.SetFileNames(dcm_files)
-            img = reader.Execute()
+            img = readSeries(dcm_folder, index_folder, threads)
             continue
+
+    if seg is None:
+        seg = sitk.Image(img.GetSize(), sitk.sitkUInt8)
+        seg.CopyInformation(img)
           
-    return  img, seg
\ No newline at end of file
+    return  img, seg
@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import argparse
+import numpy as np
+import scipy
+import SimpleITK as sitk
+
+# The scripts of the models import each other by module name.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ['nnUNet', '3DUNet', 'Evaluations']:
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from benchmark_postprocess_nnUNet import syntheticLabels, syntheticProbabilities, fillInputs, urethra_reference
+from utils_postprocess_nnUNet import fill_empty_voxels, getLargestCC, reconstruct_urethra, labels_from_probabilities
+from postprocess_nnUNet import postprocess_probabilities
+from probability_source import open_probabilities
+from prepare_for_nnUNet import prepare_case
+import utils
+import preprocessing
+import augmentations
+from evaluate_segmentations import evaluate
+
+'''
+Performance benchmarks of the hot functions and the script stages of both models, on synthetic prostate phantoms.
+
+A phantom is a multi-zone label map (PZ, CZ, TZ, AFS and urethra) with a T2 image, ADC and HBV images on a coarser grid
+and nnU-Net-like probabilities (6 channels), at a realistic size (--shape, default 384x384x24 at 0.5x0.5x3 mm). For the
+script stages, the phantom is also written as a patient folder with DICOM series and Seg.nrrd in a temporary folder.
+Every benchmark reports the fastest and the mean time over --repeats runs and the peak memory of one more run: the
+peak of the Python and NumPy allocations (tracemalloc) and the rise of the peak resident memory (Linux only, includes
+SimpleITK). The results are saved as JSON together with the commit and the library versions, and can be compared
+with an earlier run (--compare). Everything runs offline on the CPU.
+'''
+
+
+# Resident memory of this process in MB: 'VmRSS' (current) or 'VmHWM' (peak). None if /proc is not available.
+def read_memory(field):
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+# Resets the peak resident memory (VmHWM) of this process. Returns False if this is not supported.
+def reset_peak_memory():
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def measure(func, repeats=3):
+    """
+    Times func (without arguments) and measures its peak memory.
+
+    Returns:
+        dict: Fastest and mean time in seconds, peak traced memory and rise of the peak resident memory in MB.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    before = read_memory('VmRSS')
+    reset = reset_peak_memory()
+    tracemalloc.start()
+    func()
+    traced = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    peak = read_memory('VmHWM')
+
+    return {'seconds': min(times), 'mean_seconds': float(np.mean(times)), 'repeats': repeats,
+            'peak_traced_mb': traced / 1024 ** 2,
+            'peak_rss_mb': peak - before if reset and peak is not None and before is not None else None}
+
+
+# Converts an (X, Y, Z) array to a SimpleITK image with the given spacing.
+def to_image(array, spacing, origin=(0, 0, 0)):
+
+    img = sitk.GetImageFromArray(np.ascontiguousarray(array.transpose(2, 1, 0)))
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    return img
+
+
+class Phantom:
+    """
+    Synthetic prostate case.
+
+    Args:
+        shape (tuple): Size of the T2 (X, Y, Z).
+        spacing (tuple): Spacing of the T2 in mm.
+        empty_fraction (float): Fraction of prostate voxels left unlabeled (holes for fill_empty_voxels).
+    """
+
+    def __init__(self, shape=(384, 384, 24), spacing=(0.5, 0.5, 3.0), empty_fraction=0.3, seed=0):
+        rng = np.random.default_rng(seed)
+        self.shape = tuple(shape)
+        self.spacing = tuple(spacing)
+
+        self.labels, self.prostate = syntheticLabels(self.shape, self.spacing, empty_fraction=0, seed=seed)
+        self.holes, _ = syntheticLabels(self.shape, self.spacing, empty_fraction=empty_fraction, seed=seed)
+        self.probabilities = syntheticProbabilities(self.labels, seed=seed)
+
+        # T2 with a different intensity in every zone, a smooth bias field and noise
+        intensities = np.array([300, 700, 450, 500, 250, 600], dtype=np.float32)
+        x = np.linspace(-1, 1, self.shape[0], dtype=np.float32)[:, None, None]
+        t2 = intensities[self.labels] * (1 + 0.2 * x) + rng.normal(0, 40, self.shape).astype(np.float32)
+        self.t2 = to_image(np.clip(t2, 0, None).astype(np.int16), self.spacing)
+        self.seg = to_image(self.labels, self.spacing)
+
+        # ADC and HBV on a coarser grid (2x2 mm in-plane), as in the DICOM files
+        self.adc = sitk.Cast(sitk.Resample(self.t2, [n // 4 for n in self.shape[:2]] + [self.shape[2]], sitk.Transform(), sitk.sitkLinear,
+                                           self.t2.GetOrigin(), (self.spacing[0] * 4, self.spacing[1] * 4, self.spacing[2])) * 2, sitk.sitkInt16)
+        self.hbv = sitk.Cast(sitk.Cast(self.adc, sitk.sitkFloat32) * 0.25, sitk.sitkInt16)
+
+    def write(self, folder):
+        """
+        Writes the phantom as a patient folder (T2, ADC and HBV DICOM series and Seg.nrrd). Returns its path.
+        """
+        patient_dir = os.path.join(folder, 'ProstateX-0001')
+        for name, img in [('t2_tse_tra', self.t2), ('ep2d_diff_adc', self.adc), ('ep2d_diff_hbv', self.hbv)]:
+            write_dicom_series(img, os.path.join(patient_dir, name), series_uid='1.2.826.0.1.3680043.8.498.' + str(len(name)))
+        sitk.WriteImage(self.seg, os.path.join(patient_dir, 'Seg.nrrd'), useCompression=True)
+        return patient_dir
+
+
+# Writes an image as a DICOM series, one file per slice.
+def write_dicom_series(img, folder, series_uid):
+
+    os.makedirs(folder, exist_ok=True)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    direction = img.GetDirection()
+
+    for z in range(img.GetDepth()):
+        dcm_slice = img[:, :, z]
+        tags = {'0008|0060': 'MR', '0020|000e': series_uid, '0020|0013': str(z + 1),
+                '0020|0032': '\\'.join(map(str, img.TransformIndexToPhysicalPoint((0, 0, z)))),
+                '0020|0037': '\\'.join(map(str, (direction[0], direction[3], direction[6], direction[1], direction[4], direction[7]))),
+                '0028|0030': '\\'.join(map(str, img.GetSpacing()[:2])), '0018|0050': str(img.GetSpacing()[2])}
+        for tag, value in tags.items():
+            dcm_slice.SetMetaData(tag, value)
+        writer.SetFileName(os.path.join(folder, str(z).zfill(3) + '.dcm'))
+        writer.Execute(dcm_slice)
+
+
+# Benchmarks of single functions: name -> function of the phantom that returns the call to time.
+def hot_functions(p, tmp):
+
+    background, zones, urethra = fillInputs(p.holes, p.prostate)
+    zone_masks = [p.labels == k for k in range(1, 5)]
+    u = np.ascontiguousarray(p.probabilities[..., 5])
+    t2 = sitk.Cast(p.t2, sitk.sitkFloat32)
+    resampled = utils.resampleImage(t2, preprocessing.RESOLUTION, sitk.sitkLinear)
+    resampled_seg = utils.resampleImage(p.seg, preprocessing.RESOLUTION, sitk.sitkNearestNeighbor)
+    center = preprocessing.getCentroid(resampled)
+
+    return {
+        'nnUNet.fill_empty_voxels': lambda: fill_empty_voxels(background, *zones, urethra, p.spacing),
+        'nnUNet.getLargestCC (4 zones)': lambda: [getLargestCC(mask) for mask in zone_masks],
+        'nnUNet.drawUrethra (all slices)': lambda: urethra_reference(u, 3, p.spacing[0]),
+        'nnUNet.reconstruct_urethra': lambda: reconstruct_urethra(u, 3, p.spacing[0]),
+        'nnUNet.labels_from_probabilities': lambda: labels_from_probabilities(p.probabilities),
+        '3DUNet.normalize': lambda: utils.normalize(t2, 99, 1),
+        '3DUNet.resampleImage': lambda: utils.resampleImage(t2, preprocessing.RESOLUTION, sitk.sitkLinear),
+        '3DUNet.augmentCase (Train)': lambda: preprocessing.augmentCase(resampled, resampled_seg, center, event='Train'),
+        '3DUNet.augmentDataFused (Train)': lambda: augmentations.augmentDataFused({'AxT2': t2}, p.seg, 'Train'),
+        '3DUNet.augmentDataNumpy (Train)': lambda: augmentations.augmentDataNumpy({'AxT2': t2}, p.seg, 'Train'),
+        'Evaluations.evaluate': lambda: evaluate(p.labels.transpose(2, 1, 0), p.holes.transpose(2, 1, 0), p.spacing),
+    }
+
+
+# Benchmarks of the script stages on the phantom written as DICOM.
+def script_stages(p, tmp):
+
+    patient_dir = p.write(os.path.join(tmp, 'input'))
+    output_folder = os.path.join(tmp, 'nnUNet_raw')
+    for folder in ['imagesTs', 'labelsTs']:
+        os.makedirs(os.path.join(output_folder, folder), exist_ok=True)
+
+    npz_file = os.path.join(tmp, 'PROSTATEx_001.npz')
+    np.savez_compressed(npz_file, probabilities=np.ascontiguousarray(p.probabilities.transpose(3, 2, 1, 0)))
+
+    def load_case():
+        preprocessing._case_cache.clear()
+        utils._series_index.clear()
+        return preprocessing.loadCase(patient_dir)
+
+    # The cached case is the typical state during the 3D U-Net preprocessing
+    preprocessing.loadCase(patient_dir)
+    preprocessing.loadCase(patient_dir, resample=False)
+
+    return {
+        'nnUNet.prepare_case (read, resample, write)': lambda: prepare_case(patient_dir, output_folder, 'imagesTs', 'labelsTs', ['ADC', 'HBV']),
+        'nnUNet.open_probabilities (npz)': lambda: open_probabilities(npz_file),
+        'nnUNet.postprocess_probabilities': lambda: postprocess_probabilities(p.probabilities, p.spacing),
+        'nnUNet.postprocess_probabilities (crop)': lambda: postprocess_probabilities(p.probabilities, p.spacing, crop=True),
+        '3DUNet.loadCase (read, resample)': load_case,
+        '3DUNet.startPreprocess (Train)': lambda: preprocessing.startPreprocess(patient_dir, event='Train'),
+        '3DUNet.startPreprocess (Train, fused)': lambda: preprocessing.startPreprocess(patient_dir, event='Train', fused=True),
+        '3DUNet.startPreprocess (Train, numpy)': lambda: preprocessing.startPreprocess(patient_dir, event='Train', backend='numpy'),
+    }
+
+
+# Commit, date and versions of the run, to compare results across commits.
+def get_metadata(args):
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'SimpleITK': sitk.Version.VersionString(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'shape': list(args.shape), 'spacing': list(args.spacing),
+            'repeats': args.repeats}
+
+
+# Prints the ratio of every time to the same benchmark in an earlier result file.
+def compare(results, baseline_file):
+
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    previous = {result['name']: result for result in baseline['results']}
+
+    print('\nCompared with ' + str(baseline['metadata'].get('commit')) + ':')
+    for result in results:
+        if result['name'] in previous:
+            ratio = result['seconds'] / previous[result['name']]['seconds']
+            print('{:48} {:8.3f} s -> {:8.3f} s ({:.2f}x)'.format(result['name'], previous[result['name']]['seconds'], result['seconds'], ratio))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', type=int, default=[384, 384, 24], nargs=3, help='Size of the synthetic volume (X, Y, Z).')
+    parser.add_argument('--spacing', type=float, default=[0.5, 0.5, 3.0], nargs=3, help='Spacing of the synthetic volume in mm.')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of timed repeats, the fastest and the mean are reported.')
+    parser.add_argument('--filter', type=str, default=None, help='Only run the benchmarks whose name contains this text (e.g. nnUNet or normalize).')
+    parser.add_argument('--threads', type=int, default=0, help='Number of threads used by the SimpleITK filters. 0 keeps the SimpleITK default.')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='Path to the JSON-file with the results.')
+    parser.add_argument('--compare', type=str, default=None, help='JSON-file of an earlier run to compare with.')
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(args.threads)
+
+    np.random.seed(0)
+    phantom = Phantom(tuple(args.shape), tuple(args.spacing))
+    tmp = tempfile.mkdtemp(prefix='benchmark_')
+
+    results = []
+    try:
+        for group, builder in [('function', hot_functions), ('stage', script_stages)]:
+            for name, func in builder(phantom, tmp).items():
+                if args.filter is not None and args.filter not in name:
+                    continue
+                result = dict(name=name, group=group, **measure(func, args.repeats))
+                results.append(result)
+                print('{:48} {:8.3f} s (mean {:8.3f} s), peak {:8.1f} MB traced, {} MB resident'.format(
+                    name, result['seconds'], result['mean_seconds'], result['peak_traced_mb'],
+                    '{:.1f}'.format(result['peak_rss_mb']) if result['peak_rss_mb'] is not None else '-'))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': get_metadata(args), 'results': results}, f, indent=4)
+    print('Saved the results in ' + args.output)
+
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -0,0 +1,266 @@
+import os
+import csv
+import time
+import argparse
+import warnings
+import traceback
+import numpy as np
+import SimpleITK as sitk
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from scipy.ndimage import binary_erosion, distance_transform_edt, generate_binary_structure
+
+'''
+Evaluation of predicted segmentations against reference segmentations, in Python instead of the Hero workflow.
+
+The segmentations use the 6-label scheme of the models: 0 background, 1 PZ, 2 CZ, 3 TZ, 4 AFS and 5 urethra. For every
+zone and the whole prostate (labels 1-5), the Dice, the volume difference and the surface distances (HD95 and ASSD, in
+mm) are computed. The overlaps and volumes of all labels come from a single confusion matrix. The surface distances
+use the Euclidean distance transform (with the voxel spacing) of the surface of one segmentation, evaluated on the
+surface of the other, within the bounding box of the two masks. The cases are evaluated in a pool of processes and
+every metric is saved in its own csv-file (one row per case, one column per zone) in the output folder.
+'''
+
+LABELS = {'PZ': 1, 'CZ': 2, 'TZ': 3, 'AFS': 4, 'Urethra': 5}
+ZONES = list(LABELS) + ['Prostate']
+EXTENSIONS = ('.nii.gz', '.nrrd', '.nii', '.mha', '.npy')
+METRICS = ['dice', 'volume_reference', 'volume_prediction', 'volume_difference', 'relative_volume_difference', 'hd95', 'assd']
+
+
+# Label map (Z, Y, X) and spacing (X, Y, Z) of a segmentation. Image files are read with SimpleITK; npy-files are
+# the (X, Y, Z) output of postprocess_nnUNet.py and take the spacing of the reference.
+def read_segmentation(path, spacing=None):
+
+    if path.lower().endswith('.npy'):
+        return np.ascontiguousarray(np.load(path).transpose(2, 1, 0)).astype(np.uint8, copy=False), spacing
+
+    img = sitk.ReadImage(path)
+    return sitk.GetArrayFromImage(img).astype(np.uint8, copy=False), img.GetSpacing()
+
+
+# Bounding box (slices) of the non-zero voxels of any of the masks, extended by margin voxels. None if all are empty.
+def bounding_box(masks, margin=1):
+
+    union = np.logical_or.reduce(masks)
+    box = []
+    for axis in range(union.ndim):
+        indices = np.flatnonzero(np.any(union, axis=tuple(a for a in range(union.ndim) if a != axis)))
+        if len(indices) == 0:
+            return None
+        box.append(slice(max(indices[0] - margin, 0), min(indices[-1] + 1 + margin, union.shape[axis])))
+    return tuple(box)
+
+
+# Surface voxels of a mask: voxels with at least one face neighbour outside the mask.
+def surface(mask):
+
+    return mask & ~binary_erosion(mask, structure=generate_binary_structure(mask.ndim, 1), border_value=0)
+
+
+def surface_distances(reference, prediction, spacing):
+    """
+    HD95 and ASSD between two masks (as in MedPy: the 95th percentile of the distances in both directions and the
+    mean of the two average surface distances). NaN if either mask is empty.
+
+    Args:
+        reference, prediction (np.ndarray): Boolean masks (Z, Y, X).
+        spacing (tuple): Voxel spacing (Z, Y, X) in mm.
+
+    Returns:
+        tuple: HD95 and ASSD in mm.
+    """
+    if not reference.any() or not prediction.any():
+        return np.nan, np.nan
+
+    # The nearest surface voxels always lie within the bounding box of the two masks
+    box = bounding_box([reference, prediction])
+    reference_surface = surface(np.pad(reference[box], 1))
+    prediction_surface = surface(np.pad(prediction[box], 1))
+
+    to_reference = distance_transform_edt(~reference_surface, sampling=spacing)[prediction_surface]
+    to_prediction = distance_transform_edt(~prediction_surface, sampling=spacing)[reference_surface]
+
+    hd95 = np.percentile(np.hstack((to_reference, to_prediction)), 95)
+    assd = (to_reference.mean() + to_prediction.mean()) / 2
+
+    return float(hd95), float(assd)
+
+
+def evaluate(reference, prediction, spacing):
+    """
+    All metrics of a case.
+
+    Args:
+        reference, prediction (np.ndarray): Label maps (Z, Y, X) with the labels 0-5.
+        spacing (tuple): Voxel spacing (X, Y, Z) in mm.
+
+    Returns:
+        dict: For every metric, a dict with the value of every zone. Volumes are in ml, the relative volume
+            difference in percent of the reference volume.
+    """
+    if reference.shape != prediction.shape:
+        raise ValueError('The segmentations have different shapes: ' + str(reference.shape) + ' and ' + str(prediction.shape))
+
+    n = len(LABELS) + 1
+    if max(reference.max(initial=0), prediction.max(initial=0)) >= n:
+        raise ValueError('Unknown label in the segmentations, the labels must be 0-' + str(n - 1) + '.')
+    spacing_zyx = tuple(reversed(spacing))
+    voxel_volume = float(np.prod(spacing)) / 1000
+
+    # Everything outside the bounding box of the two prostates is background in both
+    box = bounding_box([reference > 0, prediction > 0], margin=0)
+    if box is not None:
+        reference = reference[box]
+        prediction = prediction[box]
+
+    # Confusion matrix of all labels in one pass (the background count only covers the bounding box)
+    confusion = np.bincount(reference.ravel().astype(np.intp) * n + prediction.ravel(), minlength=n * n)[:n * n].reshape(n, n)
+
+    overlap = {zone: confusion[value, value] for zone, value in LABELS.items()}
+    reference_volume = {zone: confusion[value].sum() for zone, value in LABELS.items()}
+    prediction_volume = {zone: confusion[:, value].sum() for zone, value in LABELS.items()}
+
+    overlap['Prostate'] = confusion[1:, 1:].sum()
+    reference_volume['Prostate'] = confusion[1:].sum()
+    prediction_volume['Prostate'] = confusion[:, 1:].sum()
+
+    metrics = {metric: dict() for metric in METRICS}
+    for zone in ZONES:
+        total = reference_volume[zone] + prediction_volume[zone]
+        metrics['dice'][zone] = 2 * overlap[zone] / total if total > 0 else np.nan
+        metrics['volume_reference'][zone] = reference_volume[zone] * voxel_volume
+        metrics['volume_prediction'][zone] = prediction_volume[zone] * voxel_volume
+        metrics['volume_difference'][zone] = (prediction_volume[zone] - reference_volume[zone]) * voxel_volume
+        metrics['relative_volume_difference'][zone] = 100 * (prediction_volume[zone] - reference_volume[zone]) / reference_volume[zone] if reference_volume[zone] > 0 else np.nan
+
+        reference_mask = reference > 0 if zone == 'Prostate' else reference == LABELS[zone]
+        prediction_mask = prediction > 0 if zone == 'Prostate' else prediction == LABELS[zone]
+        metrics['hd95'][zone], metrics['assd'][zone] = surface_distances(reference_mask, prediction_mask, spacing_zyx)
+
+    return metrics
+
+
+# Case name of a file or folder: without the extension(s). With key='digits', the last three digits of the name, as in
+# the nnU-Net case names of prepare_for_nnUNet.py (e.g. ProstateX-0300 and PROSTATEx_300 are both 300).
+def case_key(name, key='name'):
+
+    for extension in EXTENSIONS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    if key == 'digits':
+        return ''.join([n for n in name if n.isdigit()])[-3:]
+    return name
+
+
+# Reference segmentation files by case: segmentation files in the folder, or Seg*.nrrd in the case folders.
+def find_references(reference_folder, key='name'):
+
+    references = dict()
+    for name in sorted(os.listdir(reference_folder)):
+        path = os.path.join(reference_folder, name)
+        if os.path.isdir(path):
+            segmentations = [file for file in sorted(os.listdir(path)) if 'Seg' in file and file.endswith('.nrrd')]
+            if len(segmentations) > 0:
+                references[case_key(name, key)] = os.path.join(path, segmentations[0])
+        elif name.endswith(EXTENSIONS):
+            references[case_key(name, key)] = path
+    return references
+
+
+# Predicted segmentations (nrrd, nii, mha or npy) by case. Probability files are skipped.
+def find_predictions(prediction_folder, key='name'):
+
+    return {case_key(name, key): os.path.join(prediction_folder, name) for name in sorted(os.listdir(prediction_folder))
+            if name.endswith(EXTENSIONS) and not name.endswith('.probabilities.npy')}
+
+
+# Evaluates one case and catches any error, so that one failing case does not stop the rest.
+def evaluate_case(pair, spacing=None):
+
+    case, reference_file, prediction_file = pair
+    try:
+        reference, reference_spacing = read_segmentation(reference_file, spacing)
+        prediction, _ = read_segmentation(prediction_file, reference_spacing)
+        if reference_spacing is None:
+            raise ValueError('No spacing for ' + case + ', give it with --spacing.')
+        return case, evaluate(reference, prediction, reference_spacing), None
+    except Exception:
+        return case, None, traceback.format_exc()
+
+
+# Saves every metric in its own csv-file: one row per case and one column per zone, followed by the mean and standard
+# deviation over the cases.
+def write_csv(results, output_folder):
+
+    os.makedirs(output_folder, exist_ok=True)
+    for metric in METRICS:
+        rows = [[case] + [metrics[metric][zone] for zone in ZONES] for case, metrics in results]
+        values = np.array([row[1:] for row in rows], dtype=np.float64).reshape(len(rows), len(ZONES))
+
+        with open(os.path.join(output_folder, metric + '.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Case'] + ZONES)
+            writer.writerows(rows)
+            if len(rows) > 0:
+                # Zones that are missing in every case (e.g. the HD95 of an absent zone) have a NaN mean and std
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    writer.writerow(['Mean'] + list(np.nanmean(values, axis=0)))
+                    writer.writerow(['Std'] + list(np.nanstd(values, axis=0)))
+
+
+def evaluate_folder(reference_folder, prediction_folder, output_folder, key='name', spacing=None, workers=1, chunksize=1):
+    """
+    Evaluates every predicted segmentation that has a reference and saves the metrics as csv-files.
+
+    Returns:
+        list: (case, metrics) of the evaluated cases.
+    """
+    references = find_references(reference_folder, key)
+    predictions = find_predictions(prediction_folder, key)
+    pairs = [(case, references[case], predictions[case]) for case in sorted(predictions) if case in references]
+
+    job = partial(evaluate_case, spacing=spacing)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            evaluated = list(executor.map(job, pairs, chunksize=chunksize))
+    else:
+        evaluated = [job(pair) for pair in pairs]
+
+    results = []
+    for case, metrics, error in evaluated:
+        if error is not None:
+            print('Failed: ' + case + '\n' + error)
+            continue
+        results.append((case, metrics))
+
+    write_csv(results, output_folder)
+
+    missing = sorted(set(predictions) - set(references))
+    if len(missing) > 0:
+        print('No reference for: ' + ', '.join(missing))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reference_folder', type=str, default="C:\\William\\Doktorand\\Data\\test_output\\Test", help='Path to the reference segmentations, or to the case folders containing Seg.nrrd.')
+    parser.add_argument('--prediction_folder', type=str, default="C:\\William\\TEST\\nnUNet\\nnUNet_output\\Postprocessed", help='Path to the predicted segmentations (nrrd or the npy-files from postprocess_nnUNet.py).')
+    parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\Evaluation", help='Path to the folder for the csv-files.')
+    parser.add_argument('--key', type=str, default='name', choices=['name', 'digits'], help='Match the cases on the file name, or on the last three digits of the name (nnU-Net case names).')
+    parser.add_argument('--spacing', type=float, default=None, nargs=3, help='Spacing (X Y Z) in mm when the reference is a npy-file.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes. Each case is evaluated by one worker.')
+    parser.add_argument('--chunksize', type=int, default=1, help='Number of cases sent to a worker at a time.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = evaluate_folder(args.reference_folder, args.prediction_folder, args.output_folder, key=args.key,
+                              spacing=tuple(args.spacing) if args.spacing is not None else None, workers=args.workers, chunksize=args.chunksize)
+
+    print('Evaluated {} cases in {:.1f} s ({} workers).'.format(len(results), time.perf_counter() - start, args.workers))
+    for zone in ZONES:
+        dice = [metrics['dice'][zone] for _, metrics in results]
+        print('{:>8}: Dice {:.3f}'.format(zone, np.nanmean(dice) if len(dice) > 0 and not np.all(np.isnan(dice)) else np.nan))
@@ -0,0 +1,301 @@
+import time
+import tracemalloc
+import argparse
+import numpy as np
+import skimage
+from scipy.ndimage import distance_transform_edt
+
+from utils_postprocess_nnUNet import getLargestCC, fill_empty_voxels, labels_from_probabilities, get_prostate, fill_empty_labels, \
+    drawUrethra, findIndices_allSlices, column, reconstruct_urethra
+import connected_components
+from postprocess_nnUNet import postprocess_probabilities
+
+'''
+This file will benchmark the postprocessing for the nnU-Net model on synthetic prostate volumes.
+The previous (reference) implementations are kept here to check that the results are identical.
+'''
+
+
+# Reference implementation of getLargestCC with skimage.
+def getLargestCC_skimage(segmentation):
+    labels = skimage.measure.label(segmentation, connectivity=2)
+    if labels.max() != 0: # Assuming at least one CC
+        largestCC = labels == np.argmax(np.bincount(labels.flat)[1:])+1
+    else:
+        largestCC = labels == 100
+    return largestCC
+
+
+# Reference implementation of fill_empty_voxels, assigning one voxel at a time.
+def fill_empty_voxels_loop(background, pz, cz, tz, afs, urethra, spacing):
+
+    pz_within_prostate = getLargestCC(pz) & (~urethra.astype(bool))
+    cz_within_prostate = getLargestCC(cz) & (~urethra.astype(bool))
+    tz_within_prostate = getLargestCC(tz) & (~urethra.astype(bool))
+    afs_within_prostate = getLargestCC(afs) & (~urethra.astype(bool))
+
+    empty_voxel_indices = np.argwhere((background == False) & (urethra == False) & (pz_within_prostate == False) &
+                                      (cz_within_prostate == False) & (tz_within_prostate == False) &
+                                      (afs_within_prostate == False))
+
+    pz_dist = distance_transform_edt(~pz_within_prostate, sampling=spacing)
+    cz_dist = distance_transform_edt(~cz_within_prostate, sampling=spacing)
+    tz_dist = distance_transform_edt(~tz_within_prostate, sampling=spacing)
+    afs_dist = distance_transform_edt(~afs_within_prostate, sampling=spacing)
+
+    for voxel_index in empty_voxel_indices:
+        distances = [pz_dist[tuple(voxel_index)], cz_dist[tuple(voxel_index)], tz_dist[tuple(voxel_index)], afs_dist[tuple(voxel_index)]]
+        closest_zone_index = np.argmin(distances)
+        if closest_zone_index == 0:
+            pz_within_prostate[tuple(voxel_index)] = True
+        elif closest_zone_index == 1:
+            cz_within_prostate[tuple(voxel_index)] = True
+        elif closest_zone_index == 2:
+            tz_within_prostate[tuple(voxel_index)] = True
+        else:
+            afs_within_prostate[tuple(voxel_index)] = True
+
+    return np.stack([background, pz_within_prostate.astype(int), cz_within_prostate.astype(int), tz_within_prostate.astype(int), afs_within_prostate.astype(int),
+                     urethra], axis=-1)
+
+
+# Reference implementation of the zone labelling, with one argmax per label and int64 one-hot channels.
+def zone_labels_reference(probabilities, urethra, spacing):
+
+    pred_background = np.argmax(probabilities, axis=3) == 0
+    lcc_background = getLargestCC(pred_background)
+    prostate = getLargestCC((~lcc_background).astype(int))
+    background = ~prostate
+
+    urethra = urethra * prostate.astype(int)
+
+    pred_pz = np.argmax(probabilities, axis=3) == 1
+    pred_cz = np.argmax(probabilities, axis=3) == 2
+    pred_tz = np.argmax(probabilities, axis=3) == 3
+    pred_afs = np.argmax(probabilities, axis=3) == 4
+
+    pz_pred_within_prostate = pred_pz * prostate.astype(int)
+    cz_pred_within_prostate = pred_cz * prostate.astype(int)
+    tz_pred_within_prostate = pred_tz * prostate.astype(int)
+    afs_pred_within_prostate = pred_afs * prostate.astype(int)
+
+    prel_segmentation = fill_empty_voxels(background.astype(int), pz_pred_within_prostate, cz_pred_within_prostate, tz_pred_within_prostate, afs_pred_within_prostate, urethra.astype(int), spacing)
+    return prel_segmentation.argmax(axis=3)
+
+
+# Zone labelling as done in postprocess_nnUNet.py.
+def zone_labels(probabilities, urethra, spacing):
+
+    prediction = labels_from_probabilities(probabilities)
+    prostate = get_prostate(prediction)
+
+    return fill_empty_labels(~prostate, prediction, prostate, urethra.astype(bool) & prostate, spacing)
+
+
+# Reference implementation of the urethra reconstruction, one z-slice and one pixel at a time.
+def urethra_reference(u, radius, inplane_image_spacing):
+
+    urethra_zSlices = np.split(u, u.shape[2], axis=2)
+
+    indices_list = []
+    placeholder = [indices_list.append(np.insert(findIndices_allSlices(zSlice), 2, z)) for zSlice, z in zip(urethra_zSlices, range(len(urethra_zSlices)))]
+
+    x = column(np.array(indices_list), 0)
+    y = column(np.array(indices_list), 1)
+    z = column(np.array(indices_list), 2)
+    w = column(np.array(indices_list), 3)
+
+    x_p = np.round(np.polyval(np.polyfit(z, x, deg=2, w=w), z))
+    y_p = np.round(np.polyval(np.polyfit(z, y, deg=2, w=w), z))
+
+    urethra_list = []
+    for zSlice, ii in zip(urethra_zSlices, range(len(indices_list))):
+        indices = np.array([x_p[ii], y_p[ii], z[ii]])
+        urethra_list.append(drawUrethra(array_shape=zSlice.shape, indicies=indices, radius_mm=radius, inplane_image_spacing=inplane_image_spacing))
+
+    return np.stack(urethra_list, axis=2).squeeze()
+
+
+# Creates a synthetic label map (X, Y, Z) with an ellipsoidal prostate split into PZ, CZ, TZ, AFS and a urethra.
+# A fraction of the prostate voxels is left unlabeled to mimic the holes left after taking the largest components.
+def syntheticLabels(shape, spacing, empty_fraction=0.1, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    x, y, z = np.meshgrid(*[(np.arange(n) - n / 2) * s for n, s in zip(shape, spacing)], indexing='ij')
+    # Semi-axes in mm
+    prostate = (x / 25) ** 2 + (y / 20) ** 2 + (z / 20) ** 2 <= 1
+
+    labels = np.zeros(shape, dtype=np.uint8)
+    labels[prostate & (y > 5)] = 1                               # PZ, posterior
+    labels[prostate & (y <= 5) & (z > 8)] = 2                    # CZ, base
+    labels[prostate & (y <= 5) & (z <= 8) & (y > -12)] = 3       # TZ
+    labels[prostate & (y <= -12) & (z <= 8)] = 4                 # AFS, anterior
+    labels[prostate & (x ** 2 + (y + 2) ** 2 <= 9)] = 5          # Urethra
+
+    holes = prostate & (labels != 5) & (rng.random(shape) < empty_fraction)
+    labels[holes] = 0
+
+    return labels, prostate
+
+
+def fillInputs(labels, prostate):
+
+    background = (~prostate).astype(int)
+    zones = [(labels == k).astype(int) for k in range(1, 5)]
+    urethra = (labels == 5).astype(int)
+
+    return background, zones, urethra
+
+
+# Synthetic probabilities (X, Y, Z, C) from a label map, as a transposed view like the loaded nnU-Net output.
+def syntheticProbabilities(labels, n_channels=6, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    logits = rng.normal(0, 1, (n_channels,) + labels.shape[::-1]).astype(np.float32)
+    for k in range(n_channels):
+        logits[k][labels.T == k] += 2.5
+    probabilities = np.exp(logits)
+    probabilities /= probabilities.sum(axis=0)
+
+    return probabilities.transpose(3, 2, 1, 0)
+
+
+def timeit(func, *arguments, repeats=1):
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*arguments)
+        times.append(time.perf_counter() - start)
+
+    return result, min(times)
+
+
+# Peak memory (MB) allocated by func, as traced by tracemalloc (includes NumPy arrays).
+def peak_memory(func, *arguments):
+
+    tracemalloc.start()
+    func(*arguments)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak / 1024 ** 2
+
+
+def benchmark_fill(args):
+
+    labels, prostate = syntheticLabels(tuple(args.shape), tuple(args.spacing), args.empty_fraction)
+    background, zones, urethra = fillInputs(labels, prostate)
+    spacing = tuple(args.spacing)
+
+    print('Volume: ' + str(tuple(args.shape)) + ', empty voxels: ' + str(int(((labels == 0) & prostate).sum())))
+
+    reference, t_loop = timeit(fill_empty_voxels_loop, background, *zones, urethra, spacing)
+    result, t_vectorized = timeit(fill_empty_voxels, background, *zones, urethra, spacing, repeats=args.repeats)
+
+    print('fill_empty_voxels (loop):       {:8.3f} s'.format(t_loop))
+    print('fill_empty_voxels (vectorized): {:8.3f} s'.format(t_vectorized))
+    print('Speed-up: {:.1f}x'.format(t_loop / t_vectorized))
+    print('Identical labels: ' + str(np.array_equal(reference, result)))
+
+
+def benchmark_labels(args):
+
+    labels, prostate = syntheticLabels(tuple(args.shape), tuple(args.spacing), empty_fraction=0)
+    probabilities = syntheticProbabilities(labels)
+    urethra = (labels == 5).astype(float)
+    spacing = tuple(args.spacing)
+
+    print('Probabilities: ' + str(probabilities.shape) + ', ' + str(probabilities.nbytes // 1024 ** 2) + ' MB')
+
+    reference, t_reference = timeit(zone_labels_reference, probabilities, urethra, spacing, repeats=args.repeats)
+    result, t_labels = timeit(zone_labels, probabilities, urethra, spacing, repeats=args.repeats)
+    m_reference = peak_memory(zone_labels_reference, probabilities, urethra, spacing)
+    m_labels = peak_memory(zone_labels, probabilities, urethra, spacing)
+
+    print('Zone labels (argmax per label, int64): {:8.3f} s, peak {:8.1f} MB'.format(t_reference, m_reference))
+    print('Zone labels (single argmax, uint8):    {:8.3f} s, peak {:8.1f} MB'.format(t_labels, m_labels))
+    print('Speed-up: {:.1f}x, memory reduction: {:.1f}x'.format(t_reference / t_labels, m_reference / m_labels))
+    print('Identical labels: ' + str(np.array_equal(reference, result)))
+
+
+def benchmark_urethra(args):
+
+    labels, prostate = syntheticLabels(tuple(args.shape), tuple(args.spacing), empty_fraction=0)
+    u = np.ascontiguousarray(syntheticProbabilities(labels)[..., 5])
+
+    reference, t_reference = timeit(urethra_reference, u, 3, args.spacing[0])
+    result, t_vectorized = timeit(reconstruct_urethra, u, 3, args.spacing[0], repeats=args.repeats)
+
+    print('Urethra (per slice and pixel): {:8.3f} s'.format(t_reference))
+    print('Urethra (vectorized):          {:8.3f} s'.format(t_vectorized))
+    print('Speed-up: {:.1f}x'.format(t_reference / t_vectorized))
+    print('Identical urethra: ' + str(np.array_equal(reference.astype(bool), result)))
+
+
+def benchmark_cc(args):
+
+    labels, prostate = syntheticLabels(tuple(args.shape), tuple(args.spacing), args.empty_fraction)
+    zones = [labels == k for k in range(1, 5)]
+
+    references, t_reference = timeit(lambda: [getLargestCC_skimage(zone) for zone in zones], repeats=args.repeats)
+    print('Largest CC of 4 zones (skimage):            {:8.3f} s'.format(t_reference))
+
+    for backend in connected_components.BACKENDS:
+        try:
+            connected_components.set_backend(backend)
+        except ImportError:
+            print('Backend ' + backend + ' is not installed.')
+            continue
+        single, t_single = timeit(lambda: [connected_components.largest_component(zone) for zone in zones], repeats=args.repeats)
+        batched, t_batched = timeit(connected_components.largest_components, labels, [1, 2, 3, 4], repeats=args.repeats)
+        identical = all(np.array_equal(a, b) and np.array_equal(a, c) for a, b, c in zip(references, single, batched))
+        print('Largest CC of 4 zones ({}, one by one): {:8.3f} s ({:.1f}x)'.format(backend.ljust(5), t_single, t_reference / t_single))
+        print('Largest CC of 4 zones ({}, batched):    {:8.3f} s ({:.1f}x)'.format(backend.ljust(5), t_batched, t_reference / t_batched))
+        print('Identical components: ' + str(identical))
+
+
+def benchmark_crop(args):
+
+    labels, prostate = syntheticLabels(tuple(args.shape), tuple(args.spacing), empty_fraction=0)
+    spacing = tuple(args.spacing)
+
+    # Second case without AFS, where the distances to the empty zone depend on the full volume.
+    labels_no_afs = np.where(labels == 4, 3, labels)
+
+    for name, case in [('all zones', labels), ('no AFS', labels_no_afs)]:
+        probabilities = syntheticProbabilities(case)
+        for simple in [False, True]:
+            full, t_full = timeit(postprocess_probabilities, probabilities, spacing, simple, 3, False, repeats=args.repeats)
+            cropped, t_crop = timeit(postprocess_probabilities, probabilities, spacing, simple, 3, True, repeats=args.repeats)
+            m_full = peak_memory(postprocess_probabilities, probabilities, spacing, simple, 3, False)
+            m_crop = peak_memory(postprocess_probabilities, probabilities, spacing, simple, 3, True)
+            print('Postprocess ({}, {}):'.format(name, 'simple' if simple else 'default'))
+            print('  full volume: {:8.3f} s, peak {:8.1f} MB'.format(t_full, m_full))
+            print('  cropped:     {:8.3f} s, peak {:8.1f} MB'.format(t_crop, m_crop))
+            print('  Speed-up: {:.1f}x, memory reduction: {:.1f}x, bit-for-bit identical: {}'.format(
+                t_full / t_crop, m_full / m_crop, np.array_equal(full, cropped) and full.dtype == cropped.dtype))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', type=str, default='all', help='Which benchmark to run. Options are: fill, labels, urethra, cc, crop or all.')
+    parser.add_argument('--shape', type=int, default=[384, 384, 24], nargs=3, help='Size of the synthetic volume (X, Y, Z).')
+    parser.add_argument('--spacing', type=float, default=[0.5, 0.5, 3.0], nargs=3, help='Spacing of the synthetic volume in mm.')
+    parser.add_argument('--empty_fraction', type=float, default=0.3, help='Fraction of prostate voxels left unlabeled.')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of timed repeats, the fastest is reported.')
+    args = parser.parse_args()
+
+    if args.benchmark in ['fill', 'all']:
+        benchmark_fill(args)
+    if args.benchmark in ['labels', 'all']:
+        benchmark_labels(args)
+    if args.benchmark in ['urethra', 'all']:
+        benchmark_urethra(args)
+    if args.benchmark in ['cc', 'all']:
+        benchmark_cc(args)
+    if args.benchmark in ['crop', 'all']:
+        benchmark_crop(args)
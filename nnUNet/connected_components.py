@@ -0,0 +1,139 @@
+import numpy as np
+from scipy import ndimage
+
+try:
+    import cc3d
+except ImportError:
+    cc3d = None
+
+'''
+Connected-component labelling for the postprocessing of the nnU-Net model.
+
+Components are labelled with connectivity=2 as in skimage.measure.label (18-connectivity in 3D), either with cc3d
+(if installed) or scipy.ndimage.label. The masks are cropped to their bounding box before labelling and the label
+buffer is reused between calls. The result is the same as getLargestCC with skimage: on equal sizes the component
+found first in raster order is kept.
+'''
+
+BACKENDS = ['cc3d', 'scipy']
+_backend = 'cc3d' if cc3d is not None else 'scipy'
+_buffer = np.empty(0, dtype=np.uint32)
+
+
+def set_backend(name):
+    """
+    Selects the labelling backend. Options are: cc3d or scipy.
+    """
+    global _backend
+
+    if name not in BACKENDS:
+        raise ValueError('Unknown connected-component backend: ' + str(name) + '. Options are: ' + ', '.join(BACKENDS))
+    if name == 'cc3d' and cc3d is None:
+        raise ImportError('The cc3d backend requires the connected-components-3d package.')
+    _backend = name
+
+
+def get_backend():
+    return _backend
+
+
+def bounding_box(mask):
+    """
+    Bounding box of the non-zero voxels as a tuple of slices, or None if the mask is empty.
+    """
+    box = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        indices = np.flatnonzero(np.any(mask, axis=other_axes))
+        if len(indices) == 0:
+            return None
+        box.append(slice(indices[0], indices[-1] + 1))
+    return tuple(box)
+
+
+def _label_buffer(shape):
+
+    global _buffer
+
+    size = int(np.prod(shape))
+    if _buffer.size < size:
+        _buffer = np.empty(size, dtype=np.uint32)
+    return _buffer[:size].reshape(shape)
+
+
+def label(mask):
+    """
+    Labels the connected components of a binary or multi-label array with connectivity=2.
+    With the scipy backend, only binary masks are supported.
+
+    Returns:
+        tuple: uint32 label array and the number of components. The array may share memory with the next call.
+    """
+    if _backend == 'cc3d' and mask.ndim == 3:
+        labels, n = cc3d.connected_components(mask, connectivity=18, return_N=True, out_dtype=np.uint32)
+        return labels, n
+
+    structure = ndimage.generate_binary_structure(mask.ndim, min(2, mask.ndim))
+    labels = _label_buffer(mask.shape)
+    n = ndimage.label(mask, structure=structure, output=labels)
+    return labels, n
+
+
+def largest_component(mask):
+    """
+    Largest connected component of the mask (connectivity=2).
+
+    Args:
+        mask (np.ndarray): Binary mask.
+
+    Returns:
+        np.ndarray: Boolean mask of the largest component, all False if the mask is empty.
+    """
+    mask = np.asarray(mask).astype(bool, copy=False)
+    largest = np.zeros(mask.shape, dtype=bool)
+
+    box = bounding_box(mask)
+    if box is None:
+        return largest
+
+    labels, n = label(mask[box])
+    largest[box] = labels == np.argmax(np.bincount(labels.ravel(), minlength=n + 1)[1:]) + 1
+
+    return largest
+
+
+def largest_components(label_map, values):
+    """
+    Largest connected component of each of the given labels in a label map, e.g. all zones in one call.
+    With cc3d all labels are labelled in a single pass over the bounding box of the label map.
+
+    Args:
+        label_map (np.ndarray): Integer label map (e.g. uint8) where 0 is ignored.
+        values (list): The labels to return the largest component for.
+
+    Returns:
+        list: Boolean masks, one for each value.
+    """
+    if _backend != 'cc3d' or label_map.ndim != 3:
+        return [largest_component(label_map == value) for value in values]
+
+    masks = [np.zeros(label_map.shape, dtype=bool) for _ in values]
+
+    box = bounding_box(label_map)
+    if box is None:
+        return masks
+
+    cropped = label_map[box]
+    labels, n = label(cropped)
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)
+
+    # Label value of each component
+    component_value = np.zeros(n + 1, dtype=cropped.dtype)
+    component_value[labels.ravel()] = cropped.ravel()
+
+    for mask, value in zip(masks, values):
+        components = np.flatnonzero(component_value[1:] == value) + 1
+        if len(components) > 0:
+            mask[box] = labels == components[np.argmax(sizes[components])]
+
+    return masks
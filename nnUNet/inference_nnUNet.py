@@ -0,0 +1,534 @@
+import os
+import re
+import glob
+import json
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+from itertools import product
+from scipy.ndimage import gaussian_filter1d, binary_fill_holes, zoom
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+from postprocess_nnUNet import postprocess_probabilities
+from probability_source import ProbabilitySource
+
+'''
+CPU inference with the nnU-Net folds exported as ONNX files, without an nnU-Net installation.
+
+Each case is preprocessed as by nnUNetv2_predict with the plans.json and dataset.json of the model folder: cropped to the
+non-zero region, normalized per channel and resampled to the spacing of the configuration. It is then predicted with
+Gaussian-weighted sliding-window patches, several patches per onnxruntime call. The weighted logits of all folds (and mirrorings) are summed into one
+accumulator of the size of the output, so the memory stays at one probability volume for any number of folds. The
+averaged logits are resampled back to the native spacing, and the softmax, put back into the uncropped image, is saved as CASE.probabilities.npy (C, Z, Y, X) together with CASE.nrrd, the same layout as
+nnUNetv2_predict --save_probabilities, so postprocess_nnUNet.py can read the output folder directly. With
+--postprocess_folder the postprocessing runs in the same process on the probabilities in memory.
+'''
+
+
+# Gaussian importance map of a patch, as in nnU-Net: a Gaussian (sigma = 1/8 of the patch) with a maximum of
+# value_scaling_factor and no zeros. The filter is separable, so it is built from one 1D Gaussian per axis.
+def gaussian_importance_map(patch_size, sigma_scale=1. / 8, value_scaling_factor=10):
+
+    importance = np.ones([1] * len(patch_size), dtype=np.float64)
+    for axis, size in enumerate(patch_size):
+        delta = np.zeros(size)
+        delta[size // 2] = 1
+        profile = gaussian_filter1d(delta, size * sigma_scale, mode='constant', cval=0)
+        importance = importance * profile.reshape([-1 if a == axis else 1 for a in range(len(patch_size))])
+
+    importance = importance / (importance.max() / value_scaling_factor)
+    importance[importance == 0] = importance[importance > 0].min()
+
+    return importance.astype(np.float32)
+
+
+# Start positions of the patches along each axis, as in nnU-Net: evenly spread with an overlap of at least
+# 1 - step_size, the first and last patch aligned with the borders.
+def compute_steps(image_size, patch_size, step_size=0.5):
+
+    steps = []
+    for image, patch in zip(image_size, patch_size):
+        n = int(np.ceil((image - patch) / (patch * step_size))) + 1
+        actual_step = (image - patch) / (n - 1) if n > 1 else 0
+        steps.append([int(np.round(actual_step * i)) for i in range(n)])
+
+    return steps
+
+
+def load_plans(model_folder, configuration='3d_fullres'):
+    """
+    Reads the preprocessing of a configuration from the plans.json and dataset.json of an nnU-Net model folder.
+
+    Args:
+        model_folder (str): Folder with plans.json and dataset.json, as exported by nnUNetv2_export_model_to_zip.
+        configuration (str): Name of the configuration, e.g. 3d_fullres.
+
+    Returns:
+        dict: Target spacing, transpositions, normalization and patch size of the configuration (all axes in the
+        transposed Z, Y, X order of nnU-Net).
+    """
+    with open(os.path.join(model_folder, 'plans.json')) as f:
+        plans = json.load(f)
+    with open(os.path.join(model_folder, 'dataset.json')) as f:
+        dataset = json.load(f)
+
+    configurations = plans['configurations']
+    if configuration not in configurations:
+        raise ValueError('Unknown configuration: ' + configuration + '. Options are: ' + ', '.join(configurations))
+
+    # Configurations can inherit from another one and only override some of its entries
+    config = dict(configurations[configuration])
+    while 'inherits_from' in config:
+        parent = dict(configurations[config.pop('inherits_from')])
+        parent.update(config)
+        config = parent
+
+    channels = dataset.get('channel_names', dataset.get('modality'))
+
+    return {'spacing': [float(spacing) for spacing in config['spacing']],
+            'transpose_forward': list(plans['transpose_forward']),
+            'transpose_backward': list(plans['transpose_backward']),
+            'normalization_schemes': list(config['normalization_schemes']),
+            'use_mask_for_norm': list(config['use_mask_for_norm']),
+            'intensity_properties': plans.get('foreground_intensity_properties_per_channel', {}),
+            'patch_size': tuple(int(size) for size in config['patch_size']),
+            'num_channels': len(channels)}
+
+
+# Mask of the voxels that are non-zero in any channel, with the holes filled, as nnU-Net crops to.
+def create_nonzero_mask(images):
+
+    mask = images[0] != 0
+    for channel in images[1:]:
+        mask |= channel != 0
+
+    return binary_fill_holes(mask)
+
+
+# Crops the images to the bounding box of the non-zero region. Returns the crop, its mask and the box (slices).
+def crop_to_nonzero(images):
+
+    mask = create_nonzero_mask(images)
+    if not mask.any():
+        box = tuple(slice(0, size) for size in mask.shape)
+    else:
+        box = tuple(slice(int(np.min(index)), int(np.max(index)) + 1) for index in np.nonzero(mask))
+
+    return images[(slice(None),) + box], mask[box], box
+
+
+# Normalizes every channel in place with its scheme in the plans, as nnU-Net does (in float32, over the non-zero mask
+# if use_mask_for_norm).
+def normalize_channels(images, mask, plans):
+
+    for index, channel in enumerate(images):
+        scheme = plans['normalization_schemes'][index]
+
+        if scheme == 'ZScoreNormalization':
+            if plans['use_mask_for_norm'][index]:
+                mean = channel[mask].mean()
+                std = channel[mask].std()
+                channel[mask] = (channel[mask] - mean) / max(std, 1e-8)
+            else:
+                mean = channel.mean()
+                std = channel.std()
+                channel -= mean
+                channel /= max(std, 1e-8)
+
+        elif scheme == 'CTNormalization':
+            properties = plans['intensity_properties'][str(index)]
+            np.clip(channel, properties['percentile_00_5'], properties['percentile_99_5'], out=channel)
+            channel -= properties['mean']
+            channel /= max(properties['std'], 1e-8)
+
+        elif scheme != 'NoNormalization':
+            raise ValueError('Unsupported normalization scheme: ' + scheme)
+
+    return images
+
+
+# Resizes an image as skimage.transform.resize(image, shape, order, mode='edge', anti_aliasing=False), which nnU-Net
+# resamples with: a spline zoom between the voxel edges, clipped to the range of the input.
+def resize(image, shape, order):
+
+    image = image.astype(np.float64)
+    resized = zoom(image, [new / old for new, old in zip(shape, image.shape)], order=order, mode='nearest', grid_mode=True)
+    if order > 0:
+        np.clip(resized, image.min(), image.max(), out=resized)
+
+    return resized
+
+
+# Axis of the separate (nearest-neighbour) resampling of anisotropic images: the single axis with the largest spacing,
+# if it is more than 3 times the smallest. None if the image is not anisotropic or if two axes have the largest spacing.
+def get_separate_axis(spacing):
+
+    spacing = np.array(spacing, dtype=np.float64)
+    if spacing.max() / spacing.min() <= 3:
+        return None
+
+    axes = np.where(spacing.max() / spacing == 1)[0]
+
+    return int(axes[0]) if len(axes) == 1 else None
+
+
+def resample_channels(data, shape, current_spacing, new_spacing, order, out=None):
+    """
+    Resamples every channel to a new shape as nnU-Net's resample_data_or_seg_to_shape (default settings). Anisotropic
+    images are resampled slice by slice with the given spline order and with nearest neighbours between the slices.
+
+    Args:
+        data (np.ndarray): Channels (C, Z, Y, X).
+        shape (tuple): New shape (Z, Y, X).
+        current_spacing, new_spacing (list): Spacings (Z, Y, X) before and after resampling.
+        order (int): Spline order (3 for images, 1 for logits).
+        out (np.ndarray): Output array (C, shape). Allocated with the data type of data if None.
+
+    Returns:
+        np.ndarray: Resampled channels.
+    """
+    shape = tuple(int(size) for size in shape)
+    if out is None:
+        out = np.empty((data.shape[0],) + shape, dtype=data.dtype)
+
+    if data.shape[1:] == shape:
+        out[...] = data
+        return out
+
+    axis = get_separate_axis(current_spacing)
+    if axis is None:
+        axis = get_separate_axis(new_spacing)
+
+    # Nearest neighbours along the separate axis: the same voxel centers as map_coordinates(order=0, mode='nearest')
+    if axis is not None:
+        coordinates = data.shape[axis + 1] / shape[axis] * (np.arange(shape[axis]) + 0.5) - 0.5
+        indices = np.clip(np.floor(coordinates + 0.5).astype(np.int64), 0, data.shape[axis + 1] - 1)
+        slice_shape = [size for a, size in enumerate(shape) if a != axis]
+
+    for channel, channel_out in zip(data, out):
+        if axis is None:
+            channel_out[...] = resize(channel, shape, order)
+            continue
+
+        slices = np.stack([resize(np.take(channel, index, axis=axis), slice_shape, order) for index in range(channel.shape[axis])], axis)
+        channel_out[...] = np.take(slices, indices, axis=axis)
+
+    return out
+
+
+def preprocess_images(images, spacing, plans):
+    """
+    Preprocesses a case as nnU-Net: transposes it, crops it to the non-zero region, normalizes every channel and
+    resamples it to the spacing of the configuration.
+
+    Args:
+        images (np.ndarray): Images (C, Z, Y, X) as float32. Normalized in place.
+        spacing (list): Spacing of the images (Z, Y, X).
+        plans (dict): Preprocessing of the configuration (see load_plans).
+
+    Returns:
+        tuple: The preprocessed images and the properties needed to revert the preprocessing (see revert_preprocessing).
+    """
+    if images.shape[0] != plans['num_channels']:
+        raise ValueError('The model expects {} channels, the case has {}.'.format(plans['num_channels'], images.shape[0]))
+
+    transpose = plans['transpose_forward']
+    images = images.transpose([0] + [axis + 1 for axis in transpose])
+    spacing = [float(spacing[axis]) for axis in transpose]
+    shape_before_cropping = images.shape[1:]
+
+    images, mask, box = crop_to_nonzero(images)
+    images = normalize_channels(np.ascontiguousarray(images), mask, plans)
+
+    # 2D configurations keep the spacing of the first axis
+    target_spacing = list(plans['spacing'])
+    if len(target_spacing) < 3:
+        target_spacing = spacing[:1] + target_spacing
+    shape = [int(round(old / new * size)) for old, new, size in zip(spacing, target_spacing, images.shape[1:])]
+
+    properties = {'shape_before_cropping': shape_before_cropping, 'box': box, 'shape_after_cropping': images.shape[1:],
+                  'spacing': spacing, 'target_spacing': target_spacing}
+
+    return resample_channels(images, shape, spacing, target_spacing, order=3), properties
+
+
+def revert_preprocessing(logits, properties, plans, dtype=np.float32):
+    """
+    Brings the predicted logits back to the case as nnU-Net exports them: resamples them to the native spacing,
+    takes the softmax and puts it back into the uncropped (and untransposed) image, as background outside the crop.
+
+    Args:
+        logits (np.ndarray): Logits (classes, Z, Y, X) on the grid of preprocess_images.
+        properties (dict): Properties from preprocess_images.
+        plans (dict): Preprocessing of the configuration (see load_plans).
+        dtype: Data type of the returned probabilities.
+
+    Returns:
+        np.ndarray: Probabilities (classes, Z, Y, X) on the grid of the case.
+    """
+    logits = resample_channels(logits, properties['shape_after_cropping'], properties['target_spacing'], properties['spacing'], order=1)
+    probabilities = softmax_(logits)
+
+    uncropped = np.zeros((probabilities.shape[0],) + tuple(properties['shape_before_cropping']), dtype=dtype)
+    uncropped[0] = 1
+    uncropped[(slice(None),) + properties['box']] = probabilities
+
+    return uncropped.transpose([0] + [axis + 1 for axis in plans['transpose_backward']])
+
+
+# Softmax over the first axis in place, one z-slice at a time to keep the temporary arrays small.
+def softmax_(logits):
+
+    for z in range(logits.shape[1]):
+        logits_slice = logits[:, z]
+        logits_slice -= logits_slice.max(axis=0)
+        np.exp(logits_slice, out=logits_slice)
+        logits_slice /= logits_slice.sum(axis=0)
+
+    return logits
+
+
+def load_models(model_files, threads=0):
+    """
+    Creates one onnxruntime CPU session per fold.
+
+    Args:
+        model_files (list): Paths to the ONNX-files.
+        threads (int): Number of threads of each session. 0 lets onnxruntime decide.
+
+    Returns:
+        list: The sessions.
+    """
+    if onnxruntime is None:
+        raise ImportError('The ONNX inference requires the onnxruntime package.')
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    return [onnxruntime.InferenceSession(file, sess_options=options, providers=['CPUExecutionProvider']) for file in model_files]
+
+
+# Patch size and fixed batch size (None if dynamic) from the input of the model.
+def get_input_shape(session, patch_size=None):
+
+    shape = session.get_inputs()[0].shape
+    if patch_size is None:
+        patch_size = shape[2:]
+        if not all(isinstance(size, int) for size in patch_size):
+            raise ValueError('The model has a dynamic patch size, give it with patch_size.')
+
+    batch = shape[0] if isinstance(shape[0], int) else None
+
+    return tuple(int(size) for size in patch_size), batch
+
+
+def sliding_window_predict(images, sessions, patch_size=None, step_size=0.5, batch_size=4, mirror_axes=(), dtype=np.float32,
+                           return_logits=False):
+    """
+    Predicts the class probabilities of one preprocessed case with all folds.
+
+    Args:
+        images (np.ndarray): Normalized images (C, Z, Y, X) as float32.
+        sessions (list): onnxruntime sessions, one per fold (see load_models).
+        patch_size (tuple): Patch size (Z, Y, X). Taken from the model if None.
+        step_size (float): Distance between patches as a fraction of the patch size.
+        batch_size (int): Number of patches in each model call (ignored if the model has a fixed batch size).
+        mirror_axes (tuple): Spatial axes (0, 1, 2 for Z, Y, X) to mirror for test-time augmentation, as in nnU-Net.
+        dtype: Data type of the returned probabilities.
+        return_logits (bool): Return the averaged logits (float32) instead of their softmax.
+
+    Returns:
+        np.ndarray: Probabilities (classes, Z, Y, X), the softmax of the averaged logits.
+    """
+    patch_size, fixed_batch = get_input_shape(sessions[0], patch_size)
+    if fixed_batch is not None:
+        batch_size = fixed_batch
+
+    # Pad images smaller than a patch, the padding is removed again at the end
+    image_size = images.shape[1:]
+    missing = [max(patch - size, 0) for size, patch in zip(image_size, patch_size)]
+    padding = [(0, 0)] + [(n // 2, n - n // 2) for n in missing]
+    if any(sum(pad) > 0 for pad in padding):
+        images = np.pad(images, padding, mode='constant')
+    padded_size = images.shape[1:]
+
+    patches = [tuple(slice(start, start + size) for start, size in zip(position, patch_size))
+               for position in product(*compute_steps(padded_size, patch_size, step_size))]
+
+    gaussian = gaussian_importance_map(patch_size)
+
+    # The weight of every voxel is the same for all folds and mirrorings
+    weights = np.zeros(padded_size, dtype=np.float32)
+    for patch in patches:
+        weights[patch] += gaussian
+
+    mirrorings = [tuple(axis + 2 for axis, flip in zip(mirror_axes, flips) if flip) for flips in product([False, True], repeat=len(mirror_axes))]
+    input_name = sessions[0].get_inputs()[0].name
+
+    batch = np.zeros((batch_size, images.shape[0]) + patch_size, dtype=np.float32)
+    accumulator = None
+
+    for session in sessions:
+        for start in range(0, len(patches), batch_size):
+            batch_patches = patches[start:start + batch_size]
+            for i, patch in enumerate(batch_patches):
+                batch[i] = images[(slice(None),) + patch]
+            inputs = batch if fixed_batch is not None else batch[:len(batch_patches)]
+
+            logits = None
+            for axes in mirrorings:
+                prediction = session.run(None, {input_name: np.ascontiguousarray(np.flip(inputs, axes)) if axes else inputs})[0]
+                prediction = np.flip(prediction, axes) if axes else prediction
+                logits = prediction if logits is None else logits + prediction
+
+            if accumulator is None:
+                accumulator = np.zeros((logits.shape[1],) + padded_size, dtype=np.float32)
+                weighted = np.empty(logits.shape[1:], dtype=np.float32)
+
+            for i, patch in enumerate(batch_patches):
+                np.multiply(logits[i], gaussian, out=weighted)
+                accumulator[(slice(None),) + patch] += weighted
+
+    # Weighted average over the patches, folds and mirrorings, then softmax
+    accumulator /= weights * np.float32(len(sessions) * len(mirrorings))
+    accumulator = np.ascontiguousarray(accumulator[(slice(None),) + tuple(slice(before, before + size) for (before, _), size in zip(padding[1:], image_size))])
+    if return_logits:
+        return accumulator
+    probabilities = softmax_(accumulator)
+
+    return probabilities.astype(dtype, copy=False)
+
+
+# Input files of every case in an nnU-Net image folder (CASE_0000.nrrd, CASE_0001.nrrd, ...), sorted by channel.
+def get_cases(input_folder, identifier='.nrrd'):
+
+    cases = dict()
+    pattern = re.compile('(.+)_(\\d{4})' + re.escape(identifier) + '$')
+    for file in sorted(os.listdir(input_folder)):
+        match = pattern.match(file)
+        if match is not None:
+            cases.setdefault(match.group(1), []).append(os.path.join(input_folder, file))
+
+    return cases
+
+
+# Reads the channels of a case as one (C, Z, Y, X) float32 array. The first channel is the reference image.
+def read_case(files):
+
+    reference = sitk.ReadImage(files[0], sitk.sitkFloat32)
+    images = np.empty((len(files),) + sitk.GetArrayViewFromImage(reference).shape, dtype=np.float32)
+    images[0] = sitk.GetArrayViewFromImage(reference)
+    for channel, file in enumerate(files[1:], start=1):
+        # Keep a reference to the image while its array view is copied
+        img = sitk.ReadImage(file, sitk.sitkFloat32)
+        images[channel] = sitk.GetArrayViewFromImage(img)
+
+    return images, reference
+
+
+def predict_images(images, spacing, sessions, plans, dtype=np.float32, **options):
+    """
+    Preprocesses and predicts one case as nnUNetv2_predict.
+
+    Args:
+        images (np.ndarray): Images (C, Z, Y, X) as float32. Normalized in place.
+        spacing (list): Spacing of the images (Z, Y, X).
+        sessions (list): onnxruntime sessions (see load_models).
+        plans (dict): Preprocessing of the configuration (see load_plans).
+        dtype: Data type of the returned probabilities.
+        options: Options of sliding_window_predict. The patch size defaults to the one in the plans.
+
+    Returns:
+        np.ndarray: Probabilities (classes, Z, Y, X) on the grid of the images.
+    """
+    data, properties = preprocess_images(images, spacing, plans)
+    if options.get('patch_size') is None:
+        options['patch_size'] = plans['patch_size']
+
+    logits = sliding_window_predict(data, sessions, return_logits=True, **options)
+
+    return revert_preprocessing(logits, properties, plans, dtype)
+
+
+# Saves the probabilities and the segmentation of a case in the layout of nnUNetv2_predict --save_probabilities.
+def save_prediction(probabilities, reference, output_folder, case, identifier='.nrrd'):
+
+    segmentation = sitk.GetImageFromArray(probabilities.argmax(axis=0).astype(np.uint8))
+    segmentation.CopyInformation(reference)
+    sitk.WriteImage(segmentation, os.path.join(output_folder, case + identifier), useCompression=True)
+
+    np.save(os.path.join(output_folder, case + '.probabilities.npy'), probabilities)
+
+
+def predict_folder(input_folder, output_folder, model_files, plans, identifier='.nrrd', threads=0, postprocess_folder=None,
+                   postprocess_options=None, **options):
+    """
+    Predicts all cases in an nnU-Net image folder with the folds and saves the probabilities. With a postprocess_folder,
+    the postprocessed segmentations are also saved there, as by postprocess_nnUNet.py. plans is the preprocessing of the
+    configuration (see load_plans).
+
+    Returns:
+        list: (case, seconds) for every case.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    if postprocess_folder is not None:
+        os.makedirs(postprocess_folder, exist_ok=True)
+
+    sessions = load_models(model_files, threads)
+    results = []
+
+    for case, files in get_cases(input_folder, identifier).items():
+        start = time.perf_counter()
+
+        images, reference = read_case(files)
+        probabilities = predict_images(images, reference.GetSpacing()[::-1], sessions, plans, **options)
+        save_prediction(probabilities, reference, output_folder, case, identifier)
+
+        if postprocess_folder is not None:
+            segmentation = postprocess_probabilities(ProbabilitySource(probabilities, layout='CZYX'), reference.GetSpacing(), **(postprocess_options or {}))
+            np.save(os.path.join(postprocess_folder, case), segmentation)
+
+        results.append((case, time.perf_counter() - start))
+        print('{}: {:.1f} s'.format(case, results[-1][1]))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_folder', type=str, default="C:\\William\\TEST\\nnUNet_data\\nnUNet_raw\\Dataset077_ProstateZones\\imagesTs", help='Path to the folder containing the images (CASE_0000.nrrd, ...).')
+    parser.add_argument('--model_folder', type=str, default="C:\\William\\TEST\\nnUNet\\ONNX", help='Path to the folder containing the ONNX-file of each fold, plans.json and dataset.json.')
+    parser.add_argument('--configuration', type=str, default='3d_fullres', help='Configuration of the plans the folds were trained with.')
+    parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\nnUNet\\nnUNet_output\\Probabilities", help='Path to the desired output folder.')
+    parser.add_argument('--identifier', type=str, default='.nrrd', help='File-type identifier of the images.')
+    parser.add_argument('--threads', type=int, default=0, help='Number of threads of each onnxruntime session. 0 lets onnxruntime decide.')
+    parser.add_argument('--batch_size', type=int, default=4, help='Number of patches in each model call.')
+    parser.add_argument('--step_size', type=float, default=0.5, help='Distance between the patches as a fraction of the patch size.')
+    parser.add_argument('--patch_size', type=int, default=None, nargs=3, help='Patch size (Z Y X) for models with a dynamic input size.')
+    parser.add_argument('--mirror', action='store_true', help='Average over all mirrorings of the patches, as nnU-Net does by default (8 times slower).')
+    parser.add_argument('--float16', action='store_true', help='Save the probabilities as float16.')
+    parser.add_argument('--postprocess_folder', type=str, default=None, help='Also run the postprocessing in this process and save the segmentations in this folder.')
+    parser.add_argument('--crop', action='store_true', help='Run the postprocessing within the bounding box of the predicted prostate.')
+    args = parser.parse_args()
+
+    model_files = sorted(glob.glob(os.path.join(args.model_folder, '*.onnx')))
+    if len(model_files) == 0:
+        raise FileNotFoundError('No ONNX-files found in ' + args.model_folder)
+
+    plans = load_plans(args.model_folder, args.configuration)
+
+    start = time.perf_counter()
+    results = predict_folder(args.input_folder, args.output_folder, model_files, plans, identifier=args.identifier, threads=args.threads,
+                             postprocess_folder=args.postprocess_folder, postprocess_options={'crop': args.crop},
+                             patch_size=args.patch_size, step_size=args.step_size, batch_size=args.batch_size,
+                             mirror_axes=(0, 1, 2) if args.mirror else (), dtype=np.float16 if args.float16 else np.float32)
+
+    print('Predicted {} cases with {} folds in {:.1f} s.'.format(len(results), len(model_files), time.perf_counter() - start))
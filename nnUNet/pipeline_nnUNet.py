@@ -0,0 +1,167 @@
+import os
+import glob
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+
+from prepare_for_nnUNet import find_patient_files, get_additional_sequences
+from utils_prepare_for_nnUNet import read_images, resampleSequencesToReference, write_image, makeDirectory, setNumberOfThreads, OUTPUT_PIXEL_TYPES
+from inference_nnUNet import load_models, load_plans, predict_images, save_prediction
+from postprocess_nnUNet import postprocess_probabilities
+from probability_source import ProbabilitySource
+
+'''
+In-memory pipeline from the DICOM series of a patient to the postprocessed nnU-Net segmentation.
+
+The stages of prepare_for_nnUNet.py, the prediction (with the ONNX-files of the folds, see inference_nnUNet.py) and
+postprocess_nnUNet.py run in one process and pass SimpleITK images and NumPy arrays between them instead of NRRD- and
+npz-files. The models are loaded once for all patients. Writing the intermediate images and probabilities is optional
+(--intermediate_folder), and the time of every stage is reported for each patient.
+'''
+
+STAGES = ['read', 'resample', 'predict', 'postprocess', 'write']
+
+
+class Pipeline:
+    """
+    DICOM to segmentation for one patient at a time.
+
+    Args:
+        model_files (list): Paths to the ONNX-files of the folds.
+        plans (dict): Preprocessing of the configuration of the folds (see inference_nnUNet.load_plans).
+        sequences (list): Additional sequences in channel order, e.g. ['ADC', 'HBV'].
+        threads (int): Number of threads of each onnxruntime session. 0 lets onnxruntime decide.
+        cache_folder (str): Cache of the decoded DICOM series (see utils_prepare_for_nnUNet.read_image_cached).
+        output_dtype (str): Pixel type of the resampled sequences, as in prepare_for_nnUNet.py.
+        intermediate_folder (str): If given, the prepared images (CASE_0000.nrrd, ...) and the probabilities
+            (CASE.probabilities.npy and CASE.nrrd) are also written to this folder.
+        predict_options (dict): Options of inference_nnUNet.predict_images (e.g. step_size, batch_size).
+        postprocess_options (dict): Options of postprocess_nnUNet.postprocess_probabilities (e.g. crop, radius).
+    """
+
+    def __init__(self, model_files, plans, sequences=(), threads=0, cache_folder=None, output_dtype='float32',
+                 intermediate_folder=None, predict_options=None, postprocess_options=None):
+        self.sessions = load_models(model_files, threads)
+        self.plans = plans
+        self.sequences = list(sequences)
+        self.cache_folder = cache_folder
+        self.output_dtype = output_dtype
+        self.intermediate_folder = intermediate_folder
+        self.predict_options = predict_options or {}
+        self.postprocess_options = postprocess_options or {}
+
+    def run(self, patient_dir, output_file=None, case=None):
+        """
+        Segments one patient.
+
+        Args:
+            patient_dir (str): Patient folder with the DICOM series (T2 and the additional sequences).
+            output_file (str): Where to save the segmentation: a npy-file (X, Y, Z, as postprocess_nnUNet.py) or an
+                image file (e.g. nrrd) with the geometry of the T2. Not saved if None.
+            case (str): Name of the case in the intermediate files. Defaults to the name of the patient folder.
+
+        Returns:
+            tuple: Segmentation (uint8, X, Y, Z), the T2 image and the seconds spent in every stage.
+        """
+        case = os.path.basename(os.path.normpath(patient_dir)) if case is None else case
+        timings = dict.fromkeys(STAGES, 0.0)
+
+        t = time.perf_counter()
+        files = find_patient_files(patient_dir)
+        series = read_images([files['T2']] + [files[sequence] for sequence in self.sequences], self.cache_folder)
+        t2 = series[0]
+        timings['read'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        moving = dict(zip(self.sequences, series[1:]))
+        resampled = resampleSequencesToReference(moving, t2, interpolator=sitk.sitkLinear, outputPixelType=OUTPUT_PIXEL_TYPES[self.output_dtype])
+        channels = [t2] + [resampled[sequence] for sequence in self.sequences]
+
+        # (C, Z, Y, X) float32, as nnU-Net reads the prepared images
+        images = np.empty((len(channels),) + sitk.GetArrayViewFromImage(t2).shape, dtype=np.float32)
+        for channel, img in zip(images, channels):
+            channel[...] = sitk.GetArrayViewFromImage(img)
+        timings['resample'] = time.perf_counter() - t
+
+        if self.intermediate_folder is not None:
+            t = time.perf_counter()
+            makeDirectory(self.intermediate_folder)
+            for index, img in enumerate(channels):
+                write_image(img, os.path.join(self.intermediate_folder, case + '_' + str(index).zfill(4) + '.nrrd'))
+            timings['write'] += time.perf_counter() - t
+
+        t = time.perf_counter()
+        probabilities = predict_images(images, t2.GetSpacing()[::-1], self.sessions, self.plans, **self.predict_options)
+        timings['predict'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        segmentation = postprocess_probabilities(ProbabilitySource(probabilities, layout='CZYX'), t2.GetSpacing(), **self.postprocess_options)
+        timings['postprocess'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        if self.intermediate_folder is not None:
+            save_prediction(probabilities, t2, self.intermediate_folder, case)
+        if output_file is not None:
+            save_segmentation(segmentation, t2, output_file)
+        timings['write'] += time.perf_counter() - t
+
+        return segmentation, t2, timings
+
+
+# Saves a segmentation (X, Y, Z) as a npy-file, or as an image with the geometry of the reference image.
+def save_segmentation(segmentation, reference, output_file):
+
+    if output_file.lower().endswith('.npy'):
+        np.save(output_file, segmentation)
+        return
+
+    img = sitk.GetImageFromArray(np.ascontiguousarray(segmentation.transpose(2, 1, 0)))
+    img.CopyInformation(reference)
+    sitk.WriteImage(img, output_file, useCompression=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_folder', type=str, default="C:\\William\\Doktorand\\Data\\test_output\\Test", help='Path to the folder containing the patient folders.')
+    parser.add_argument('--model_folder', type=str, default="C:\\William\\TEST\\nnUNet\\ONNX", help='Path to the folder containing the ONNX-file of each fold, plans.json and dataset.json.')
+    parser.add_argument('--configuration', type=str, default='3d_fullres', help='Configuration of the plans the folds were trained with.')
+    parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\nnUNet\\Pipeline", help='Path to the desired output folder.')
+    parser.add_argument('--imgs', type=str, default=[], nargs='+', help='Additional image sequences the model was trained with. Options are: ADC and HBV.')
+    parser.add_argument('--output_format', type=str, default='npy', choices=['npy', 'nrrd'], help='npy: as postprocess_nnUNet.py. nrrd: with the geometry of the T2.')
+    parser.add_argument('--intermediate_folder', type=str, default=None, help='Also write the prepared images and the probabilities to this folder.')
+    parser.add_argument('--cache_folder', type=str, default=None, help='Folder for caching the decoded DICOM series.')
+    parser.add_argument('--output_dtype', type=str, default='float32', choices=list(OUTPUT_PIXEL_TYPES), help='Pixel type of the resampled sequences (ADC, HBV).')
+    parser.add_argument('--threads', type=int, default=0, help='Number of threads of each onnxruntime session and SimpleITK filter. 0 keeps the defaults.')
+    parser.add_argument('--batch_size', type=int, default=4, help='Number of patches in each model call.')
+    parser.add_argument('--step_size', type=float, default=0.5, help='Distance between the patches as a fraction of the patch size.')
+    parser.add_argument('--mirror', action='store_true', help='Average over all mirrorings of the patches, as nnU-Net does by default.')
+    parser.add_argument('--crop', action='store_true', help='Run the postprocessing within the bounding box of the predicted prostate.')
+    args = parser.parse_args()
+
+    model_files = sorted(glob.glob(os.path.join(args.model_folder, '*.onnx')))
+    if len(model_files) == 0:
+        raise FileNotFoundError('No ONNX-files found in ' + args.model_folder)
+
+    setNumberOfThreads(args.threads)
+    makeDirectory(args.output_folder)
+
+    start = time.perf_counter()
+    pipeline = Pipeline(model_files, load_plans(args.model_folder, args.configuration), get_additional_sequences(args.imgs), threads=args.threads, cache_folder=args.cache_folder,
+                        output_dtype=args.output_dtype, intermediate_folder=args.intermediate_folder,
+                        predict_options={'batch_size': args.batch_size, 'step_size': args.step_size, 'mirror_axes': (0, 1, 2) if args.mirror else ()},
+                        postprocess_options={'crop': args.crop})
+    print('Loaded {} folds in {:.1f} s.'.format(len(model_files), time.perf_counter() - start))
+
+    totals = dict.fromkeys(STAGES, 0.0)
+    patients = sorted(os.listdir(args.input_folder))
+    for patient in patients:
+        output_file = os.path.join(args.output_folder, patient + '.' + args.output_format)
+        _, _, timings = pipeline.run(os.path.join(args.input_folder, patient), output_file)
+
+        print(patient + ': ' + ', '.join('{} {:.2f} s'.format(stage, timings[stage]) for stage in STAGES))
+        for stage in STAGES:
+            totals[stage] += timings[stage]
+
+    print('Segmented {} patients in {:.1f} s ('.format(len(patients), time.perf_counter() - start) + ', '.join('{} {:.1f} s'.format(stage, totals[stage]) for stage in STAGES) + ').')
@@ -1,98 +1,193 @@
 import os
+import time
+import traceback
 import SimpleITK as sitk
 import numpy as np
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 
-from utils_postprocess_nnUNet import get_filenames_with_extension, channelSplit, getLargestCC, drawUrethra, findIndices_allSlices, column, fill_empty_voxels
+from utils_postprocess_nnUNet import get_filenames_with_extension, reconstruct_urethra, labels_from_probabilities, get_prostate, fill_empty_labels, get_bounding_box
+from probability_source import open_probabilities, ProbabilitySource
+from connected_components import set_backend
 
 '''
 This file will perform the postprocessing for the nnU-Net model based on the probabilities from the model prediction.
+The cases are processed independently and can be spread over several worker processes (--workers).
 '''
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--probabilities_folder', type=str, default="C:\\William\\TEST\\nnUNet\\nnUNet_output\\Probabilities", help='Path to folder containing the probabilities from the model prediction.')
-parser.add_argument('--file_identifier', type=str, default='nrrd', help='The file identifier. Options are: ...')
-parser.add_argument('--simple_postprocess', type=bool, default=False, help='Type of postprocess. Options are: True or False.')
-parser.add_argument('--radius', type=int, default=3, help='Defining the radius of the drawn urethra.')
-parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\nnUNet\\nnUNet_output\\Postprocessed", help='Path to the desired output folder.')
-args = parser.parse_args()
 
+# Probability file belonging to the image file. Uncompressed files (CASE.probabilities.npy or CASE.probabilities.raw)
+# are preferred over the npz-file from nnU-Net.
+def find_probabilities(probabilities_folder, file, file_identifier='nrrd'):
 
-filenames = get_filenames_with_extension(args.probabilities_folder, args.file_identifier)
+    for extension in ['probabilities.npy', 'probabilities.raw', 'npz']:
+        path = os.path.join(probabilities_folder, file.replace(file_identifier, extension))
+        if os.path.exists(path):
+            return path
 
-for file in filenames:
+    return os.path.join(probabilities_folder, file.replace(file_identifier, 'npz'))
 
-    img = sitk.ReadImage(os.path.join(args.probabilities_folder, file))
-    spacing = img.GetSpacing()
 
-    probabilities = np.load(os.path.join(args.probabilities_folder, file.replace(args.file_identifier, 'npz')))['probabilities'].transpose(3,2,1,0)
+# Postprocessed segmentation (uint8, X, Y, Z) from the probabilities (X, Y, Z, C) of one case.
+# With crop, the steps after finding the prostate only run within its bounding box (extended by margin voxels).
+def postprocess_probabilities(probabilities, spacing, simple_postprocess=False, radius=3, crop=False, margin=2):
 
-    bg = channelSplit(probabilities, 0)
-    pz = channelSplit(probabilities, 1)
-    cz = channelSplit(probabilities, 2)
-    tz = channelSplit(probabilities, 3)
-    afs = channelSplit(probabilities, 4)
-    u = channelSplit(probabilities, 5)
+    if not isinstance(probabilities, ProbabilitySource):
+        probabilities = ProbabilitySource(probabilities, layout='XYZC')
 
+    u = probabilities.channel(5)
 
-    pred_background = np.argmax(probabilities, axis=3) == 0
+    # Single argmax over the channels, the rest of the pipeline works on uint8 labels and boolean masks.
+    prediction = labels_from_probabilities(probabilities)
 
-    lcc_background = getLargestCC(pred_background)
+    prostate = get_prostate(prediction)
 
-    prostate = getLargestCC((~lcc_background).astype(int))
+    full_shape = prostate.shape
+    box = get_bounding_box(prostate, margin) if crop else None
+    if box is None:
+        box = tuple(slice(0, n) for n in full_shape)
+        crop = False
 
+    prediction = prediction[box]
+    prostate = prostate[box]
     background = ~prostate
 
-    urethra_zSlices = np.split(u, u.shape[2], axis=2)
+    # Draw urethra along the fitted centerline.
+    urethra = reconstruct_urethra(u, radius_mm=radius, inplane_image_spacing=spacing[0], box=box) & prostate
 
-    indices_list = []
-    placeholder = [indices_list.append(np.insert(findIndices_allSlices(zSlice), 2, z)) for zSlice, z in zip(urethra_zSlices, range(len(urethra_zSlices)))]
+    if simple_postprocess:
 
+        pz, cz, tz, afs = [np.asarray(probabilities[box + (channel,)], dtype=np.float32) for channel in range(1, 5)]
+        updated_probabilities_stacked = np.stack([background, pz, cz, tz, afs, urethra], axis=-1)
+        segmentation = updated_probabilities_stacked.argmax(axis=3).astype(np.uint8)
 
-    x = column(np.array(indices_list), 0)
-    y = column(np.array(indices_list), 1)
-    z = column(np.array(indices_list), 2)
-    w = column(np.array(indices_list), 3)
+    else:
 
-    fitxz = np.polyfit(z, x, deg=2, w=w)
-    fityz = np.polyfit(z, y, deg=2, w=w)
+        segmentation = fill_empty_labels(background, prediction, prostate, urethra, spacing,
+                                         box=box if crop else None, full_shape=full_shape)
 
-    x_pred = np.polyval(fitxz, z)
-    y_pred = np.polyval(fityz, z)
+    if not crop:
+        return segmentation
 
-    x_p = np.round(x_pred)
-    y_p = np.round(y_pred)
+    # Paste the cropped segmentation back, everything outside the crop is background.
+    full_segmentation = np.zeros(full_shape, dtype=np.uint8)
+    full_segmentation[box] = segmentation
 
+    return full_segmentation
 
-    # Draw urethra.
-    urethra_list = []
-    for zSlice, ii in zip(urethra_zSlices, range(len(indices_list))):
-        indices = np.array([x_p[ii], y_p[ii], z[ii]])
-        urethra_list.append(drawUrethra(array_shape=zSlice.shape, indicies=indices, radius_mm=args.radius, inplane_image_spacing=spacing[0]))
 
+# Postprocess a single case (file) and save the resulting segmentation in the output folder.
+def postprocess_case(file, probabilities_folder, output_folder, file_identifier='nrrd', simple_postprocess=False, radius=3, cache_folder=None, float16=False,
+                     cc_backend=None, crop=False, margin=2):
 
-    urethra_all_slices = np.stack(urethra_list, axis=2).squeeze()
+    if cc_backend is not None:
+        set_backend(cc_backend)
 
-    urethra = urethra_all_slices * prostate.astype(int)
+    img = sitk.ReadImage(os.path.join(probabilities_folder, file))
+    spacing = img.GetSpacing()
 
-    if args.simple_postprocess:
+    # Probabilities as (X, Y, Z, C), memory-mapped when possible.
+    probabilities = open_probabilities(find_probabilities(probabilities_folder, file, file_identifier),
+                                       cache_folder=cache_folder, dtype=np.float16 if float16 else None)
 
-        updated_probabilities_stacked = np.stack([background.astype(int), pz, cz, tz, afs, urethra], axis=-1)
-        segmentation = updated_probabilities_stacked.argmax(axis=3)
+    segmentation = postprocess_probabilities(probabilities, spacing, simple_postprocess=simple_postprocess, radius=radius, crop=crop, margin=margin)
 
-    else:
-        
-        pred_pz = np.argmax(probabilities, axis=3) == 1
-        pred_cz = np.argmax(probabilities, axis=3) == 2
-        pred_tz = np.argmax(probabilities, axis=3) == 3
-        pred_afs = np.argmax(probabilities, axis=3) == 4
+    output_file = os.path.join(output_folder, file[:-5])
+    np.save(output_file, segmentation)
+
+    return output_file + '.npy'
+
+
+# Runs postprocess_case and catches any error, so that one failing case does not stop the rest of the batch.
+def run_case(file, **kwargs):
+
+    start = time.perf_counter()
+    try:
+        postprocess_case(file, **kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+
+    return file, time.perf_counter() - start, error
 
-        pz_pred_within_prostate = pred_pz * prostate.astype(int)
-        cz_pred_within_prostate = pred_cz * prostate.astype(int)
-        tz_pred_within_prostate = pred_tz * prostate.astype(int)
-        afs_pred_within_prostate = pred_afs * prostate.astype(int)
 
-        prel_segmentation = fill_empty_voxels(background.astype(int), pz_pred_within_prostate, cz_pred_within_prostate, tz_pred_within_prostate, afs_pred_within_prostate, urethra.astype(int), spacing)
-        segmentation = prel_segmentation.argmax(axis=3)
+# Runs a chunk of cases in one worker call.
+def run_cases(files, **kwargs):
 
-    np.save(os.path.join(args.output_folder, file[:-5]), segmentation)
\ No newline at end of file
+    return [run_case(file, **kwargs) for file in files]
+
+
+def postprocess_folder(probabilities_folder, output_folder, file_identifier='nrrd', workers=1, chunksize=1, **options):
+    """
+    Postprocesses all cases in the folder. Additional options (e.g. radius) are passed on to postprocess_case.
+
+    A case that raises, or whose worker dies (e.g. out of memory, which breaks the whole process pool), is recorded as
+    failed and the other cases are still collected.
+
+    Returns:
+        dict: 'results' (file, seconds, error traceback or None) of every case, the 'failed' files and the total
+        'elapsed' seconds.
+    """
+    filenames = get_filenames_with_extension(probabilities_folder, file_identifier)
+
+    job = partial(run_cases, probabilities_folder=probabilities_folder, output_folder=output_folder,
+                  file_identifier=file_identifier, **options)
+
+    start = time.perf_counter()
+    results = []
+
+    if workers > 1:
+        chunks = [filenames[i:i + chunksize] for i in range(0, len(filenames), chunksize)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(job, chunk): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                try:
+                    results.extend(future.result())
+                except Exception:
+                    # BrokenProcessPool fails this and all pending chunks, the finished ones are kept
+                    error = traceback.format_exc()
+                    results.extend((file, 0.0, error) for file in futures[future])
+
+        order = {file: index for index, file in enumerate(filenames)}
+        results.sort(key=lambda result: order[result[0]])
+    else:
+        results = job(filenames)
+
+    failed = []
+    for file, elapsed, error in results:
+        if error is not None:
+            failed.append(file)
+            print('Failed: ' + file + '\n' + error)
+
+    elapsed = time.perf_counter() - start
+
+    # Summary of the run
+    print('Postprocessed {} of {} cases in {:.1f} s ({:.2f} cases/s, {} workers).'.format(
+        len(results) - len(failed), len(results), elapsed, len(results) / elapsed if elapsed > 0 else 0, workers))
+    if len(failed) > 0:
+        print('Failed cases: ' + ', '.join(failed))
+
+    return {'results': results, 'failed': failed, 'elapsed': elapsed}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--probabilities_folder', type=str, default="C:\\William\\TEST\\nnUNet\\nnUNet_output\\Probabilities", help='Path to folder containing the probabilities from the model prediction.')
+    parser.add_argument('--file_identifier', type=str, default='nrrd', help='The file identifier. Options are: ...')
+    parser.add_argument('--simple_postprocess', type=bool, default=False, help='Type of postprocess. Options are: True or False.')
+    parser.add_argument('--radius', type=int, default=3, help='Defining the radius of the drawn urethra.')
+    parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\nnUNet\\nnUNet_output\\Postprocessed", help='Path to the desired output folder.')
+    parser.add_argument('--cache_folder', type=str, default=None, help='Folder for uncompressed, memory-mapped copies of the npz-probabilities. Reused in later runs.')
+    parser.add_argument('--float16', action='store_true', help='Store the uncompressed probabilities as float16.')
+    parser.add_argument('--cc_backend', type=str, default=None, help='Connected-component backend. Options are: cc3d or scipy. Defaults to cc3d if installed.')
+    parser.add_argument('--crop', action='store_true', help='Run the postprocessing within the bounding box of the predicted prostate. The output is identical.')
+    parser.add_argument('--margin', type=int, default=2, help='Margin (voxels) around the prostate bounding box used with --crop.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes. Each case is processed by one worker.')
+    parser.add_argument('--chunksize', type=int, default=1, help='Number of cases sent to a worker at a time.')
+    args = parser.parse_args()
+
+    postprocess_folder(args.probabilities_folder, args.output_folder, file_identifier=args.file_identifier, workers=args.workers, chunksize=args.chunksize,
+                       simple_postprocess=args.simple_postprocess, radius=args.radius, cache_folder=args.cache_folder, float16=args.float16, cc_backend=args.cc_backend,
+                       crop=args.crop, margin=args.margin)
@@ -1,178 +1,236 @@
 import SimpleITK as sitk
 import os
+import json
+import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from utils_prepare_for_nnUNet import makeDirectory, read_image, write_image, resampleToReference
+from utils_prepare_for_nnUNet import makeDirectory, read_images, write_image, resampleSequencesToReference, update_cache_index, \
+    source_fingerprints, load_manifest, save_manifest, setNumberOfThreads, OUTPUT_PIXEL_TYPES
 
 '''
 This file will set up the training and test data in the required structure for the nnU-Net.
 The user has the options to include the ADC and HBV sequences in addition to the required T2w axial image.
+The patients are read and written concurrently (--workers) and decoded DICOM series can be cached (--cache_folder).
+Every prepared patient is recorded in manifest.json in the dataset folder. With --incremental, patients whose sources
+and options are unchanged since the last (possibly interrupted) run are skipped.
 '''
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--imgs', type=str, default=[], nargs='+', help='Additional image sequences you want to include. Options are: ADC and HBV.')
-#parser.add_argument('--imgs', type=str, default=['ADC', 'HBV'], help='Additional image sequences you want to include. Options are: ADC or ADC and HBV.')
-parser.add_argument('--identifier', type=str, default='.nrrd', help='File-type identifier. Options are: nrrd, ...')
-parser.add_argument('--data_id', type=str, default="Dataset077_ProstateZones", help='Defining the ID of the dataset.')
-parser.add_argument('--input_folder', type=str, default="C:\\William\\Doktorand\\Data\\test_output", help='Path to the folder containing the images.')
-parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\nnUNet_data\\nnUNet_raw", help='Path to the desired output folder.')
-args = parser.parse_args()
 
-image_sequences = args.imgs
-image_sequences.insert(0, 'T2')
+# Paths to the image series (DICOM folders) and segmentation of a patient.
+def find_patient_files(patient_dir):
 
-output_folder = os.path.join(args.output_folder, args.data_id)
+    files = dict()
 
-############################################
-# Setting up Training-data
-############################################
+    for patient_file in os.listdir(patient_dir):
 
-for data in ['Train', 'Validate']:
-    for patient_folder in os.listdir(os.path.join(args.input_folder, data)):
-        
-        numbers = ''.join([n for n in patient_folder if n.isdigit()])[-3:]
+        path_to_file = os.path.join(patient_dir, patient_file)
 
-        images = 'imagesTr'
-        labels = 'labelsTr'
+        if 'tra' in patient_file:
+            files.update({'T2': path_to_file})
+            continue
 
-        makeDirectory(os.path.join(output_folder, images))
-        makeDirectory(os.path.join(output_folder, labels))
+        elif 'adc' in patient_file:
+            files.update({'ADC': path_to_file})
+            continue
 
-        for patient_file in os.listdir(os.path.join(args.input_folder, data, patient_folder)):
+        elif 'hbv' in patient_file:
+            files.update({'HBV': path_to_file})
+            continue
 
-            path_to_file = os.path.join(args.input_folder, data, patient_folder, patient_file)
+        elif 'Seg' in patient_file:
+            files.update({'Seg': path_to_file})
+            continue
 
-            if 'tra' in patient_file:
-                t2w = read_image(path_to_file)
-                continue
+    return files
 
-            elif 'adc' in patient_file:
-                adc = read_image(path_to_file)
-                continue
 
-            elif 'hbv' in patient_file:       
-                hbv = read_image(path_to_file)
-                continue
+# Additional sequences that are written, in channel order.
+def get_additional_sequences(image_sequences):
 
-            elif 'Seg' in patient_file:
-                seg = sitk.ReadImage(path_to_file)    
-                continue
+    if 'ADC' and 'HBV' in image_sequences:
+        return ['ADC', 'HBV']
+    elif 'ADC' in image_sequences:
+        return ['ADC']
+    return []
 
-        imgs = dict()
 
-        imgs.update({'Seg': seg})
-        imgs.update({'AxT2': t2w})
+# Source files of a patient that are used for the given sequences.
+def get_used_files(patient_dir, labels, sequences):
 
-        dst_t2w = os.path.join(output_folder, images, 'PROSTATEx_' + numbers + '_0000' + args.identifier)
-        dst_label = os.path.join(output_folder, labels, 'PROSTATEx_' + numbers + args.identifier)
+    files = find_patient_files(patient_dir)
+    used = ['T2'] + sequences + (['Seg'] if labels is not None else [])
 
-        write_image(imgs['AxT2'], dst_t2w)
-        write_image(imgs['Seg'], dst_label)
+    return {name: files[name] for name in used if name in files}
 
-        if 'ADC' and 'HBV' in image_sequences:
-            imgs.update({'ADC': resampleToReference(adc, imgs['AxT2'], interpolator=sitk.sitkLinear)})
-            dst_adc = os.path.join(output_folder, images, 'PROSTATEx_' + numbers + '_0001' + args.identifier)
-            imgs.update({'HBV': resampleToReference(hbv,  imgs['AxT2'], interpolator=sitk.sitkLinear)})
-            dst_hbv = os.path.join(output_folder, images, 'PROSTATEx_' + numbers + '_0002' + args.identifier)
 
-            write_image(imgs['ADC'], dst_adc)
-            write_image(imgs['HBV'], dst_hbv)
+# Writes the images (and label, for training data) of one patient in the nnU-Net structure.
+# Returns the written files relative to the output folder.
+def prepare_case(patient_dir, output_folder, images, labels, sequences, identifier='.nrrd', cache_folder=None, output_dtype='float32'):
 
-        elif 'ADC' in image_sequences:
-            imgs.update({'ADC': resampleToReference(adc, imgs['AxT2'], interpolator=sitk.sitkLinear)})
-            dst_adc = os.path.join(output_folder, images, 'PROSTATEx_' + numbers + '_0001' + args.identifier)
+    numbers = ''.join([n for n in os.path.basename(patient_dir) if n.isdigit()])[-3:]
+    files = find_patient_files(patient_dir)
 
-            write_image(imgs['ADC'], dst_adc)
+    imgs = dict()
+    outputs = []
 
+    # Read the T2 and the additional sequences at the same time.
+    series = read_images([files['T2']] + [files[sequence] for sequence in sequences], cache_folder)
+    imgs.update({'AxT2': series[0]})
 
-############################################
-# Setting up json-file for nnUNet
-############################################
+    dst_t2w = os.path.join(images, 'PROSTATEx_' + numbers + '_0000' + identifier)
+    write_image(imgs['AxT2'], os.path.join(output_folder, dst_t2w))
+    outputs.append(dst_t2w)
 
+    if labels is not None:
+        imgs.update({'Seg': sitk.ReadImage(files['Seg'])})
+        dst_label = os.path.join(labels, 'PROSTATEx_' + numbers + identifier)
+        write_image(imgs['Seg'], os.path.join(output_folder, dst_label))
+        outputs.append(dst_label)
 
-from generate_dataset_json import generate_dataset_json
+    # Resample all additional sequences onto the T2 at the same time.
+    moving = dict(zip(sequences, series[1:]))
+    imgs.update(resampleSequencesToReference(moving, imgs['AxT2'], interpolator=sitk.sitkLinear, outputPixelType=OUTPUT_PIXEL_TYPES[output_dtype]))
 
-if 'ADC' and 'HBV' in image_sequences:
-    ch_names = {
-                0: 'T2',
-                1: 'ADC',
-                2: 'HBV'
-                }
-elif 'ADC' in image_sequences:
-    ch_names = {
-                0: 'T2',
-                1: 'ADC'
-                }
-    
-elif not 'ADC' in image_sequences:
-    ch_names = {
-                0: 'T2'
-                }
-        
-seg_labels = {
-            'background': 0,
-            'PZ': 1,
-            'CZ': 2,
-            'TZ': 3,
-            'AFS': 4,
-            'Urethra': 5
-        }
+    for channel, sequence in enumerate(sequences, start=1):
+        dst = os.path.join(images, 'PROSTATEx_' + numbers + '_' + str(channel).zfill(4) + identifier)
+        write_image(imgs[sequence], os.path.join(output_folder, dst))
+        outputs.append(dst)
 
-samples = len(os.listdir(os.path.join(output_folder, labels)))
+    return outputs
 
 
-generate_dataset_json(output_folder, ch_names, labels=seg_labels, num_training_cases=samples, file_ending=args.identifier)
+# Removes files written for a case that are not part of its current outputs.
+def remove_outputs(output_folder, old_outputs, new_outputs=()):
 
+    for output in set(old_outputs) - set(new_outputs):
+        if os.path.exists(os.path.join(output_folder, output)):
+            os.remove(os.path.join(output_folder, output))
 
-############################################
-# Setting up Test-data
-############################################
 
+if __name__ == '__main__':
 
-for patient_folder in os.listdir(os.path.join(args.input_folder, 'Test')):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--imgs', type=str, default=[], nargs='+', help='Additional image sequences you want to include. Options are: ADC and HBV.')
+    #parser.add_argument('--imgs', type=str, default=['ADC', 'HBV'], help='Additional image sequences you want to include. Options are: ADC or ADC and HBV.')
+    parser.add_argument('--identifier', type=str, default='.nrrd', help='File-type identifier. Options are: nrrd, ...')
+    parser.add_argument('--data_id', type=str, default="Dataset077_ProstateZones", help='Defining the ID of the dataset.')
+    parser.add_argument('--input_folder', type=str, default="C:\\William\\Doktorand\\Data\\test_output", help='Path to the folder containing the images.')
+    parser.add_argument('--output_folder', type=str, default="C:\\William\\TEST\\nnUNet_data\\nnUNet_raw", help='Path to the desired output folder.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of patients read and written at the same time.')
+    parser.add_argument('--threads', type=int, default=0, help='Number of threads used by each SimpleITK filter. 0 keeps the SimpleITK default.')
+    parser.add_argument('--output_dtype', type=str, default='float32', choices=list(OUTPUT_PIXEL_TYPES), help='Pixel type of the resampled sequences (ADC, HBV).')
+    parser.add_argument('--incremental', action='store_true', help='Only prepare patients that are new or changed since the last run (see manifest.json).')
+    parser.add_argument('--cache_folder', type=str, default=None, help='Folder for caching the decoded DICOM series. Unchanged series are not decoded again in later runs.')
+    args = parser.parse_args()
 
-    numbers = ''.join([n for n in patient_folder if n.isdigit()])[-3:]
+    image_sequences = args.imgs
+    image_sequences.insert(0, 'T2')
 
-    images = 'imagesTs'
+    sequences = get_additional_sequences(image_sequences)
 
-    makeDirectory(os.path.join(output_folder, images))
+    setNumberOfThreads(args.threads)
 
-        
-    for patient_file in os.listdir(os.path.join(args.input_folder, 'Test', patient_folder)):
+    output_folder = os.path.join(args.output_folder, args.data_id)
 
-        path_to_file = os.path.join(args.input_folder, 'Test', patient_folder, patient_file)
+    ############################################
+    # Setting up Training- and Test-data
+    ############################################
 
-        if 'tra' in patient_file:
-            t2w = read_image(path_to_file)
-            continue
+    manifest_file = os.path.join(output_folder, 'manifest.json')
+    makeDirectory(output_folder)
+    manifest = load_manifest(manifest_file)
+    options = {'sequences': sequences, 'identifier': args.identifier, 'output_dtype': args.output_dtype}
 
-        elif 'adc' in patient_file:
-            adc = read_image(path_to_file)
-            continue
+    jobs = []
+    cases = set()
+    skipped = 0
+    for data, images, labels in [('Train', 'imagesTr', 'labelsTr'), ('Validate', 'imagesTr', 'labelsTr'), ('Test', 'imagesTs', None)]:
 
-        elif 'hbv' in patient_file:
-            hbv = read_image(path_to_file)
-            continue
+        makeDirectory(os.path.join(output_folder, images))
+        if labels is not None:
+            makeDirectory(os.path.join(output_folder, labels))
 
+        for patient_folder in os.listdir(os.path.join(args.input_folder, data)):
 
-    imgs = dict()
+            patient_dir = os.path.join(args.input_folder, data, patient_folder)
+            case = data + '/' + patient_folder
+            cases.add(case)
+            sources = source_fingerprints(get_used_files(patient_dir, labels, sequences))
 
-    imgs.update({'AxT2': t2w})
+            entry = manifest['cases'].get(case)
+            if args.incremental and entry is not None and entry['sources'] == sources and entry['options'] == options and \
+                    all(os.path.exists(os.path.join(output_folder, output)) for output in entry['outputs']):
+                skipped += 1
+            else:
+                jobs.append((case, patient_dir, images, labels, sources))
 
-    dst_t2w = os.path.join(output_folder, images, 'PROSTATEx_' + numbers + '_0000' + args.identifier)
-    write_image(imgs['AxT2'], dst_t2w)
+    # Remove the outputs of patients that are no longer in the input folder.
+    if args.incremental:
+        for case in list(manifest['cases']):
+            if case not in cases:
+                remove_outputs(output_folder, manifest['cases'].pop(case)['outputs'])
+        save_manifest(manifest, manifest_file)
 
-    if 'ADC' and 'HBV' in image_sequences:
-        imgs.update({'ADC': resampleToReference(adc, imgs['AxT2'], interpolator=sitk.sitkLinear)})
-        dst_adc = os.path.join(output_folder, images, 'PROSTATEx_' + numbers + '_0001' + args.identifier)
-        imgs.update({'HBV': resampleToReference(hbv,  imgs['AxT2'], interpolator=sitk.sitkLinear)})
-        dst_hbv = os.path.join(output_folder, images, 'PROSTATEx_' + numbers + '_0002' + args.identifier)
+    start = time.perf_counter()
 
-        write_image(imgs['ADC'], dst_adc)
-        write_image(imgs['HBV'], dst_hbv)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(prepare_case, patient_dir, output_folder, images, labels, sequences, args.identifier, args.cache_folder, args.output_dtype): (case, sources)
+                   for case, patient_dir, images, labels, sources in jobs}
 
-    elif 'ADC' in image_sequences:
-        imgs.update({'ADC': resampleToReference(adc, imgs['AxT2'], interpolator=sitk.sitkLinear)})
-        dst_adc = os.path.join(output_folder, images, 'PROSTATEx_' + numbers + '_0001' + args.identifier)
+        # Record every finished patient right away, so that an interrupted run can be resumed.
+        for future in as_completed(futures):
+            case, sources = futures[future]
+            outputs = future.result()
+            if case in manifest['cases']:
+                remove_outputs(output_folder, manifest['cases'][case]['outputs'], outputs)
+            manifest['cases'][case] = {'sources': sources, 'options': options, 'outputs': outputs}
+            save_manifest(manifest, manifest_file)
 
-        write_image(imgs['ADC'], dst_adc)
+    if args.cache_folder is not None:
+        update_cache_index(args.cache_folder)
+
+    print('Prepared {} patients in {:.1f} s, {} unchanged patients skipped ({} workers).'.format(len(jobs), time.perf_counter() - start, skipped, args.workers))
+
+    ############################################
+    # Setting up json-file for nnUNet
+    ############################################
+
+
+    from generate_dataset_json import generate_dataset_json
+
+    if 'ADC' and 'HBV' in image_sequences:
+        ch_names = {
+                    0: 'T2',
+                    1: 'ADC',
+                    2: 'HBV'
+                    }
+    elif 'ADC' in image_sequences:
+        ch_names = {
+                    0: 'T2',
+                    1: 'ADC'
+                    }
+
+    elif not 'ADC' in image_sequences:
+        ch_names = {
+                    0: 'T2'
+                    }
+
+    seg_labels = {
+                'background': 0,
+                'PZ': 1,
+                'CZ': 2,
+                'TZ': 3,
+                'AFS': 4,
+                'Urethra': 5
+            }
+
+    samples = len(os.listdir(os.path.join(output_folder, 'labelsTr')))
+
+    # Only rewrite dataset.json when its content changes.
+    dataset_json = {'channel_names': ch_names, 'labels': seg_labels, 'numTraining': samples, 'file_ending': args.identifier}
+    if not args.incremental or manifest.get('dataset_json') != json.loads(json.dumps(dataset_json)) or \
+            not os.path.exists(os.path.join(output_folder, 'dataset.json')):
+        generate_dataset_json(output_folder, ch_names, labels=seg_labels, num_training_cases=samples, file_ending=args.identifier)
+        manifest['dataset_json'] = dataset_json
+        save_manifest(manifest, manifest_file)
@@ -0,0 +1,189 @@
+import os
+import json
+import weakref
+import zipfile
+import tempfile
+import numpy as np
+
+'''
+Access to the probabilities from the nnU-Net prediction without inflating the full softmax into memory.
+
+nnU-Net saves the probabilities as (C, Z, Y, X) in a compressed npz-file. This module converts them once into a
+C-contiguous, channel-last (Z, Y, X, C) npy-file that is memory-mapped afterwards (a temporary file if there is no cache
+folder). Uncompressed npy-files and raw
+files with a json sidecar are memory-mapped directly. The postprocessing always sees the probabilities as (X, Y, Z, C).
+'''
+
+
+class ProbabilitySource:
+    """
+    Probabilities with shape (X, Y, Z, C) backed by an in-memory or memory-mapped array.
+
+    Args:
+        array (np.ndarray): The stored array (e.g. np.memmap).
+        layout (str): Axis order of the stored array, e.g. 'CZYX' (nnU-Net) or 'ZYXC' (cache).
+    """
+
+    def __init__(self, array, layout='ZYXC'):
+        self.array = array
+        self.layout = layout.upper()
+        self.probabilities = array.transpose([self.layout.index(axis) for axis in 'XYZC'])
+
+    @property
+    def shape(self):
+        return self.probabilities.shape
+
+    @property
+    def dtype(self):
+        return self.probabilities.dtype
+
+    def channel(self, channel, dtype=np.float32):
+        """
+        Single channel as a C-contiguous (X, Y, Z) array.
+        """
+        return np.ascontiguousarray(self.probabilities[:, :, :, channel], dtype=dtype)
+
+    def slab(self, z_start, z_stop):
+        """
+        All channels of the z-slices [z_start, z_stop) as a (X, Y, z_stop - z_start, C) array.
+        Only this part of the file is read for memory-mapped sources.
+        """
+        return np.asarray(self.probabilities[:, :, z_start:z_stop])
+
+    def __getitem__(self, index):
+        return self.probabilities[index]
+
+
+def _read_npy_header(stream):
+
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(stream)
+    return np.lib.format.read_array_header_2_0(stream)
+
+
+def npz_to_channel_last(npz_file, output_file=None, key='probabilities', dtype=None):
+    """
+    Converts the probabilities in an nnU-Net npz-file (C, Z, Y, X) to a channel-last (Z, Y, X, C) array.
+    The npz-member is decompressed one z-slice of one channel (or, if it is stored in Fortran order, a block of about
+    the same size) at a time, so only that part is held in memory next to the output.
+
+    Args:
+        npz_file (str): Path to the npz-file.
+        output_file (str): Path to the npy-file that is created. If None, the array is kept in memory.
+        key (str): Name of the array in the npz-file.
+        dtype: Output data type (e.g. np.float16). Defaults to the stored type.
+
+    Returns:
+        np.ndarray: The converted array, memory-mapped read-only if output_file is given.
+    """
+    with zipfile.ZipFile(npz_file) as archive, archive.open(key + '.npy') as stream:
+        shape, fortran_order, stored_dtype = _read_npy_header(stream)
+        dtype = stored_dtype if dtype is None else np.dtype(dtype)
+        output_shape = shape[1:] + shape[:1]
+
+        if output_file is None:
+            output = np.empty(output_shape, dtype=dtype)
+        else:
+            # Per-process name, so that workers converting the same file into a shared cache do not write into
+            # each other's memory map.
+            tmp_file = output_file + '.' + str(os.getpid()) + '.tmp.npy'
+            output = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=output_shape)
+
+        # Size of the blocks that are decompressed at a time: one z-slice of one channel
+        block_size = int(np.prod(shape[2:]))
+
+        if fortran_order:
+            # The last axis (X) varies slowest, so the member is read in blocks of X-columns of all channels
+            columns = max(1, block_size // int(np.prod(shape[:-1])))
+            for x in range(0, shape[-1], columns):
+                block_shape = shape[:-1] + (min(columns, shape[-1] - x),)
+                buffer = stream.read(int(np.prod(block_shape)) * stored_dtype.itemsize)
+                block = np.frombuffer(buffer, dtype=stored_dtype).reshape(block_shape, order='F')
+                output[:, :, x:x + block_shape[-1], :] = np.moveaxis(block, 0, -1)
+        else:
+            for channel in range(shape[0]):
+                for z in range(shape[1]):
+                    buffer = stream.read(block_size * stored_dtype.itemsize)
+                    output[z, ..., channel] = np.frombuffer(buffer, dtype=stored_dtype).reshape(shape[2:])
+
+    if output_file is None:
+        return output
+
+    output.flush()
+    del output
+
+    # Rename when finished so that an interrupted conversion is never picked up as a valid cache.
+    os.replace(tmp_file, output_file)
+
+    return np.load(output_file, mmap_mode='r')
+
+
+# Removes a file if it still exists.
+def _remove_file(file):
+
+    try:
+        os.remove(file)
+    except OSError:
+        pass
+
+
+def open_probabilities(path, cache_folder=None, dtype=None, layout='CZYX'):
+    """
+    Opens the probabilities from the model prediction.
+
+    Args:
+        path (str): Path to a npz-file (nnU-Net output), an uncompressed npy-file or a raw file with a json sidecar
+            (same name, '.json', containing 'shape', 'dtype' and 'layout').
+        cache_folder (str): Folder for the channel-last npy-files converted from npz-files. If None, the npz-file is
+            converted into a temporary npy-file in the default temporary folder (TMPDIR), which is removed when the
+            array is no longer used.
+        dtype: Data type of the converted npz-file (e.g. np.float16 to halve the size). Defaults to the stored type.
+        layout (str): Axis order of npy-files.
+
+    Returns:
+        ProbabilitySource: Probabilities with shape (X, Y, Z, C).
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == '.npy':
+        return ProbabilitySource(np.load(path, mmap_mode='r'), layout=layout)
+
+    if extension == '.raw':
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            header = json.load(f)
+        array = np.memmap(path, dtype=np.dtype(header['dtype']), mode='r', shape=tuple(header['shape']))
+        return ProbabilitySource(array, layout=header.get('layout', layout))
+
+    if extension != '.npz':
+        raise ValueError('Unsupported probability file: ' + path)
+
+    if cache_folder is None:
+        handle, tmp_file = tempfile.mkstemp(suffix='.npy')
+        os.close(handle)
+        try:
+            array = npz_to_channel_last(path, tmp_file, dtype=dtype)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+        # The memory map keeps the data of a removed file on POSIX. Windows cannot remove a mapped file, so it is
+        # removed once the array is garbage collected.
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            weakref.finalize(array, _remove_file, tmp_file)
+
+        return ProbabilitySource(array, layout='ZYXC')
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    suffix = '_zyxc.npy' if dtype is None else '_zyxc_' + np.dtype(dtype).name + '.npy'
+    cache_file = os.path.join(cache_folder, name + suffix)
+
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(path):
+        array = np.load(cache_file, mmap_mode='r')
+    else:
+        os.makedirs(cache_folder, exist_ok=True)
+        array = npz_to_channel_last(path, cache_file, dtype=dtype)
+
+    return ProbabilitySource(array, layout='ZYXC')
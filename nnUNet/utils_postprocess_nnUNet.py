@@ -1,8 +1,9 @@
 import os
 import numpy as np
-import skimage
 from scipy.ndimage import distance_transform_edt
 
+from connected_components import largest_component, largest_components, bounding_box
+
 
 def get_filenames_with_extension(folder_path, extension):
     """
@@ -27,12 +28,7 @@ def channelSplit(array, channel):
 
 
 def getLargestCC(segmentation):
-    labels = skimage.measure.label(segmentation, connectivity=2)
-    if labels.max() != 0: # Assuming at least one CC
-        largestCC = labels == np.argmax(np.bincount(labels.flat)[1:])+1
-    else:
-        largestCC = labels == 100
-    return largestCC
+    return largest_component(segmentation)
 
 
 def drawUrethra(array_shape, indicies, radius_mm, inplane_image_spacing):
@@ -83,44 +79,239 @@ def column(matrix, i):
     return [row[i] for row in matrix]
 
 
-def fill_empty_voxels(background, pz, cz, tz, afs, urethra, spacing):
+def urethra_centerline(u):
+    """
+    Location of the maximum urethra probability in every z-slice, as findIndices_allSlices but for all slices at once.
+    If the maximum occurs more than once in a slice, the rounded mean location is used.
+
+    Args:
+        u (np.ndarray): Urethra probabilities with shape (X, Y, Z).
+
+    Returns:
+        tuple: x, y, z and w (the maximum, used as weight) with one value per z-slice.
+    """
+    w = u.max(axis=(0, 1))
+    x_max, y_max, z_max = np.unravel_index(np.flatnonzero(u == w), u.shape)
+
+    # Mean location of the maxima in each slice (sums of integers, so exact as in np.average).
+    count = np.bincount(z_max, minlength=u.shape[2])
+    x = np.round(np.bincount(z_max, weights=x_max, minlength=u.shape[2]) / count)
+    y = np.round(np.bincount(z_max, weights=y_max, minlength=u.shape[2]) / count)
+    z = np.arange(u.shape[2], dtype=np.float64)
+
+    return x, y, z, w.astype(np.float64)
+
+
+def fit_urethra(x, y, z, w, deg=2):
+    """
+    Weighted polynomial fit of x(z) and y(z).
+    The two fits are kept separate: a single fit with two columns gives slightly different coefficients, which can
+    change the rounded centre.
+
+    Returns:
+        tuple: Rounded x and y from the fitted polynomials for every z.
+    """
+    x_p = np.round(np.polyval(np.polyfit(z, x, deg=deg, w=w), z))
+    y_p = np.round(np.polyval(np.polyfit(z, y, deg=deg, w=w), z))
+
+    return x_p, y_p
+
+
+def draw_urethra_volume(array_shape, x, y, radius_mm, inplane_image_spacing):
+    """
+    Draws a disk around (x[z], y[z]) in every z-slice, as drawUrethra but for all slices at once.
+    The centres are whole pixels (rounded), so the same disk stencil is painted in every slice.
+
+    Args:
+        array_shape (tuple): Shape of the volume (X, Y, Z).
+        x, y (np.ndarray): Rounded centre of the disk in every z-slice.
+        radius_mm (float): Radius of the disk in mm.
+        inplane_image_spacing (float): In-plane spacing in mm.
+
+    Returns:
+        np.ndarray: Boolean volume with the drawn urethra.
+    """
+    radius = radius_mm / inplane_image_spacing
+
+    # Pixel offsets within the disk
+    r = int(np.floor(radius))
+    dx, dy = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1), indexing='ij')
+    inside = dx ** 2 + dy ** 2 <= radius ** 2
+    dx, dy = dx[inside], dy[inside]
+
+    # Disk pixels for all slices, dropping those outside the volume
+    p = x[:, None] + dx[None, :]
+    q = y[:, None] + dy[None, :]
+    z = np.broadcast_to(np.arange(len(x))[:, None], p.shape)
+    within = (p >= 0) & (p < array_shape[0]) & (q >= 0) & (q < array_shape[1])
+
+    urethra = np.zeros(array_shape, dtype=bool)
+    urethra[p[within].astype(np.intp), q[within].astype(np.intp), z[within]] = True
+
+    return urethra
+
+
+def reconstruct_urethra(u, radius_mm, inplane_image_spacing, box=None):
+    """
+    Urethra as disks along a second degree polynomial fitted through the maximum urethra probability of every z-slice.
+    The fit always uses the full volume; with box (tuple of slices) only the part within the box is drawn and returned.
+    """
+    x, y, z, w = urethra_centerline(u)
+    x_p, y_p = fit_urethra(x, y, z, w)
+
+    if box is None:
+        return draw_urethra_volume(u.shape, x_p, y_p, radius_mm, inplane_image_spacing)
+
+    shape = tuple(b.stop - b.start for b in box)
+    return draw_urethra_volume(shape, x_p[box[2]] - box[0].start, y_p[box[2]] - box[1].start, radius_mm, inplane_image_spacing)
+
+
+def labels_from_probabilities(probabilities, slab_size=8):
+    """
+    Single argmax over the channel axis, computed in slabs along z so that only a small int64 buffer is needed.
+
+    Args:
+        probabilities (np.ndarray): Probabilities with shape (X, Y, Z, C).
+        slab_size (int): Number of z-slices handled at a time.
+
+    Returns:
+        np.ndarray: uint8 label volume with shape (X, Y, Z).
+    """
+    labels = np.empty(probabilities.shape[:3], dtype=np.uint8)
+    for z in range(0, probabilities.shape[2], slab_size):
+        labels[:, :, z:z + slab_size] = np.argmax(probabilities[:, :, z:z + slab_size], axis=3)
+    return labels
+
+
+def labels_from_masks(masks):
+    """
+    Label volume from a list of binary masks, equal to np.stack(masks, axis=-1).argmax(axis=-1) but without the stack.
+
+    Args:
+        masks (list): Binary masks, the position in the list is the label.
+
+    Returns:
+        np.ndarray: uint8 label volume.
+    """
+    labels = np.zeros(masks[0].shape, dtype=np.uint8)
+    # Reverse order so that overlapping voxels get the lowest label, as with argmax.
+    for label in reversed(range(1, len(masks))):
+        labels[masks[label].astype(bool, copy=False)] = label
+    labels[masks[0].astype(bool, copy=False)] = 0
+    return labels
+
+
+def get_prostate(labels):
+
+    lcc_background = getLargestCC(labels == 0)
+
+    return getLargestCC(~lcc_background)
+
+
+def get_bounding_box(mask, margin=0):
+    """
+    Bounding box of a mask, extended by a margin (voxels) and clamped to the volume.
+
+    Returns:
+        tuple: Slices of the bounding box, or None if the mask is empty.
+    """
+    box = bounding_box(mask)
+    if box is None:
+        return None
+
+    return tuple(slice(max(b.start - margin, 0), min(b.stop + margin, n)) for b, n in zip(box, mask.shape))
+
+
+def zone_distance(zone, spacing, box=None, full_shape=None):
+    """
+    Distance from every voxel to the zone. All zone voxels lie within a crop around the prostate, so the distances
+    within the crop are the same as in the full volume. An empty zone has no voxel to measure from and the distance
+    transform then depends on the volume itself, so it is computed on the full volume.
+    """
+    if box is not None and not zone.any():
+        return distance_transform_edt(np.ones(full_shape, dtype=bool), sampling=spacing)[box]
+
+    return distance_transform_edt(~zone, sampling=spacing)
+
+
+def fill_nearest_zone(background, zones, urethra, spacing, box=None, full_shape=None):
+    """
+    Assigns the voxels within the prostate that are not part of any zone (or the urethra) to the closest zone.
+
+    Args:
+        background (np.ndarray): Background mask.
+        zones (list): Boolean zone masks (PZ, CZ, TZ, AFS), updated in place.
+        urethra (np.ndarray): Boolean urethra mask.
+        spacing (tuple): Voxel spacing used for the distance maps.
+        box (tuple): If the masks are cropped from a larger volume, the slices of the crop.
+        full_shape (tuple): Shape of the uncropped volume, needed together with box.
+
+    Returns:
+        list: The filled zone masks.
+    """
+    # Get mask of empty voxels within the prostate boundary
+    labelled = np.logical_or.reduce(zones)
+    empty_voxels = ~background.astype(bool, copy=False) & ~urethra & ~labelled
+    if not empty_voxels.any():
+        return zones
+
+    # The distance transforms only need to cover the empty voxels and all zone voxels (the voxels they measure from),
+    # so they are computed within the bounding box of both. The box is composed with the crop of the masks, if any,
+    # for the full-volume distances of an empty zone.
+    inner = get_bounding_box(empty_voxels | labelled)
+    if full_shape is None:
+        full_shape = empty_voxels.shape
+    outer = box if box is not None else tuple(slice(0, n) for n in full_shape)
+    crop = tuple(slice(o.start + i.start, o.start + i.stop) for o, i in zip(outer, inner))
+    empty_crop = empty_voxels[inner]
+
+    # Distances to each zone (Euclidean distance transform), only kept for the empty voxels.
+    # Order of the rows must match the order of the zones since ties go to the first zone.
+    distances = np.stack([zone_distance(zone[inner], spacing, crop, full_shape)[empty_crop] for zone in zones], axis=0)
+
+    # Assign all empty voxels to their closest zone at once
+    closest_zone_index = np.argmin(distances, axis=0)
+    for zone_index, zone in enumerate(zones):
+        zone[inner][empty_crop] = closest_zone_index == zone_index
+
+    return zones
+
+
+def fill_empty_zones(background, pz, cz, tz, afs, urethra, spacing):
+
+    urethra = urethra.astype(bool, copy=False)
+
+    zones = [getLargestCC(zone) & ~urethra for zone in [pz, cz, tz, afs]]
 
-    pz_lcc = getLargestCC(pz)
-    cz_lcc = getLargestCC(cz)
-    tz_lcc = getLargestCC(tz)
-    afs_lcc = getLargestCC(afs)
-
-    pz_within_prostate = pz_lcc & (~urethra.astype(bool))
-    cz_within_prostate = cz_lcc & (~urethra.astype(bool))
-    tz_within_prostate = tz_lcc & (~urethra.astype(bool))
-    afs_within_prostate = afs_lcc & (~urethra.astype(bool))
-
-    # Get indices of empty voxels within the prostate boundary
-    empty_voxel_indices = np.argwhere((background == False) & (urethra == False) & (pz_within_prostate == False) &
-                                      (cz_within_prostate == False) & (tz_within_prostate == False) &
-                                      (afs_within_prostate == False))
-
-    # Create distance maps for each zone using Euclidean distance transform
-    pz_dist = distance_transform_edt(~pz_within_prostate, sampling=spacing)
-    cz_dist = distance_transform_edt(~cz_within_prostate, sampling=spacing)
-    tz_dist = distance_transform_edt(~tz_within_prostate, sampling=spacing)
-    afs_dist = distance_transform_edt(~afs_within_prostate, sampling=spacing)
-
-    # Iterate over empty voxel indices and assign them to the nearest zone
-    for voxel_index in empty_voxel_indices:
-        distances = [pz_dist[tuple(voxel_index)], cz_dist[tuple(voxel_index)], tz_dist[tuple(voxel_index)], afs_dist[tuple(voxel_index)]]
-        # Find the index of the closest zone
-        closest_zone_index = np.argmin(distances)
-        # Assign the voxel to the closest zone
-        if closest_zone_index == 0:
-            pz_within_prostate[tuple(voxel_index)] = True
-        elif closest_zone_index == 1:
-            cz_within_prostate[tuple(voxel_index)] = True
-        elif closest_zone_index == 2:
-            tz_within_prostate[tuple(voxel_index)] = True
-        else:
-            afs_within_prostate[tuple(voxel_index)] = True
+    return fill_nearest_zone(background, zones, urethra, spacing)
 
 
+def fill_empty_voxels(background, pz, cz, tz, afs, urethra, spacing):
+
+    pz_within_prostate, cz_within_prostate, tz_within_prostate, afs_within_prostate = fill_empty_zones(background, pz, cz, tz, afs, urethra, spacing)
+
     return np.stack([background, pz_within_prostate.astype(int), cz_within_prostate.astype(int), tz_within_prostate.astype(int), afs_within_prostate.astype(int),
                      urethra], axis=-1)
+
+
+def fill_empty_labels(background, prediction, prostate, urethra, spacing, box=None, full_shape=None):
+    """
+    Postprocessed label volume (0-5) from the predicted labels, the prostate mask and the drawn urethra.
+
+    Args:
+        background (np.ndarray): Boolean background mask.
+        prediction (np.ndarray): uint8 label volume from the model prediction.
+        prostate (np.ndarray): Boolean prostate mask.
+        urethra (np.ndarray): Boolean urethra mask.
+        spacing (tuple): Voxel spacing used for the distance maps.
+        box (tuple): If the arrays are cropped from a larger volume, the slices of the crop.
+        full_shape (tuple): Shape of the uncropped volume, needed together with box.
+
+    Returns:
+        np.ndarray: uint8 label volume.
+    """
+    # Largest component of each zone within the prostate, all zones labelled in one pass when possible.
+    zones = largest_components(np.where(prostate, prediction, 0), [1, 2, 3, 4])
+    zones = fill_nearest_zone(background, [zone & ~urethra for zone in zones], urethra, spacing, box, full_shape)
+
+    return labels_from_masks([background] + zones + [urethra])
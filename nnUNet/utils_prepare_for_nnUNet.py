@@ -1,6 +1,9 @@
 import os
+import json
+import hashlib
 import SimpleITK as sitk
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 def makeDirectory(pathToDir):
 
@@ -13,7 +16,10 @@ def write_image(img, dst):
     sitk.WriteImage(img, dst)
 
 
-def read_image(dcm_folder):
+def read_image(dcm_folder, cache_folder=None):
+
+    if cache_folder is not None:
+        return read_image_cached(dcm_folder, cache_folder)
                 
     reader = sitk.ImageSeriesReader()
     dcm_files = reader.GetGDCMSeriesFileNames(dcm_folder)
@@ -22,6 +28,98 @@ def read_image(dcm_folder):
 
     return img
 
+
+# Output pixel types for the resampled sequences. SimpleITK (and NRRD) has no float16, int16 is the compact option.
+OUTPUT_PIXEL_TYPES = {'float32': sitk.sitkFloat32, 'int16': sitk.sitkInt16, 'uint16': sitk.sitkUInt16}
+
+
+# Sets the number of threads used by every SimpleITK filter (0 keeps the SimpleITK default).
+def setNumberOfThreads(threads):
+
+    if threads > 0:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+
+# Reads several DICOM series concurrently.
+def read_images(dcm_folders, cache_folder=None):
+
+    if len(dcm_folders) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(dcm_folders)) as executor:
+        return list(executor.map(lambda dcm_folder: read_image(dcm_folder, cache_folder), dcm_folders))
+
+
+# Resamples several images (e.g. ADC and HBV) onto the grid of the reference image (T2) at the same time.
+# The images are interpolated as float32, as in resampleToReference, and optionally rounded to a compact output type.
+def resampleSequencesToReference(images, referenceImage, interpolator=sitk.sitkLinear, defaultValue=0, outputPixelType=sitk.sitkFloat32):
+
+    identity = sitk.Transform()
+
+    def resample(inputImage):
+        outputImage = sitk.Resample(inputImage, referenceImage, identity, interpolator, defaultValue, sitk.sitkFloat32)
+        if outputPixelType != sitk.sitkFloat32:
+            outputImage = sitk.Clamp(sitk.Round(outputImage), outputPixelType)
+        return outputImage
+
+    if len(images) == 0:
+        return dict()
+
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        return dict(zip(images.keys(), executor.map(resample, images.values())))
+
+
+# Fingerprint of a DICOM folder from its file names, sizes and modification times. No DICOM header is read.
+def series_fingerprint(dcm_folder):
+
+    files = sorted([entry.name, entry.stat().st_size, entry.stat().st_mtime_ns] for entry in os.scandir(dcm_folder) if entry.is_file())
+    key = hashlib.sha1(json.dumps([os.path.abspath(dcm_folder), files]).encode()).hexdigest()
+
+    return key, files
+
+
+# Reads a DICOM series through a cache of decoded volumes. The volume is stored as KEY.nrrd together with KEY.json
+# (folder and file list), where KEY is the fingerprint of the folder. A changed folder gets a new key and is re-read.
+def read_image_cached(dcm_folder, cache_folder):
+
+    key, files = series_fingerprint(dcm_folder)
+    cached_image = os.path.join(cache_folder, key + '.nrrd')
+
+    if os.path.exists(cached_image):
+        img = sitk.ReadImage(cached_image)
+        # Drop the NRRD header fields so that the image is the same as when read from DICOM.
+        for meta_key in img.GetMetaDataKeys():
+            img.EraseMetaData(meta_key)
+        return img
+
+    img = read_image(dcm_folder)
+
+    makeDirectory(cache_folder)
+    tmp_image = os.path.join(cache_folder, key + '.tmp.nrrd')
+    write_image(img, tmp_image)
+    os.replace(tmp_image, cached_image)
+
+    with open(os.path.join(cache_folder, key + '.json'), 'w') as f:
+        json.dump({'folder': os.path.abspath(dcm_folder), 'image': key + '.nrrd', 'files': files}, f)
+
+    return img
+
+
+# Collects the entries of the cache into index.json (fingerprint -> folder, cached image and file list).
+def update_cache_index(cache_folder):
+
+    index = dict()
+    for filename in sorted(os.listdir(cache_folder)):
+        if filename.endswith('.json') and filename != 'index.json':
+            with open(os.path.join(cache_folder, filename)) as f:
+                entry = json.load(f)
+            index[os.path.splitext(filename)[0]] = entry
+
+    with open(os.path.join(cache_folder, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=4)
+
+    return index
+
 def resampleToReference(inputImage, referenceImage, interpolator=sitk.sitkLinear, defaultValue=0):
 
     castImageFilter = sitk.CastImageFilter()
@@ -35,4 +133,35 @@ def resampleToReference(inputImage, referenceImage, interpolator=sitk.sitkLinear
 
     outputImage = filter.Execute(inputImage)
     
-    return outputImage
\ No newline at end of file
+    return outputImage
+
+# Fingerprint of a single file from its path, size and modification time.
+def file_fingerprint(path):
+
+    stat = os.stat(path)
+
+    return hashlib.sha1(json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns]).encode()).hexdigest()
+
+
+# Fingerprints of the source files (DICOM folders or files) of a case.
+def source_fingerprints(files):
+
+    return {name: series_fingerprint(path)[0] if os.path.isdir(path) else file_fingerprint(path) for name, path in files.items()}
+
+
+def load_manifest(manifest_file):
+
+    if not os.path.exists(manifest_file):
+        return {'cases': {}}
+
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+# Saves the manifest through a temporary file, so that an interrupted run never leaves a broken manifest.
+def save_manifest(manifest, manifest_file):
+
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_file, manifest_file)